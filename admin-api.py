@@ -9,17 +9,26 @@ import asyncio
 import json
 import os
 import re
+import signal
 import subprocess
+import sys
 import time
 import hashlib
+import gzip
+import io
 from pathlib import Path
 from http.server import HTTPServer, SimpleHTTPRequestHandler, ThreadingHTTPServer
 from http import HTTPStatus
 import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 import urllib.parse
 import urllib.request
 import socket
 
+import blob_store
+import history_store
+
 try:
     from wiro_client import WiroClient
 except ImportError:
@@ -30,6 +39,11 @@ try:
 except ImportError:
     vector_store = None
 
+try:
+    import intent_router
+except ImportError:
+    intent_router = None
+
 # ─── Configuration ───────────────────────────────────────────────
 API_PORT = int(os.environ.get("KOALACLAW_API_PORT", "3099"))
 INSTALL_DIR = os.environ.get("KOALACLAW_INSTALL_DIR", "/opt/koalaclaw")
@@ -37,8 +51,29 @@ STATE_FILE = os.path.join(INSTALL_DIR, ".koalaclaw.state")
 UI_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ui")
 ROLES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "roles")
 DATA_DIR = os.path.join(INSTALL_DIR, "data")
+BLOB_DIR = os.path.join(DATA_DIR, "blobs")
 SETTINGS_FILE = os.path.join(INSTALL_DIR, ".settings.json")
 
+# Orchestration: max delegations running at once, per-delegation timeout (s),
+# and how often (s) to ping an idle SSE stream to detect client disconnects
+ORCH_PARALLELISM = int(os.environ.get("KOALACLAW_ORCH_PARALLELISM", "4"))
+ORCH_DELEGATION_TIMEOUT = int(os.environ.get("KOALACLAW_ORCH_DELEGATION_TIMEOUT", "120"))
+SSE_KEEPALIVE_INTERVAL = 5
+
+# Broadcast: max agents messaged at once (requests may ask for fewer) and per-agent timeout (s)
+BROADCAST_PARALLELISM = int(os.environ.get("KOALACLAW_BROADCAST_PARALLELISM", "8"))
+BROADCAST_TIMEOUT = 90
+
+# Identical (agent, message) calls in flight share one exec; a finished result
+# can also be reused for this many seconds (0 = only coalesce in-flight calls)
+COALESCE_REUSE_SECONDS = float(os.environ.get("KOALACLAW_COALESCE_REUSE_SECONDS", "0"))
+
+# Recent chat history kept in memory per agent (write-through), with a global
+# size cap; the least recently used agents are evicted first
+HISTORY_LONGPOLL_MAX = 30  # seconds a ?wait= history request may block
+HISTORY_RING_SIZE = int(os.environ.get("KOALACLAW_HISTORY_RING_SIZE", "200"))
+HISTORY_CACHE_MAX_BYTES = int(os.environ.get("KOALACLAW_HISTORY_CACHE_MB", "64")) * 1024 * 1024
+
 # Allowed agent file paths (relative to agent dir): workspace root or mind/
 AGENT_EDITABLE_FILES = [
     "workspace/IDENTITY.md",
@@ -240,59 +275,231 @@ def get_wiro_client():
 
 
 # ─── Chat History ────────────────────────────────────────────────
-def get_history_path(agent_id):
-    """Get the chat history file path for an agent."""
-    return os.path.join(DATA_DIR, f"koala-agent-{agent_id}", "chat-history.jsonl")
+def get_history_store(agent_id):
+    """Get the segmented history store for an agent (migrates chat-history.jsonl on first use)."""
+    return history_store.open_store(os.path.join(DATA_DIR, f"koala-agent-{agent_id}"))
+
+
+_blobs = blob_store.BlobStore(BLOB_DIR)
+
+
+def get_media_index(agent_id):
+    """Media URLs (url, kind, timestamp, role, seq) seen in an agent's history."""
+    return history_store.open_media_index(os.path.join(DATA_DIR, f"koala-agent-{agent_id}"))
+
+
+class _HistoryCache:
+    """Bounded in-memory ring of the most recent history entries per agent.
+
+    Rings are warmed lazily from disk and kept current by write-through
+    appends. Total size (serialized bytes) is capped across agents, evicting
+    the least recently used ring first.
+    """
+
+    def __init__(self, ring_size, max_bytes):
+        self.ring_size = ring_size
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._rings = OrderedDict()
+        self._appends = {}
+        self._bytes = 0
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def get(self, agent_id, limit, loader):
+        """Return the last `limit` (seq, entry) pairs; loader(n) reads the last n from disk."""
+        key = str(agent_id)
+        with self._lock:
+            ring = self._rings.get(key)
+            if ring and (limit <= len(ring["entries"]) or ring["complete"]):
+                self._rings.move_to_end(key)
+                self._stats["hits"] += 1
+                return [(seq, e) for _, seq, e in list(ring["entries"])[-limit:]]
+            self._stats["misses"] += 1
+            seen_appends = self._appends.get(key, 0)
+
+        wanted = max(limit, self.ring_size)
+        entries = loader(wanted)
+        with self._lock:
+            # An append that raced with the disk read may be missing from `entries`
+            if self._appends.get(key, 0) == seen_appends and key not in self._rings:
+                sized = deque(((len(json.dumps(e)), seq, e) for seq, e in entries[-self.ring_size:]),
+                              maxlen=self.ring_size)
+                # Complete only if the disk read returned everything and all of it fits in the ring
+                complete = len(entries) < wanted and len(entries) <= self.ring_size
+                self._rings[key] = {"entries": sized, "complete": complete}
+                self._bytes += sum(item[0] for item in sized)
+                self._evict()
+        return entries[-limit:]
+
+    def after(self, agent_id, after, limit):
+        """(seq, entry) pairs newer than `after` if the ring covers them, else None."""
+        key = str(agent_id)
+        with self._lock:
+            ring = self._rings.get(key)
+            if not ring:
+                return None
+            entries = ring["entries"]
+            # Anything older than the ring's first entry is only on disk
+            if not entries:
+                return [] if ring["complete"] else None
+            if after + 1 < entries[0][1]:
+                return None
+            self._rings.move_to_end(key)
+            self._stats["hits"] += 1
+            return [(seq, e) for _, seq, e in entries if seq > after][:limit]
+
+    def append(self, agent_id, seq, entry, size):
+        key = str(agent_id)
+        with self._lock:
+            self._appends[key] = self._appends.get(key, 0) + 1
+            ring = self._rings.get(key)
+            if not ring:
+                return
+            entries = ring["entries"]
+            if len(entries) == entries.maxlen:
+                self._bytes -= entries[0][0]
+                ring["complete"] = False
+            entries.append((size, seq, entry))
+            self._bytes += size
+            self._rings.move_to_end(key)
+            self._evict()
+
+    def _evict(self):
+        while self._bytes > self.max_bytes and len(self._rings) > 1:
+            _, ring = self._rings.popitem(last=False)
+            self._bytes -= sum(item[0] for item in ring["entries"])
+            self._stats["evictions"] += 1
+
+    def stats(self):
+        with self._lock:
+            return {**self._stats, "agents": len(self._rings), "bytes": self._bytes,
+                    "max_bytes": self.max_bytes, "ring_size": self.ring_size}
+
+
+_history_cache = _HistoryCache(HISTORY_RING_SIZE, HISTORY_CACHE_MAX_BYTES)
+
+
+class _HistoryNotifier:
+    """Per-agent append counters that long-poll/SSE readers can wait on."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._conds = {}
+        self._versions = {}
+
+    def _cond(self, key):
+        with self._lock:
+            cond = self._conds.get(key)
+            if cond is None:
+                cond = self._conds[key] = threading.Condition()
+            return cond
+
+    def version(self, agent_id):
+        cond = self._cond(str(agent_id))
+        with cond:
+            return self._versions.get(str(agent_id), 0)
+
+    def notify(self, agent_id):
+        key = str(agent_id)
+        cond = self._cond(key)
+        with cond:
+            self._versions[key] = self._versions.get(key, 0) + 1
+            cond.notify_all()
+
+    def wait(self, agent_id, version, timeout):
+        """Block until the agent's version moves past `version` or timeout. Returns the new version."""
+        key = str(agent_id)
+        cond = self._cond(key)
+        with cond:
+            cond.wait_for(lambda: self._versions.get(key, 0) != version, timeout)
+            return self._versions.get(key, 0)
+
+
+_history_notifier = _HistoryNotifier()
 
 
 def read_chat_history(agent_id, limit=100):
-    """Read chat history from JSONL file."""
-    path = get_history_path(agent_id)
-    if not os.path.exists(path):
-        return []
-    
-    entries = []
+    """Read chat history (last `limit` entries, or all if limit is 0).
+
+    Recent windows are served from the in-memory ring; larger ones from disk.
+    """
+    return [e for _, e in read_chat_page(agent_id, limit=limit)]
+
+
+def read_chat_page(agent_id, before=None, after=None, limit=100):
+    """(seq, entry) pairs: the last `limit`, or `limit` around a before/after cursor (seq)."""
     try:
-        with open(path, "r") as f:
-            for line in f:
-                line = line.strip()
-                if line:
-                    try:
-                        entries.append(json.loads(line))
-                    except json.JSONDecodeError:
-                        continue
-    except Exception:
+        store = get_history_store(agent_id)
+        if after is not None:
+            cached = _history_cache.after(agent_id, after, limit)
+            return cached if cached is not None else store.page(after=after, limit=limit)
+        if before is not None:
+            return store.page(before=before, limit=limit)
+        if not limit:
+            return list(store.iter_range())
+        return _history_cache.get(agent_id, limit, store.tail)
+    except Exception as e:
+        print(f"[HISTORY] Read failed for agent {agent_id}: {e}", file=sys.stderr, flush=True)
         return []
-    
-    # Return last N entries
-    return entries[-limit:] if limit else entries
+
+
+def _attach_image(agent_id, entry, image_base64):
+    """Move a data-URL attachment into the blob store; history keeps only the reference."""
+    try:
+        digest, mime, _ = _blobs.put_data_url(image_base64)
+        entry["image_blob"] = digest
+        entry["image_type"] = mime
+    except Exception as e:
+        print(f"[HISTORY] Storing attachment inline for agent {agent_id}: {e}", file=sys.stderr, flush=True)
+        entry["image_base64"] = image_base64
 
 
 def append_chat_history(agent_id, role, content, image_base64=None):
-    """Append a message to chat history JSONL file + Qdrant vector store."""
-    path = get_history_path(agent_id)
-    os.makedirs(os.path.dirname(path), exist_ok=True)
-    
+    """Append a message to the agent's history store + Qdrant vector store."""
+
     ts = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
     entry = {
         "role": role,
         "content": content,
         "timestamp": ts,
     }
-    if image_base64 is not None:
-        entry["image_base64"] = image_base64
-    
-    try:
-        with open(path, "a") as f:
-            f.write(json.dumps(entry) + "\n")
-    except Exception:
-        pass
+    if image_base64:
+        _attach_image(agent_id, entry, image_base64)
+    append_history_entries(agent_id, [entry])
+
+
+def append_history_entries(agent_id, entries, bulk=False):
+    """Append prepared entries in one commit and fan out to the cache, media index and vector store.
 
-    if vector_store and content and content.strip():
+    bulk=True (imports) waits for room in the vector indexing queue instead of dropping.
+    """
+    lines = [json.dumps(entry).encode("utf-8") for entry in entries]
+    media = get_media_index(agent_id)
+
+    def committed(seq, entry, line):
+        # Runs inside the group commit, in seq order across concurrent appends
+        _history_cache.append(agent_id, seq, entry, len(line))
         try:
-            vector_store.add_chat_message(int(agent_id), role, content, ts)
-        except Exception:
-            pass
+            media.add(seq, entry)
+        except Exception as e:
+            print(f"[HISTORY] Media index update failed for agent {agent_id}: {e}", file=sys.stderr, flush=True)
+
+    try:
+        get_history_store(agent_id).append_many(list(zip(entries, lines)), on_commit=committed)
+    except Exception as e:
+        print(f"[HISTORY] Append failed for agent {agent_id}: {e}", file=sys.stderr, flush=True)
+    else:
+        _history_notifier.notify(agent_id)
+
+    if vector_store:
+        for entry in entries:
+            content = entry.get("content")
+            if isinstance(content, str) and content.strip():
+                try:
+                    vector_store.enqueue_chat_message(int(agent_id), entry.get("role", ""), content,
+                                                      entry.get("timestamp", ""), block=bulk)
+                except Exception:
+                    pass
 
 
 # ─── Docker Helpers ──────────────────────────────────────────────
@@ -565,25 +772,306 @@ def get_system_info():
     return info
 
 
+# ─── Orchestrator Prompt ─────────────────────────────────────────
+# Token budget per optional section of the routing prompt (~4 chars per token)
+ANALYSIS_PROMPT_BUDGET = {
+    "roster": 800,
+    "media": 300,
+    "selection": 200,
+    "rag": 600,
+    "message": 1000,
+}
+RAG_MIN_SCORE = 0.3
+# Hybrid (dense + keyword) retrieval finds exact-term matches without a deep result list
+RAG_LIMIT = int(os.environ.get("KOALACLAW_RAG_LIMIT", "3" if vector_store and vector_store.HYBRID_ENABLED else "5"))
+
+_roster_cache = {}
+_roster_cache_lock = threading.Lock()
+
+
+def estimate_tokens(text):
+    """Cheap token estimate (~4 characters per token)."""
+    return (len(text) + 3) // 4
+
+
+def _truncate_to_tokens(text, tokens, keep_tail=False):
+    """Cut text to roughly `tokens` tokens, marking the cut."""
+    limit = tokens * 4
+    if len(text) <= limit:
+        return text
+    if keep_tail:
+        head = limit * 2 // 3
+        return text[:head] + " [...] " + text[-(limit - head):]
+    return text[:limit] + " [...]"
+
+
+def get_roster_snapshot(state):
+    """Return (roster list, roster text) for the orchestrator, cached per role layout."""
+    count = int(state.get("AGENT_COUNT", "0"))
+    key = tuple(state.get(f"ROLE_{i}", "") for i in range(1, count + 1))
+    with _roster_cache_lock:
+        cached = _roster_cache.get(key)
+    if cached:
+        return cached
+    roster = []
+    for i, role_id in enumerate(key, 1):
+        info = get_role_info(role_id)
+        roster.append({"id": i, "name": info["name"], "role": info["role_title"], "emoji": info["emoji"],
+                       "role_id": role_id})
+    lines, used = [], 0
+    budget = ANALYSIS_PROMPT_BUDGET["roster"]
+    for idx, a in enumerate(roster):
+        line = f"- Agent {a['id']}: {a['emoji']} {a['name']} — {a['role']}"
+        if used + estimate_tokens(line) > budget:
+            lines.append(f"- ... and {len(roster) - idx} more agents")
+            break
+        lines.append(line)
+        used += estimate_tokens(line)
+    snapshot = (roster, "\n".join(lines))
+    with _roster_cache_lock:
+        _roster_cache.clear()
+        _roster_cache[key] = snapshot
+    return snapshot
+
+
+def build_analysis_prompt(roster_text, message, orch_id, media_urls=(), selection="", doc_results=()):
+    """Assemble the orchestrator routing prompt within ANALYSIS_PROMPT_BUDGET.
+
+    Media URLs are kept newest-first, RAG snippets best-score-first, and each
+    section is cut when its budget runs out. Returns (prompt, sizes) where
+    sizes holds the estimated tokens per section and in total.
+    """
+    budget = ANALYSIS_PROMPT_BUDGET
+
+    context_hint = ""
+    if media_urls:
+        shown, used = [], 0
+        for u in reversed(list(media_urls)[-10:]):
+            if used + estimate_tokens(u) > budget["media"]:
+                break
+            shown.insert(0, u)
+            used += estimate_tokens(u)
+        media_list = "\n".join(f"  - {u}" for u in shown)
+        context_hint = (
+            f'\nMedia generated in this conversation ({len(media_urls)} total, showing last {len(shown)}):\n{media_list}\n'
+            f'Most recent: {media_urls[-1]}\n'
+            f'If the user refers to "this image/video", "convert this", "make this a video", etc., use the most recent relevant URL as input_image.\n'
+            f'For image-to-video: set task_type to "image-to-video" and include "input_image":"<URL>" in wiro_generate.\n'
+        )
+
+    selection_hint = ""
+    if selection:
+        selection_hint = (
+            f"\nThe user was previously shown model options. If they are selecting one "
+            f"(by number, name, or description), use wiro_generate with the selected model. "
+            f'Include "model":"owner/project" in wiro_generate to use that specific model.\n'
+            f"Previous options shown:\n{_truncate_to_tokens(selection, budget['selection'])}\n"
+        )
+
+    rag_context = ""
+    # Fused (RRF) scores are ranks, not similarities: the threshold only applies to dense scores
+    ranked = sorted((r for r in doc_results if r.get("fused") or r.get("score", 0) > RAG_MIN_SCORE),
+                    key=lambda r: r.get("score", 0), reverse=True)
+    snippets, used = [], 0
+    for r in ranked:
+        snippet = f"[{r['filename']}]: {r['content']}"
+        remaining = budget["rag"] - used
+        if estimate_tokens(snippet) > remaining:
+            if remaining < 50:
+                break
+            snippet = _truncate_to_tokens(snippet, remaining)
+        snippets.append(snippet)
+        used += estimate_tokens(snippet)
+    if snippets:
+        rag_context = "\nRelevant context from uploaded documents:\n" + "\n".join(snippets) + "\n"
+
+    user_message = _truncate_to_tokens(message, budget["message"], keep_tail=True)
+
+    analysis_prompt = (
+        f"SYSTEM: You are a task router. Respond with ONLY a raw JSON object. "
+        f"No markdown fences, no explanation, no text before or after.\n\n"
+        f"Available agents:\n{roster_text}\n\n"
+        f"You have the wiro-ai skill for AI content generation.\n"
+        f"When the user wants to generate/create/draw an image, video, or audio:\n"
+        f"- FIRST TIME: use wiro_suggest to show model options with costs\n"
+        f"- AFTER USER SELECTS: use wiro_generate with the chosen model\n"
+        f'For image-to-video, include "input_image":"URL" in wiro_generate.\n'
+        f"{context_hint}{selection_hint}{rag_context}\n"
+        f"User request: {user_message}\n\n"
+        f"You are Agent {orch_id} (OrchestratorKoala). Do NOT delegate to yourself.\n"
+        f"Only delegate when the task genuinely needs a specialist. "
+        f"For simple questions, answer directly.\n\n"
+        f"JSON format:\n"
+        f'{{"plan":"brief plan","delegations":[{{"agent_id":N,"task":"task"}}],"direct_answer":null}}\n'
+        f"Delegations run in parallel. If a task needs another delegation's result, add "
+        f'"depends_on":[agent_id, ...] to it.\n'
+        f"For simple/direct: "
+        f'{{"plan":"direct","delegations":[],"direct_answer":"your answer"}}\n'
+        f"To suggest models (first time): "
+        f'{{"plan":"suggest models","delegations":[],"direct_answer":null,"wiro_suggest":{{"prompt":"detailed prompt","task_type":"text-to-image"}}}}\n'
+        f"To generate with chosen model: "
+        f'{{"plan":"generate","delegations":[],"direct_answer":null,"wiro_generate":{{"prompt":"detailed prompt","task_type":"text-to-image","model":"owner/project"}}}}\n'
+        f"To generate without asking (user says 'just do it' or picks a model): "
+        f'{{"plan":"generate","delegations":[],"direct_answer":null,"wiro_generate":{{"prompt":"detailed prompt","task_type":"text-to-image"}}}}'
+    )
+
+    sizes = {
+        "roster": estimate_tokens(roster_text),
+        "media": estimate_tokens(context_hint),
+        "selection": estimate_tokens(selection_hint),
+        "rag": estimate_tokens(rag_context),
+        "message": estimate_tokens(user_message),
+        "total": estimate_tokens(analysis_prompt),
+    }
+    return analysis_prompt, sizes
+
+
 # ─── Agent Execution Helper ──────────────────────────────────────
-def _exec_agent_message(agent_id, message, timeout=120):
-    """Send a message to an agent via docker exec and return the cleaned response."""
-    result = subprocess.run(
+class _LimitedReader(io.RawIOBase):
+    """Read at most `length` bytes of a request body (file-like, for line iteration / gzip)."""
+
+    def __init__(self, raw, length):
+        self._raw = raw
+        self._remaining = length
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if self._remaining <= 0:
+            return 0
+        chunk = self._raw.read(min(len(b), self._remaining, 65536))
+        self._remaining -= len(chunk)
+        b[:len(chunk)] = chunk
+        return len(chunk)
+
+    def drain(self):
+        """Discard whatever the handler didn't read, so the connection stays sane."""
+        while self._remaining > 0:
+            chunk = self._raw.read(min(65536, self._remaining))
+            if not chunk:
+                break
+            self._remaining -= len(chunk)
+
+
+class ExecCancelled(RuntimeError):
+    """Raised when an agent exec is killed because its caller cancelled."""
+
+
+def _run_agent_exec(agent_id, message, timeout=120, cancel=None):
+    """Send a message to an agent via docker exec and return the cleaned response.
+
+    If cancel (a threading.Event) gets set while waiting, the exec is killed
+    and ExecCancelled is raised.
+    """
+    proc = subprocess.Popen(
         ["docker", "exec", f"koala-agent-{agent_id}",
          "node", "openclaw.mjs", "agent",
          "--agent", "main",
          "-m", message],
-        capture_output=True, text=True, timeout=timeout
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True
     )
-    stdout = result.stdout.strip()
+    deadline = time.monotonic() + timeout
+    while True:
+        remaining = deadline - time.monotonic()
+        try:
+            out, err = proc.communicate(timeout=max(0.0, min(remaining, 1.0) if cancel else remaining))
+            break
+        except subprocess.TimeoutExpired:
+            cancelled = cancel is not None and cancel.is_set()
+            if cancelled or time.monotonic() >= deadline:
+                proc.kill()
+                proc.communicate()
+                if cancelled:
+                    raise ExecCancelled("Cancelled")
+                raise subprocess.TimeoutExpired(proc.args, timeout)
+    stdout = out.strip()
     lines = [l for l in stdout.split("\n")
              if l.strip() and not l.startswith("🦞") and not l.startswith("Usage:")]
     response = "\n".join(lines).strip()
-    if not response and result.returncode != 0:
-        raise RuntimeError(result.stderr.strip() or "No response from agent")
+    if not response and proc.returncode != 0:
+        raise RuntimeError(err.strip() or "No response from agent")
     return response or stdout or "(empty response)"
 
 
+class _SingleFlight:
+    """Coalesce concurrent identical calls into one upstream call.
+
+    The first caller for a key runs fn; callers arriving while it runs wait
+    for and share its result (or exception). Successful results are kept for
+    reuse_seconds so immediate retries/double-clicks are answered from memory.
+    """
+
+    def __init__(self, reuse_seconds=0):
+        self.reuse_seconds = reuse_seconds
+        self._lock = threading.Lock()
+        self._inflight = {}
+        self._recent = {}
+        self._stats = {"calls": 0, "executed": 0, "coalesced": 0, "reused": 0}
+
+    def do(self, key, fn, timeout=None, cancel=None):
+        with self._lock:
+            self._stats["calls"] += 1
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                recent = self._recent.get(key)
+                if recent and recent[0] > now:
+                    self._stats["reused"] += 1
+                    return recent[1]
+                self._recent.pop(key, None)
+                call = self._inflight.get(key)
+                leader = call is None
+                if leader:
+                    call = {"done": threading.Event(), "result": None, "error": None}
+                    self._inflight[key] = call
+                    self._stats["executed"] += 1
+                else:
+                    self._stats["coalesced"] += 1
+
+            if leader:
+                try:
+                    call["result"] = fn()
+                except BaseException as e:
+                    call["error"] = e
+                finally:
+                    with self._lock:
+                        self._inflight.pop(key, None)
+                        if call["error"] is None and self.reuse_seconds > 0:
+                            self._recent[key] = (time.monotonic() + self.reuse_seconds, call["result"])
+                            if len(self._recent) > 256:
+                                now = time.monotonic()
+                                self._recent = {k: v for k, v in self._recent.items() if v[0] > now}
+                    call["done"].set()
+            else:
+                deadline = None if timeout is None else time.monotonic() + timeout
+                while not call["done"].wait(1.0):
+                    if cancel is not None and cancel.is_set():
+                        raise ExecCancelled("Cancelled")
+                    if deadline is not None and time.monotonic() >= deadline:
+                        raise subprocess.TimeoutExpired("coalesced agent call", timeout)
+
+            if isinstance(call["error"], ExecCancelled) and not leader and not (cancel and cancel.is_set()):
+                continue  # the leader gave up, not us: run it ourselves
+            if call["error"] is not None:
+                raise call["error"]
+            return call["result"]
+
+    def stats(self):
+        with self._lock:
+            return {**self._stats, "in_flight": len(self._inflight), "reuse_seconds": self.reuse_seconds}
+
+
+_agent_calls = _SingleFlight(COALESCE_REUSE_SECONDS)
+
+
+def _exec_agent_message(agent_id, message, timeout=120, cancel=None):
+    """Send a message to an agent, sharing the exec with identical in-flight calls."""
+    key = (str(agent_id), hashlib.sha256(message.encode("utf-8")).hexdigest())
+    return _agent_calls.do(key, lambda: _run_agent_exec(agent_id, message, timeout, cancel),
+                           timeout=timeout, cancel=cancel)
+
+
 def _parse_json_from_response(text):
     """Try to extract a JSON object from an LLM response (handles markdown fences)."""
     # Try direct parse
@@ -622,6 +1110,14 @@ class AdminAPIHandler(SimpleHTTPRequestHandler):
             self._proxy_to_agent("GET")
             return
 
+        if path.startswith("/api/blobs/"):
+            self._serve_blob(path[len("/api/blobs/"):])
+            return
+
+        if path == "/api/history/export":
+            self._history_export(urllib.parse.parse_qs(parsed.query))
+            return
+
         # API routes
         if path.startswith("/api/"):
             self._handle_api(path, parsed.query)
@@ -635,8 +1131,187 @@ class AdminAPIHandler(SimpleHTTPRequestHandler):
         if parsed.path.startswith("/agent/"):
             self._proxy_to_agent("HEAD")
             return
+        if parsed.path.startswith("/api/blobs/"):
+            self._serve_blob(parsed.path[len("/api/blobs/"):], head=True)
+            return
         super().do_HEAD()
 
+    def _export_agent_ids(self, params):
+        """Agent ids from ?agent=all|N|N,M (default all)."""
+        value = params.get("agent", ["all"])[0]
+        if value == "all":
+            return list(range(1, int(load_state().get("AGENT_COUNT", "0")) + 1))
+        return [int(a) for a in value.split(",") if a.strip().isdigit()]
+
+    def _history_export(self, params):
+        """GET /api/history/export — stream NDJSON history (?agent=, ?since=, ?until=, ?gzip=1, ?inline_images=1).
+
+        One line per entry: {"agent_id", "id", ...entry}. Constant memory: entries
+        are read from the stores one segment/batch at a time and written as they go.
+        If reading fails after the headers went out, the stream ends with a single
+        {"error": ...} line, so a truncated export can be told from a complete one.
+        """
+        agent_ids = self._export_agent_ids(params)
+        since = params.get("since", [""])[0]
+        until = params.get("until", [""])[0]
+        compress = params.get("gzip", ["0"])[0] in ("1", "true")
+        inline_images = params.get("inline_images", ["0"])[0] in ("1", "true")
+        stamp = time.strftime("%Y%m%d-%H%M%S", time.gmtime())
+        filename = f"koalaclaw-history-{stamp}.ndjson" + (".gz" if compress else "")
+
+        self.send_response(HTTPStatus.OK)
+        self.send_header("Content-Type", "application/gzip" if compress else "application/x-ndjson")
+        self.send_header("Content-Disposition", f'attachment; filename="{filename}"')
+        self.send_header("Cache-Control", "no-store")
+        self.send_header("Access-Control-Allow-Origin", "*")
+        self.end_headers()
+
+        out = gzip.GzipFile(fileobj=self.wfile, mode="wb", compresslevel=6) if compress else self.wfile
+        exported = 0
+        buf = []
+        try:
+            for agent_id in agent_ids:
+                for seq, entry in get_history_store(agent_id).iter_range(since, until):
+                    if inline_images and entry.get("image_blob"):
+                        data_url = _blobs.to_data_url(entry["image_blob"], entry.get("image_type", ""))
+                        if data_url:
+                            entry = {k: v for k, v in entry.items() if k not in ("image_blob", "image_type")}
+                            entry["image_base64"] = data_url
+                    buf.append(json.dumps({"agent_id": agent_id, "id": seq, **entry}, ensure_ascii=False))
+                    if len(buf) >= 500:
+                        out.write(("\n".join(buf) + "\n").encode("utf-8"))
+                        exported += len(buf)
+                        buf = []
+            if buf:
+                out.write(("\n".join(buf) + "\n").encode("utf-8"))
+                exported += len(buf)
+            if compress:
+                out.close()
+            self.wfile.flush()
+            print(f"[HISTORY] Exported {exported} entries for agents {agent_ids}", file=sys.stderr, flush=True)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        except Exception as e:
+            print(f"[HISTORY] Export failed after {exported} entries: {e}", file=sys.stderr, flush=True)
+            try:
+                buf.append(json.dumps({"error": f"export failed: {e}", "exported": exported + len(buf)}))
+                out.write(("\n".join(buf) + "\n").encode("utf-8"))
+                if compress:
+                    out.close()
+                self.wfile.flush()
+            except (OSError, ValueError):
+                pass
+
+    def _history_import(self, params):
+        """POST /api/history/import — append NDJSON history (gzip accepted), streamed from the request body.
+
+        Each line needs role/content/timestamp and an agent_id, unless ?agent=N
+        sends everything to one agent. Entries are appended after the existing
+        history in batches; vector indexing happens in the background.
+        """
+        length = int(self.headers.get("Content-Length", 0) or 0)
+        if length <= 0:
+            self._json_response({"error": "Content-Length required"}, HTTPStatus.LENGTH_REQUIRED)
+            return
+        target = params.get("agent", [""])[0]
+        target = int(target) if target.isdigit() else None
+        count = int(load_state().get("AGENT_COUNT", "0"))
+
+        raw_body = _LimitedReader(self.rfile, length)
+        body = io.BufferedReader(raw_body, 65536)
+        stream = gzip.GzipFile(fileobj=body, mode="rb") if body.peek(2)[:2] == b"\x1f\x8b" else body
+        imported, skipped, errors = {}, 0, []
+        pending = {}
+
+        def _flush(agent_id):
+            entries = pending.pop(agent_id, [])
+            if entries:
+                append_history_entries(agent_id, entries, bulk=True)
+                imported[agent_id] = imported.get(agent_id, 0) + len(entries)
+
+        try:
+            for line_no, raw in enumerate(stream, 1):
+                if not raw.strip():
+                    continue
+                try:
+                    item = json.loads(raw)
+                    agent_id = target if target is not None else int(item.get("agent_id"))
+                    if not 1 <= agent_id <= count or not isinstance(item.get("role"), str):
+                        raise ValueError("unknown agent or missing role")
+                except (ValueError, TypeError, AttributeError) as e:
+                    skipped += 1
+                    if len(errors) < 10:
+                        errors.append(f"line {line_no}: {e}")
+                    continue
+                entry = {k: v for k, v in item.items() if k not in ("agent_id", "id", "image_base64")}
+                entry.setdefault("content", "")
+                entry.setdefault("timestamp", time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()))
+                if item.get("image_base64"):
+                    _attach_image(agent_id, entry, item["image_base64"])
+                pending.setdefault(agent_id, []).append(entry)
+                if len(pending[agent_id]) >= 500:
+                    _flush(agent_id)
+        except (OSError, EOFError) as e:
+            errors.append(f"body: {e}")
+        finally:
+            for agent_id in list(pending):
+                _flush(agent_id)
+            raw_body.drain()
+
+        print(f"[HISTORY] Imported {sum(imported.values())} entries ({skipped} skipped)", file=sys.stderr, flush=True)
+        self._json_response({"imported": {str(k): v for k, v in imported.items()},
+                             "total": sum(imported.values()), "skipped": skipped, "errors": errors})
+
+    def _serve_blob(self, digest, head=False):
+        """GET /api/blobs/{sha256} — immutable attachment bytes (ETag, Range)."""
+        opened = _blobs.open(digest)
+        if not opened:
+            self._json_response({"error": "Blob not found"}, HTTPStatus.NOT_FOUND)
+            return
+        f, size, mime = opened
+        with f:
+            etag = f'"{digest.lower()}"'
+            if etag in [t.strip() for t in self.headers.get("If-None-Match", "").split(",")]:
+                self.send_response(HTTPStatus.NOT_MODIFIED)
+                self.send_header("ETag", etag)
+                self.end_headers()
+                return
+            start, end, status = 0, size - 1, HTTPStatus.OK
+            try:
+                byte_range = blob_store.parse_range(self.headers.get("Range", ""), size)
+            except ValueError:
+                self.send_response(HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE)
+                self.send_header("Content-Range", f"bytes */{size}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            if byte_range and self.headers.get("If-Range", etag) == etag:
+                start, end = byte_range
+                status = HTTPStatus.PARTIAL_CONTENT
+            self.send_response(status)
+            self.send_header("Content-Type", mime)
+            self.send_header("Content-Length", str(end - start + 1))
+            self.send_header("ETag", etag)
+            self.send_header("Cache-Control", "public, max-age=31536000, immutable")
+            self.send_header("Accept-Ranges", "bytes")
+            self.send_header("Access-Control-Allow-Origin", "*")
+            if status == HTTPStatus.PARTIAL_CONTENT:
+                self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+            self.end_headers()
+            if head:
+                return
+            f.seek(start)
+            remaining = end - start + 1
+            try:
+                while remaining > 0:
+                    chunk = f.read(min(65536, remaining))
+                    if not chunk:
+                        break
+                    self.wfile.write(chunk)
+                    remaining -= len(chunk)
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+
     def do_POST(self):
         parsed = urllib.parse.urlparse(self.path)
         path = parsed.path
@@ -646,6 +1321,11 @@ class AdminAPIHandler(SimpleHTTPRequestHandler):
             self._proxy_to_agent("POST")
             return
 
+        # Streamed: the body is read incrementally instead of up front
+        if path == "/api/history/import":
+            self._history_import(urllib.parse.parse_qs(parsed.query))
+            return
+
         if path.startswith("/api/"):
             content_length = int(self.headers.get("Content-Length", 0))
             body = self.rfile.read(content_length) if content_length > 0 else b""
@@ -751,7 +1431,11 @@ class AdminAPIHandler(SimpleHTTPRequestHandler):
     def _handle_api(self, path, query):
         """Route GET API requests."""
         try:
-            if path == "/api/status":
+            if path == "/api/health":
+                vector = vector_store.readiness() if vector_store else {"ready": True, "embedder": "not installed"}
+                body = {"status": "ok" if vector["ready"] else "warming", "ready": vector["ready"], "vector": vector}
+                self._json_response(body, HTTPStatus.OK if vector["ready"] else HTTPStatus.SERVICE_UNAVAILABLE)
+            elif path == "/api/status":
                 self._json_response(self._get_status())
             elif path == "/api/agents":
                 self._json_response(self._get_agents())
@@ -766,24 +1450,32 @@ class AdminAPIHandler(SimpleHTTPRequestHandler):
                 agent_id = int(path.split("/")[3])
                 q = ""
                 limit = 10
+                mode = ""
                 if query:
                     params = urllib.parse.parse_qs(query)
                     q = params.get("q", [""])[0]
                     limit = int(params.get("limit", [10])[0])
+                    mode = params.get("mode", [""])[0]
                 if not q:
                     self._json_response({"results": [], "error": "q parameter required"})
-                elif not vector_store or not vector_store.is_available():
-                    self._json_response({"results": [], "error": "Vector store not available"})
+                elif mode == "keyword" or not vector_store or not vector_store.is_available():
+                    # Keyword search runs on the history store itself (FTS5 with the sqlite backend)
+                    results = get_history_store(agent_id).search(q, limit)
+                    self._json_response({"results": results, "mode": "keyword"})
                 else:
                     results = vector_store.search_chat(agent_id, q, limit)
-                    self._json_response({"results": results})
-            elif path.startswith("/api/agents/") and path.endswith("/history"):
+                    self._json_response({"results": results, "mode": "semantic"})
+            elif path.startswith("/api/agents/") and path.endswith("/media"):
                 agent_id = int(path.split("/")[3])
-                limit = 100
+                kind = ""
+                limit = 0
                 if query:
                     params = urllib.parse.parse_qs(query)
-                    limit = int(params.get("limit", [100])[0])
-                self._json_response({"history": read_chat_history(agent_id, limit)})
+                    kind = params.get("kind", [""])[0]
+                    limit = int(params.get("limit", [0])[0])
+                self._json_response({"media": get_media_index(agent_id).items(kind, limit)})
+            elif path.startswith("/api/agents/") and path.endswith("/history"):
+                self._history(int(path.split("/")[3]), urllib.parse.parse_qs(query or ""))
             elif path.startswith("/api/agents/") and "/documents" in path and "/search" not in path:
                 agent_id = int(path.split("/")[3])
                 docs_dir = os.path.join(DATA_DIR, f"koala-agent-{agent_id}", "docs")
@@ -818,6 +1510,14 @@ class AdminAPIHandler(SimpleHTTPRequestHandler):
                 self._json_response(load_integrations())
             elif path == "/api/system/info":
                 self._json_response(get_system_info())
+            elif path == "/api/system/metrics":
+                metrics = {"coalescing": _agent_calls.stats(), "history_cache": _history_cache.stats()}
+                if vector_store:
+                    metrics["vector_indexing"] = vector_store.indexing_stats()
+                    metrics["embedding_cache"] = vector_store.embedding_cache_stats()
+                    metrics["query_cache"] = vector_store.query_cache_stats()
+                    metrics["vector_connection"] = vector_store.connection_stats()
+                self._json_response(metrics)
             elif path == "/api/agents/roster":
                 self._json_response(self._get_roster())
             elif path == "/api/roles":
@@ -890,7 +1590,8 @@ class AdminAPIHandler(SimpleHTTPRequestHandler):
                 self._orchestrate_stream(data)
                 return
             elif path == "/api/agents/broadcast":
-                self._json_response(self._broadcast(data))
+                self._broadcast(data)
+                return
             elif path == "/api/wiro/generate":
                 self._json_response(self._wiro_generate(data))
             elif path == "/api/wiro/smart-generate":
@@ -1013,7 +1714,7 @@ class AdminAPIHandler(SimpleHTTPRequestHandler):
     def _handle_document_upload(self, path, data):
         """POST /api/agents/{id}/documents — upload a document for RAG."""
         agent_id = int(path.split("/")[3])
-        content = data.get("content", "")
+        content = data.pop("content", "")
         filename = data.get("filename", "document.txt")
 
         if not content:
@@ -1030,11 +1731,16 @@ class AdminAPIHandler(SimpleHTTPRequestHandler):
             self._json_response({"error": f"Failed to save: {e}"})
             return
 
-        chunks_added = 0
+        size = len(content)
+        del content  # index from the saved file, streamed line by line
+
+        indexed = {"chunks": 0}
         if vector_store and vector_store.is_available():
-            chunks_added = vector_store.add_document(agent_id, filename, content)
+            with open(filepath, "r", encoding="utf-8") as f:
+                indexed = vector_store.index_document(agent_id, filename, f)
 
-        self._json_response({"success": True, "filename": filename, "chunks": chunks_added, "size": len(content)})
+        self._json_response({"success": True, "filename": filename, "chunks": indexed["chunks"],
+                             "size": size, "indexing": indexed})
 
     def _handle_document_delete(self, path):
         """DELETE /api/agents/{id}/documents/{filename}"""
@@ -1246,56 +1952,18 @@ class AdminAPIHandler(SimpleHTTPRequestHandler):
         count = int(state.get("AGENT_COUNT", "0"))
         orch_id = get_orchestrator_agent_id(state)
 
-        agents_roster = []
-        for i in range(1, count + 1):
-            info = get_role_info(state.get(f"ROLE_{i}", ""))
-            agents_roster.append({"id": i, "name": info["name"], "role": info["role_title"], "emoji": info["emoji"]})
-
-        roster_text = "\n".join(
-            f"- Agent {a['id']}: {a['emoji']} {a['name']} — {a['role']}"
-            for a in agents_roster
-        )
+        agents_roster, roster_text = get_roster_snapshot(state)
 
-        # Find ALL media URLs from chat history for context
-        import re as _re
+        # All media URLs from this conversation, for context (maintained at append time)
         all_media_urls = []
         recent_media_url = ""
         try:
-            history = read_chat_history(orch_id, limit=200)
-            for entry in history:
-                content = entry.get("content", "")
-                # Match Wiro CDN URLs and common media extensions
-                urls = _re.findall(r'(https?://cdn[^\s<>"]+|https?://[^\s<>"]+\.(?:png|jpe?g|webp|gif|mp4|webm|mp3|wav|ogg))\b', content)
-                for u in urls:
-                    if u not in all_media_urls:
-                        all_media_urls.append(u)
+            all_media_urls = [item["url"] for item in get_media_index(orch_id).items()]
             if all_media_urls:
                 recent_media_url = all_media_urls[-1]
         except Exception:
             pass
 
-        context_hint = ""
-        if all_media_urls:
-            media_list = "\n".join(f"  - {u}" for u in all_media_urls[-10:])
-            context_hint = (
-                f'\nMedia generated in this conversation ({len(all_media_urls)} total, showing last {min(10, len(all_media_urls))}):\n{media_list}\n'
-                f'Most recent: {recent_media_url}\n'
-                f'If the user refers to "this image/video", "convert this", "make this a video", etc., use the most recent relevant URL as input_image.\n'
-                f'For image-to-video: set task_type to "image-to-video" and include "input_image":"<URL>" in wiro_generate.\n'
-            )
-
-        # RAG: search uploaded documents for relevant context
-        rag_context = ""
-        if vector_store and vector_store.is_available():
-            try:
-                doc_results = vector_store.search_docs(orch_id, message, limit=5)
-                if doc_results:
-                    snippets = [f"[{r['filename']}]: {r['content']}" for r in doc_results if r.get("score", 0) > 0.3]
-                    if snippets:
-                        rag_context = "\nRelevant context from uploaded documents:\n" + "\n".join(snippets) + "\n"
-            except Exception:
-                pass
-
         # Direct model selection: if user typed a number (1, 2, 3), pick from previous suggestions
         stripped_msg = message.strip()
         if stripped_msg in ("1", "2", "3"):
@@ -1368,64 +2036,55 @@ class AdminAPIHandler(SimpleHTTPRequestHandler):
         except Exception:
             pass
 
-        selection_hint = ""
-        if model_selection:
-            selection_hint = (
-                f"\nThe user was previously shown model options. If they are selecting one "
-                f"(by number, name, or description), use wiro_generate with the selected model. "
-                f'Include "model":"owner/project" in wiro_generate to use that specific model.\n'
-                f"Previous options shown:\n{model_selection[:500]}\n"
-            )
+        # Fast path: confident local embedding match skips the analysis round trip.
+        # Not used while the user may be picking from previously suggested models,
+        # nor for follow-ups about earlier media (the LLM sees all_media_urls).
+        plan = None
+        if intent_router and not model_selection:
+            plan = intent_router.route(message, [a for a in agents_roster if a["id"] != orch_id],
+                                       has_media=bool(all_media_urls))
+        if plan:
+            raw_plan = json.dumps(plan)
+            self._sse_send("phase", {"phase": "routed", "message": "Routed locally..."})
+            print(f"[ORCH] Fast route: {plan['fast_route']}", file=sys.stderr, flush=True)
+        else:
+            self._sse_send("phase", {"phase": "analyzing", "message": "Analyzing task..."})
+            print(f"[ORCH] Analyzing task via Agent {orch_id}...", file=sys.stderr, flush=True)
 
-        analysis_prompt = (
-            f"SYSTEM: You are a task router. Respond with ONLY a raw JSON object. "
-            f"No markdown fences, no explanation, no text before or after.\n\n"
-            f"Available agents:\n{roster_text}\n\n"
-            f"You have the wiro-ai skill for AI content generation.\n"
-            f"When the user wants to generate/create/draw an image, video, or audio:\n"
-            f"- FIRST TIME: use wiro_suggest to show model options with costs\n"
-            f"- AFTER USER SELECTS: use wiro_generate with the chosen model\n"
-            f'For image-to-video, include "input_image":"URL" in wiro_generate.\n'
-            f"{context_hint}{selection_hint}{rag_context}\n"
-            f"User request: {message}\n\n"
-            f"You are Agent {orch_id} (OrchestratorKoala). Do NOT delegate to yourself.\n"
-            f"Only delegate when the task genuinely needs a specialist. "
-            f"For simple questions, answer directly.\n\n"
-            f"JSON format:\n"
-            f'{{"plan":"brief plan","delegations":[{{"agent_id":N,"task":"task"}}],"direct_answer":null}}\n'
-            f"For simple/direct: "
-            f'{{"plan":"direct","delegations":[],"direct_answer":"your answer"}}\n'
-            f"To suggest models (first time): "
-            f'{{"plan":"suggest models","delegations":[],"direct_answer":null,"wiro_suggest":{{"prompt":"detailed prompt","task_type":"text-to-image"}}}}\n'
-            f"To generate with chosen model: "
-            f'{{"plan":"generate","delegations":[],"direct_answer":null,"wiro_generate":{{"prompt":"detailed prompt","task_type":"text-to-image","model":"owner/project"}}}}\n'
-            f"To generate without asking (user says 'just do it' or picks a model): "
-            f'{{"plan":"generate","delegations":[],"direct_answer":null,"wiro_generate":{{"prompt":"detailed prompt","task_type":"text-to-image"}}}}'
-        )
+            # RAG: search uploaded documents for relevant context
+            doc_results = []
+            if vector_store and vector_store.is_available():
+                try:
+                    doc_results = vector_store.search_docs(orch_id, message, limit=RAG_LIMIT)
+                except Exception:
+                    pass
 
-        self._sse_send("phase", {"phase": "analyzing", "message": "Analyzing task..."})
-        print(f"[ORCH] Analyzing task via Agent {orch_id}...", file=sys.stderr, flush=True)
+            analysis_prompt, sizes = build_analysis_prompt(
+                roster_text, message, orch_id,
+                media_urls=all_media_urls, selection=model_selection, doc_results=doc_results,
+            )
+            print(f"[ORCH] Analysis prompt ~{sizes['total']} tokens {sizes}", file=sys.stderr, flush=True)
 
-        try:
-            raw_plan = _exec_agent_message(orch_id, analysis_prompt, timeout=60)
-            print(f"[ORCH] Raw plan: {raw_plan[:300]}", file=sys.stderr, flush=True)
-        except Exception as e:
-            print(f"[ORCH] Analysis failed: {e}", file=sys.stderr, flush=True)
-            self._sse_send("phase", {"phase": "fallback", "message": "Answering directly..."})
             try:
-                fallback = _exec_agent_message(orch_id, message, timeout=60)
-            except Exception:
-                self._sse_send("error", {"error": f"Orchestrator failed: {e}"})
+                raw_plan = _exec_agent_message(orch_id, analysis_prompt, timeout=60)
+                print(f"[ORCH] Raw plan: {raw_plan[:300]}", file=sys.stderr, flush=True)
+            except Exception as e:
+                print(f"[ORCH] Analysis failed: {e}", file=sys.stderr, flush=True)
+                self._sse_send("phase", {"phase": "fallback", "message": "Answering directly..."})
+                try:
+                    fallback = _exec_agent_message(orch_id, message, timeout=60)
+                except Exception:
+                    self._sse_send("error", {"error": f"Orchestrator failed: {e}"})
+                    self._sse_end()
+                    return
+                append_chat_history(orch_id, "user", message)
+                append_chat_history(orch_id, "assistant", fallback)
+                self._sse_send("done", {"response": fallback, "chain": [], "plan": "direct (fallback)"})
                 self._sse_end()
                 return
-            append_chat_history(orch_id, "user", message)
-            append_chat_history(orch_id, "assistant", fallback)
-            self._sse_send("done", {"response": fallback, "chain": [], "plan": "direct (fallback)"})
-            self._sse_end()
-            return
 
-        plan = _parse_json_from_response(raw_plan)
-        print(f"[ORCH] Parsed plan: {plan}", file=sys.stderr, flush=True)
+            plan = _parse_json_from_response(raw_plan)
+            print(f"[ORCH] Parsed plan: {plan}", file=sys.stderr, flush=True)
 
         if not plan:
             self._sse_send("phase", {"phase": "direct", "message": "Answering directly..."})
@@ -1575,40 +2234,32 @@ class AdminAPIHandler(SimpleHTTPRequestHandler):
             ],
         })
 
-        chain = []
+        jobs = []
         for deleg in delegations:
-            target_id = int(deleg.get("agent_id", 0))
+            try:
+                target_id = int(deleg.get("agent_id", 0))
+            except (TypeError, ValueError):
+                continue
             task_text = deleg.get("task", "")
             if target_id < 1 or target_id > count or target_id == orch_id or not task_text:
                 continue
-
-            target_info = get_role_info(state.get(f"ROLE_{target_id}", ""))
-            self._sse_send("delegating", {
-                "agent_id": target_id, "agent_name": target_info["name"],
-                "agent_emoji": target_info["emoji"], "role": target_info["role_title"],
-                "task": task_text,
+            deps = deleg.get("depends_on") or []
+            jobs.append({
+                "index": len(jobs), "agent_id": target_id, "task": task_text,
+                "info": get_role_info(state.get(f"ROLE_{target_id}", "")),
+                "depends_on": deps if isinstance(deps, list) else [deps],
             })
-            print(f"[ORCH] Delegating to Agent {target_id} ({target_info['name']}): {task_text[:80]}...", file=sys.stderr, flush=True)
-
-            try:
-                resp = _exec_agent_message(target_id, task_text, timeout=120)
-            except Exception as e:
-                resp = f"(Agent {target_id} error: {e})"
-
-            step = {
-                "agent_id": target_id, "agent_name": target_info["name"],
-                "agent_emoji": target_info["emoji"], "role": target_info["role_title"],
-                "task": task_text, "response": resp,
-            }
-            chain.append(step)
-            self._sse_send("agent_done", step)
 
-            append_chat_history(target_id, "delegation", json.dumps({
-                "direction": "in", "from_agent": orch_id, "from_name": "OrchestratorKoala",
-                "task": task_text, "response": resp[:500],
-            }))
+        try:
+            chain = self._run_delegations(jobs, orch_id)
+        except (BrokenPipeError, ConnectionResetError):
+            print("[ORCH] Client disconnected, delegations cancelled", file=sys.stderr, flush=True)
+            return
 
-        if chain:
+        if len(chain) == 1 and plan.get("fast_route"):
+            # Single locally-routed specialist: its answer is the final answer
+            final = chain[0]["response"]
+        elif chain:
             self._sse_send("phase", {"phase": "combining", "message": "Combining results..."})
             summary_parts = "\n\n".join(
                 f"### {c['agent_name']} ({c['role']})\n{c['response']}" for c in chain
@@ -1633,6 +2284,148 @@ class AdminAPIHandler(SimpleHTTPRequestHandler):
         self._sse_send("done", {"response": final, "chain": chain, "plan": plan.get("plan", "")})
         self._sse_end()
 
+    def _run_delegations(self, jobs, orch_id):
+        """Run delegation jobs concurrently, honouring depends_on edges.
+
+        Jobs start once every delegation they depend on (by agent_id) has
+        finished; at most ORCH_PARALLELISM run at once. agent_done events are
+        sent in completion order; the returned chain is in plan order. If the
+        client goes away, running execs are killed, pending jobs are dropped
+        and the write error is re-raised.
+        """
+        import sys
+
+        by_agent = {}
+        for job in jobs:
+            by_agent.setdefault(job["agent_id"], []).append(job["index"])
+        for job in jobs:
+            deps = set()
+            for aid in job["depends_on"]:
+                try:
+                    deps.update(by_agent.get(int(aid), []))
+                except (TypeError, ValueError):
+                    continue
+            deps.discard(job["index"])
+            job["deps"] = deps
+
+        cancel = threading.Event()
+        results = {}
+        pending = list(jobs)
+        running = {}
+        pool = ThreadPoolExecutor(max_workers=max(1, ORCH_PARALLELISM))
+        try:
+            while pending or running:
+                ready = [j for j in pending if j["deps"] <= results.keys()]
+                if not ready and not running:
+                    # Dependency cycle or failed upstream: run what's left without waiting
+                    print(f"[ORCH] Unresolvable depends_on, running {len(pending)} job(s) anyway", file=sys.stderr, flush=True)
+                    ready = list(pending)
+                for job in ready:
+                    if len(running) >= ORCH_PARALLELISM:
+                        break
+                    pending.remove(job)
+                    task_text = job["task"]
+                    upstream = [results[d] for d in sorted(job["deps"]) if d in results]
+                    if upstream:
+                        task_text += "\n\n" + "\n\n".join(
+                            f"Context from {u['agent_name']}:\n{u['response'][:2000]}" for u in upstream
+                        )
+                    info = job["info"]
+                    self._sse_send("delegating", {
+                        "agent_id": job["agent_id"], "agent_name": info["name"],
+                        "agent_emoji": info["emoji"], "role": info["role_title"],
+                        "task": job["task"],
+                    })
+                    print(f"[ORCH] Delegating to Agent {job['agent_id']} ({info['name']}): {job['task'][:80]}...", file=sys.stderr, flush=True)
+                    future = pool.submit(_exec_agent_message, job["agent_id"], task_text,
+                                         ORCH_DELEGATION_TIMEOUT, cancel)
+                    running[future] = job
+
+                done, _ = wait(list(running), timeout=SSE_KEEPALIVE_INTERVAL, return_when=FIRST_COMPLETED)
+                if not done:
+                    self._sse_ping()
+                    continue
+                for future in done:
+                    job = running.pop(future)
+                    info = job["info"]
+                    try:
+                        resp = future.result()
+                    except subprocess.TimeoutExpired:
+                        resp = f"(Agent {job['agent_id']} error: timed out after {ORCH_DELEGATION_TIMEOUT}s)"
+                    except Exception as e:
+                        resp = f"(Agent {job['agent_id']} error: {e})"
+                    step = {
+                        "agent_id": job["agent_id"], "agent_name": info["name"],
+                        "agent_emoji": info["emoji"], "role": info["role_title"],
+                        "task": job["task"], "response": resp,
+                    }
+                    results[job["index"]] = step
+                    append_chat_history(job["agent_id"], "delegation", json.dumps({
+                        "direction": "in", "from_agent": orch_id, "from_name": "OrchestratorKoala",
+                        "task": job["task"], "response": resp[:500],
+                    }))
+                    self._sse_send("agent_done", step)
+        except (BrokenPipeError, ConnectionResetError):
+            cancel.set()
+            raise
+        finally:
+            pool.shutdown(wait=False, cancel_futures=True)
+        return [results[j["index"]] for j in jobs if j["index"] in results]
+
+    def _history(self, agent_id, params):
+        """GET /api/agents/{id}/history — last N, before/after cursors, long-poll or SSE.
+
+        Every entry carries a stable "id". ?after=ID&wait=S blocks up to S seconds
+        until something newer is appended; ?stream=1 (or Accept: text/event-stream)
+        sends each new entry as an SSE "entry" event (from ?after=ID, else from now).
+        """
+        def _int(name):
+            value = params.get(name, [""])[0]
+            return int(value) if value.lstrip("-").isdigit() else None
+
+        limit = _int("limit")
+        limit = 100 if limit is None else limit
+        before, after = _int("before"), _int("after")
+        stream = params.get("stream", ["0"])[0] in ("1", "true") or "text/event-stream" in self.headers.get("Accept", "")
+        if stream:
+            if after is None:
+                # No cursor: only entries appended from now on
+                latest = read_chat_page(agent_id, limit=1)
+                after = latest[-1][0] if latest else -1
+            self._history_stream(agent_id, after)
+            return
+
+        wait_s = min(float(params.get("wait", ["0"])[0] or 0), HISTORY_LONGPOLL_MAX)
+        version = _history_notifier.version(agent_id)
+        page = read_chat_page(agent_id, before=before, after=after, limit=limit)
+        deadline = time.time() + wait_s
+        while after is not None and not page and time.time() < deadline:
+            version = _history_notifier.wait(agent_id, version, deadline - time.time())
+            page = read_chat_page(agent_id, after=after, limit=limit)
+
+        history = [{**entry, "id": seq} for seq, entry in page]
+        result = {"history": history}
+        if history:
+            result["first_id"] = history[0]["id"]
+            result["last_id"] = history[-1]["id"]
+        self._json_response(result)
+
+    def _history_stream(self, agent_id, after):
+        """SSE: push entries appended after `after` until the client disconnects."""
+        self._sse_start()
+        try:
+            while True:
+                version = _history_notifier.version(agent_id)
+                page = read_chat_page(agent_id, after=after, limit=HISTORY_RING_SIZE)
+                for seq, entry in page:
+                    self._sse_send("entry", {**entry, "id": seq})
+                    after = seq
+                if len(page) < HISTORY_RING_SIZE:
+                    if _history_notifier.wait(agent_id, version, SSE_KEEPALIVE_INTERVAL) == version:
+                        self._sse_ping()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
     def _sse_start(self):
         """Begin an SSE response."""
         self.send_response(200)
@@ -1648,6 +2441,11 @@ class AdminAPIHandler(SimpleHTTPRequestHandler):
         self.wfile.write(f"event: {event}\ndata: {payload}\n\n".encode("utf-8"))
         self.wfile.flush()
 
+    def _sse_ping(self):
+        """Send an SSE comment line (keeps proxies open, surfaces client disconnects)."""
+        self.wfile.write(b": keepalive\n\n")
+        self.wfile.flush()
+
     def _sse_end(self):
         """End SSE stream."""
         self.wfile.write(b"event: close\ndata: {}\n\n")
@@ -1673,35 +2471,109 @@ class AdminAPIHandler(SimpleHTTPRequestHandler):
         return {"roster": roster, "orchestrator_id": get_orchestrator_agent_id(state)}
 
     def _broadcast(self, data):
-        """POST /api/agents/broadcast — send message to multiple agents, collect responses."""
+        """POST /api/agents/broadcast — send message to multiple agents concurrently.
+
+        With "stream": true (or Accept: text/event-stream) responds with SSE:
+        an agent_done event per agent as soon as it answers, then done with
+        all results and per-agent latency. Otherwise returns the same
+        aggregate as JSON once every agent has answered.
+        """
+        import sys
+
         message = (data.get("message") or "").strip()
         agent_ids = data.get("agent_ids") or []
+        stream = bool(data.get("stream")) or "text/event-stream" in (self.headers.get("Accept") or "")
         if not message:
-            return {"error": "message required"}
+            if stream:
+                self._sse_start()
+                self._sse_send("error", {"error": "message required"})
+                self._sse_end()
+            else:
+                self._json_response({"error": "message required"})
+            return
 
         state = load_state()
         count = int(state.get("AGENT_COUNT", "0"))
         if not agent_ids:
             agent_ids = list(range(1, count + 1))
-
-        results = []
-        for aid in agent_ids:
-            aid = int(aid)
-            if aid < 1 or aid > count:
+        if not isinstance(agent_ids, list):
+            agent_ids = [agent_ids]
+        targets, invalid = [], []
+        for raw in agent_ids:
+            try:
+                aid = int(raw)
+            except (TypeError, ValueError):
+                invalid.append(raw)
                 continue
-            info = get_role_info(state.get(f"ROLE_{aid}", ""))
+            if 1 <= aid <= count and aid not in targets:
+                targets.append(aid)
+        try:
+            parallelism = int(data.get("parallelism") or BROADCAST_PARALLELISM)
+        except (TypeError, ValueError):
+            parallelism = BROADCAST_PARALLELISM
+        parallelism = max(1, min(parallelism, BROADCAST_PARALLELISM))
+
+        def _ask(aid):
+            started = time.monotonic()
             try:
-                resp = _exec_agent_message(aid, message, timeout=90)
+                resp, ok = _exec_agent_message(aid, message, timeout=BROADCAST_TIMEOUT, cancel=cancel), True
+            except subprocess.TimeoutExpired:
+                resp, ok = f"(error: timed out after {BROADCAST_TIMEOUT}s)", False
             except Exception as e:
-                resp = f"(error: {e})"
-            results.append({
-                "agent_id": aid,
-                "agent_name": info["name"],
-                "agent_emoji": info["emoji"],
-                "role": info["role_title"],
-                "response": resp,
-            })
-        return {"success": True, "results": results}
+                resp, ok = f"(error: {e})", False
+            return resp, ok, int((time.monotonic() - started) * 1000)
+
+        if stream:
+            self._sse_start()
+        cancel = threading.Event()
+        started = time.monotonic()
+        results = {}
+        pool = ThreadPoolExecutor(max_workers=parallelism)
+        try:
+            running = {pool.submit(_ask, aid): aid for aid in targets}
+            while running:
+                done, _ = wait(list(running), timeout=SSE_KEEPALIVE_INTERVAL, return_when=FIRST_COMPLETED)
+                if not done:
+                    if stream:
+                        self._sse_ping()
+                    continue
+                for future in done:
+                    aid = running.pop(future)
+                    resp, ok, latency_ms = future.result()
+                    info = get_role_info(state.get(f"ROLE_{aid}", ""))
+                    results[aid] = {
+                        "agent_id": aid,
+                        "agent_name": info["name"],
+                        "agent_emoji": info["emoji"],
+                        "role": info["role_title"],
+                        "response": resp,
+                        "ok": ok,
+                        "latency_ms": latency_ms,
+                    }
+                    if stream:
+                        self._sse_send("agent_done", results[aid])
+        except (BrokenPipeError, ConnectionResetError):
+            cancel.set()
+            print("[BROADCAST] Client disconnected, broadcast cancelled", file=sys.stderr, flush=True)
+            return
+        finally:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+        ordered = [results[aid] for aid in targets if aid in results]
+        aggregate = {
+            "success": True,
+            "results": ordered,
+            "latency_ms": {str(r["agent_id"]): r["latency_ms"] for r in ordered},
+            "failed": [r["agent_id"] for r in ordered if not r["ok"]],
+            "invalid_agent_ids": invalid,
+            "total_ms": int((time.monotonic() - started) * 1000),
+            "parallelism": parallelism,
+        }
+        if stream:
+            self._sse_send("done", aggregate)
+            self._sse_end()
+        else:
+            self._json_response(aggregate)
 
     def _post_settings(self, data):
         """POST /api/settings — update settings (Wiro key/secret, channel tokens)."""
@@ -1890,11 +2762,22 @@ def run_server():
     print(f"🦞 KoalaClaw Admin API running on http://0.0.0.0:{API_PORT}")
     print(f"   UI:  http://0.0.0.0:{API_PORT}/")
     print(f"   API: http://0.0.0.0:{API_PORT}/api/status")
+    if vector_store:
+        vector_store.start_warmup()
+
+    def _handle_sigterm(signum, frame):
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGTERM, _handle_sigterm)
     try:
         server.serve_forever()
     except KeyboardInterrupt:
         print("\nShutting down...")
         server.shutdown()
+    finally:
+        if vector_store and not vector_store.flush_indexing(timeout=10):
+            print("[VECTOR] Shutdown with chat messages still unindexed", file=sys.stderr, flush=True)
+        history_store.close_all()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""
+Content-addressed blob storage for KoalaClaw chat attachments.
+
+Blobs live in data/blobs/ab/abcdef… named by the SHA-256 of their bytes, so
+the same image uploaded twice is stored once and a blob never changes. History
+entries keep only the hash (image_blob) and MIME type (image_type).
+"""
+
+import base64
+import binascii
+import hashlib
+import os
+import re
+import sys
+from typing import Optional, Tuple
+
+HASH_RE = re.compile(r"^[0-9a-f]{64}$")
+DATA_URL_RE = re.compile(r"^data:([\w.+-]+/[\w.+-]+)?(;[^,]*)?,", re.IGNORECASE)
+
+# Magic bytes → MIME type, for serving blobs without a sidecar file
+_SIGNATURES = [
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+    (b"%PDF-", "application/pdf"),
+]
+
+
+def sniff_type(head: bytes) -> str:
+    for magic, mime in _SIGNATURES:
+        if head.startswith(magic):
+            return mime
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    return "application/octet-stream"
+
+
+def decode_data_url(value: str) -> Tuple[bytes, str]:
+    """Decode a data: URL (or bare base64) into (bytes, mime). Raises ValueError."""
+    mime = ""
+    match = DATA_URL_RE.match(value)
+    if match:
+        if not (match.group(2) or "").lower().endswith(";base64"):
+            raise ValueError("only base64 data URLs are supported")
+        mime = (match.group(1) or "").lower()
+        value = value[match.end():]
+    try:
+        data = base64.b64decode(value, validate=False)
+    except (binascii.Error, ValueError) as e:
+        raise ValueError(f"invalid base64: {e}")
+    if not data:
+        raise ValueError("empty attachment")
+    return data, mime or sniff_type(data[:16])
+
+
+class BlobStore:
+    def __init__(self, root: str):
+        self.root = root
+
+    def path(self, digest: str) -> Optional[str]:
+        """Filesystem path of a blob, or None if the hash is malformed."""
+        digest = digest.lower()
+        if not HASH_RE.match(digest):
+            return None
+        return os.path.join(self.root, digest[:2], digest)
+
+    def put(self, data: bytes) -> str:
+        """Store bytes (no-op if already present) and return their hash."""
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.path(digest)
+        if os.path.exists(path):
+            return digest
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.{id(data)}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+        return digest
+
+    def put_data_url(self, value: str) -> Tuple[str, str, int]:
+        """Store a data: URL attachment. Returns (hash, mime, size)."""
+        data, mime = decode_data_url(value)
+        return self.put(data), mime, len(data)
+
+    def open(self, digest: str):
+        """Return (file, size, mime) for a stored blob, or None."""
+        path = self.path(digest)
+        if not path or not os.path.isfile(path):
+            return None
+        f = open(path, "rb")
+        try:
+            size = os.fstat(f.fileno()).st_size
+            mime = sniff_type(f.read(16))
+            f.seek(0)
+        except Exception:
+            f.close()
+            raise
+        return f, size, mime
+
+    def to_data_url(self, digest: str, mime: str = "") -> Optional[str]:
+        opened = self.open(digest)
+        if not opened:
+            return None
+        f, _, sniffed = opened
+        with f:
+            data = f.read()
+        return f"data:{mime or sniffed};base64," + base64.b64encode(data).decode("ascii")
+
+
+def parse_range(header: str, size: int) -> Optional[Tuple[int, int]]:
+    """Parse a single 'bytes=a-b' range into inclusive (start, end).
+
+    Returns None for a missing/multi-range/unsupported header (serve the whole
+    blob) and raises ValueError for an unsatisfiable one.
+    """
+    if not header or not header.startswith("bytes=") or "," in header:
+        return None
+    first, _, last = header[6:].strip().partition("-")
+    try:
+        start = int(first) if first else None
+        end = int(last) if last else None
+    except ValueError:
+        print(f"[BLOBS] Ignoring malformed Range header: {header}", file=sys.stderr, flush=True)
+        return None
+    if start is None:
+        # Suffix range: the last `end` bytes
+        if not end:
+            raise ValueError("range not satisfiable")
+        return max(0, size - end), size - 1
+    if end is None:
+        end = size - 1
+    if start >= size or end < start:
+        raise ValueError("range not satisfiable")
+    return start, min(end, size - 1)
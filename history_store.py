@@ -0,0 +1,976 @@
+#!/usr/bin/env python3
+"""
+Chat history storage for KoalaClaw.
+
+Each agent's history lives in data/koala-agent-{id}/history/:
+  seg-000007.jsonl          — active segment (appended to, kept open)
+  seg-000006.jsonl.zst|.gz  — closed segments, compressed in the background
+  index.json                — segment list + sparse timestamp → offset index
+
+A segment is closed when it grows past SEGMENT_MAX_BYTES or when the UTC day
+changes. "Last N" and time-range reads only open the segments they need.
+A legacy chat-history.jsonl is migrated on first access and kept as
+chat-history.jsonl.migrated.
+
+With KOALACLAW_HISTORY_BACKEND=sqlite, history goes to a WAL-mode SQLite
+database instead (data/koala-agent-{id}/history.db, or one data/history.db
+for the whole install with KOALACLAW_HISTORY_SQLITE_SCOPE=install), indexed
+by role and timestamp with an FTS5 table for keyword search. Existing
+segmented/legacy history is imported on first access.
+
+Concurrent appends to one agent are group-committed: one write + flush per
+batch, fsync'd as well with KOALACLAW_HISTORY_FSYNC=1.
+
+Every entry has a position (seq) that never changes: segment first_seq + line
+number within the segment.
+
+Media URLs found in messages are also recorded in media-index.jsonl next to the
+history, so "what media does this conversation have" never rescans it.
+"""
+
+import gzip
+import io
+import json
+import os
+import queue
+import re
+import sqlite3
+import sys
+import threading
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+SEGMENT_MAX_BYTES = int(os.environ.get("KOALACLAW_HISTORY_SEGMENT_MB", "8")) * 1024 * 1024
+ROTATE_DAILY = os.environ.get("KOALACLAW_HISTORY_ROTATE_DAILY", "1") != "0"
+SPARSE_INDEX_EVERY = 128
+CODEC = "zst" if zstandard else "gz"
+
+# fsync every group commit (history survives power loss, at some append latency)
+HISTORY_FSYNC = os.environ.get("KOALACLAW_HISTORY_FSYNC", "0") == "1"
+
+HISTORY_BACKEND = os.environ.get("KOALACLAW_HISTORY_BACKEND", "segments")
+SQLITE_SCOPE = os.environ.get("KOALACLAW_HISTORY_SQLITE_SCOPE", "agent")
+
+HISTORY_DIRNAME = "history"
+LEGACY_FILENAME = "chat-history.jsonl"
+MEDIA_INDEX_FILENAME = "media-index.jsonl"
+
+# Wiro CDN URLs and common media extensions
+MEDIA_URL_RE = re.compile(r'(https?://cdn[^\s<>"]+|https?://[^\s<>"]+\.(?:png|jpe?g|webp|gif|mp4|webm|mp3|wav|ogg))\b')
+MEDIA_KINDS = {
+    "image": (".png", ".jpg", ".jpeg", ".webp", ".gif"),
+    "video": (".mp4", ".webm"),
+    "audio": (".mp3", ".wav", ".ogg"),
+}
+
+
+# ─── Low-level readers ────────────────────────────────────────────
+def tail_lines(path: str, limit: int, end: Optional[int] = None, block_size: int = 65536) -> List[bytes]:
+    """Return the last `limit` non-empty lines of a file (oldest first).
+
+    Seeks backwards from `end` (default: end of file) in blocks, so the cost
+    depends on `limit`, not on the file size.
+    """
+    lines_out: List[bytes] = []
+    with open(path, "rb") as f:
+        if end is None:
+            f.seek(0, os.SEEK_END)
+            end = f.tell()
+        pos = end
+        partial = b""
+        while pos > 0 and len(lines_out) < limit:
+            step = min(block_size, pos)
+            pos -= step
+            f.seek(pos)
+            lines = (f.read(step) + partial).split(b"\n")
+            # The first piece may be the tail of a line that starts in an earlier block
+            partial = lines.pop(0) if pos > 0 else b""
+            for raw in reversed(lines):
+                if len(lines_out) >= limit:
+                    break
+                if raw.strip():
+                    lines_out.append(raw)
+    lines_out.reverse()
+    return lines_out
+
+
+def tail_jsonl(path: str, limit: int, block_size: int = 65536) -> List[Dict[str, Any]]:
+    """Return the last `limit` entries of a JSONL file, oldest first."""
+    return [e for e in (_decode(raw) for raw in tail_lines(path, limit, block_size=block_size)) if e is not None]
+
+
+def _decode(raw: bytes) -> Optional[Dict[str, Any]]:
+    try:
+        entry = json.loads(raw)
+    except (json.JSONDecodeError, UnicodeDecodeError):
+        return None
+    return entry if isinstance(entry, dict) else None
+
+
+def _open_segment(path: str, codec: Optional[str]):
+    if codec == "gz":
+        return gzip.open(path, "rb")
+    if codec == "zst":
+        if not zstandard:
+            raise RuntimeError(f"zstandard not installed, cannot read {path}")
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), closefd=True))
+    return open(path, "rb")
+
+
+def _entry_ts(entry: Dict[str, Any]) -> str:
+    return str(entry.get("timestamp", ""))
+
+
+def _until_bound(until: str) -> str:
+    """A date-only `until` (YYYY-MM-DD) includes that whole day."""
+    if re.fullmatch(r"\d{4}-\d{2}-\d{2}", until or ""):
+        return until + "\uffff"
+    return until
+
+
+def _keyword_terms(query: str) -> List[str]:
+    return [t for t in re.findall(r"\w+", query.lower()) if t]
+
+
+# ─── Group commit ─────────────────────────────────────────────────
+class _GroupCommit:
+    """Batches concurrent append() calls into one write + flush (+ fsync).
+
+    The first caller becomes the leader and commits everything queued so far;
+    callers arriving meanwhile queue up and are committed together by the next
+    leader. Entries are written in arrival order, one whole line each.
+    Subclasses implement _commit_batch(batch), filling slot["seq"].
+
+    on_commit(seq, entry, line) callbacks run in seq order before the next
+    batch is committed, so caches fed from them never see a gap or reordering.
+    """
+
+    def _init_group_commit(self):
+        self._commit_cond = threading.Condition()
+        self._pending: List[Dict[str, Any]] = []
+        self._committing = False
+        self._commit_stats = {"appends": 0, "group_commits": 0, "max_batch": 0}
+
+    def append(self, entry: Dict[str, Any], line: Optional[bytes] = None) -> int:
+        """Append an entry (optionally already JSON-encoded); returns its seq."""
+        return self.append_many([(entry, line)])[0]
+
+    def append_many(self, items: List[Tuple[Dict[str, Any], Optional[bytes]]],
+                    on_commit: Optional[Callable[[int, Dict[str, Any], bytes], None]] = None) -> List[int]:
+        """Append (entry, line-or-None) pairs in order, in one commit; returns their seqs."""
+        self._ensure_loaded()
+        slots = [{"entry": entry, "line": line if line is not None else json.dumps(entry).encode("utf-8"),
+                  "seq": None, "error": None, "done": False, "on_commit": on_commit} for entry, line in items]
+        if not slots:
+            return []
+        slot = slots[-1]
+        with self._commit_cond:
+            self._pending.extend(slots)
+            while self._committing and not slot["done"]:
+                self._commit_cond.wait()
+            if not slot["done"]:
+                self._committing = True
+                batch, self._pending = self._pending, []
+        if not slot["done"]:
+            try:
+                self._commit_batch(batch)
+            except Exception as e:
+                for item in batch:
+                    item["error"] = e
+            else:
+                for item in batch:
+                    if item["on_commit"]:
+                        try:
+                            item["on_commit"](item["seq"], item["entry"], item["line"])
+                        except Exception as e:
+                            print(f"[HISTORY] on_commit callback failed: {e}", file=sys.stderr, flush=True)
+            finally:
+                with self._commit_cond:
+                    for item in batch:
+                        item["done"] = True
+                    self._commit_stats["appends"] += len(batch)
+                    self._commit_stats["group_commits"] += 1
+                    self._commit_stats["max_batch"] = max(self._commit_stats["max_batch"], len(batch))
+                    self._committing = False
+                    self._commit_cond.notify_all()
+        if slot["error"] is not None:
+            raise slot["error"]
+        return [item["seq"] for item in slots]
+
+    def commit_stats(self) -> Dict[str, Any]:
+        with self._commit_cond:
+            return dict(self._commit_stats)
+
+
+# ─── Segmented store ──────────────────────────────────────────────
+class SegmentedHistory(_GroupCommit):
+    """Append-only, segmented JSONL history for one agent."""
+
+    def __init__(self, agent_dir: str):
+        self._init_group_commit()
+        self.agent_dir = agent_dir
+        self.dir = os.path.join(agent_dir, HISTORY_DIRNAME)
+        self._lock = threading.RLock()
+        self._segments: List[Dict[str, Any]] = []
+        self._fh = None
+        self._loaded = False
+
+    # ── setup ──
+    def _segment_path(self, seg: Dict[str, Any]) -> str:
+        name = f"seg-{seg['id']:06d}.jsonl"
+        if seg.get("codec"):
+            name += "." + seg["codec"]
+        return os.path.join(self.dir, name)
+
+    def _ensure_loaded(self):
+        if self._loaded:
+            return
+        with self._lock:
+            if self._loaded:
+                return
+            legacy = os.path.join(self.agent_dir, LEGACY_FILENAME)
+            if not os.path.isdir(self.dir) and os.path.isfile(legacy):
+                self._migrate_legacy(legacy)
+            else:
+                self._load_index()
+            self._loaded = True
+
+    def _load_index(self):
+        os.makedirs(self.dir, exist_ok=True)
+        index_path = os.path.join(self.dir, "index.json")
+        segments = []
+        if os.path.isfile(index_path):
+            try:
+                with open(index_path, "r") as f:
+                    segments = json.load(f).get("segments", [])
+            except Exception as e:
+                print(f"[HISTORY] Bad index {index_path}, rebuilding: {e}", file=sys.stderr, flush=True)
+                segments = []
+        known = {s["id"] for s in segments}
+        # Segments written after the last index save (at least the active one) are rescanned.
+        # If a compression was interrupted, the plain file is the complete copy.
+        found = {}
+        for name in sorted(os.listdir(self.dir)):
+            if not name.startswith("seg-") or name.endswith(".tmp"):
+                continue
+            seg_id = int(name[4:10])
+            codec = None if name.endswith(".jsonl") else name.rsplit(".", 1)[-1]
+            if seg_id not in known and (seg_id not in found or codec is None):
+                found[seg_id] = codec
+        for seg_id, codec in found.items():
+            seg = {"id": seg_id, "codec": codec}
+            self._scan_segment(seg)
+            segments.append(seg)
+        segments.sort(key=lambda s: s["id"])
+        first_seq = 0
+        for seg in segments:
+            seg["first_seq"] = first_seq
+            first_seq += seg["count"]
+        self._segments = segments
+        if not segments or segments[-1].get("codec"):
+            self._new_segment()
+        elif segments[-1]["id"] in known:
+            # Rotation happened but the new segment was never written to
+            self._scan_segment(segments[-1])
+        for seg in self._segments[:-1]:
+            if not seg.get("codec"):
+                self._compress_later(seg)
+
+    def _scan_segment(self, seg: Dict[str, Any]):
+        """Rebuild count/timestamps/sparse index of a segment by reading it."""
+        seg.update({"count": 0, "bytes": 0, "first_ts": "", "last_ts": "", "sparse": [],
+                    "min_ts": "", "max_ts": "", "ordered": True})
+        try:
+            seg["codec"], f = self._open_current(seg)
+        except FileNotFoundError:
+            return
+        offset = 0
+        with f:
+            for raw in f:
+                length = len(raw)
+                if raw.strip():
+                    entry = _decode(raw) or {}
+                    self._track(seg, entry, offset)
+                offset += length
+        seg["bytes"] = offset
+
+    def _track(self, seg: Dict[str, Any], entry: Dict[str, Any], offset: int):
+        ts = _entry_ts(entry)
+        if seg["count"] % SPARSE_INDEX_EVERY == 0:
+            seg["sparse"].append([ts, offset])
+        if ts and not seg["first_ts"]:
+            seg["first_ts"] = ts
+        if ts:
+            # Imports can append older entries after newer ones
+            if seg["last_ts"] and ts < seg["last_ts"]:
+                seg["ordered"] = False
+            seg["last_ts"] = ts
+            seg["min_ts"] = min(seg.get("min_ts") or ts, ts)
+            seg["max_ts"] = max(seg.get("max_ts") or ts, ts)
+        seg["count"] += 1
+
+    def _migrate_legacy(self, legacy: str):
+        print(f"[HISTORY] Migrating {legacy} to segmented storage", file=sys.stderr, flush=True)
+        os.makedirs(self.dir, exist_ok=True)
+        self._segments = []
+        self._new_segment()
+        with open(legacy, "rb") as f:
+            for raw in f:
+                if raw.strip():
+                    self._write_line(raw.rstrip(b"\r\n"), _decode(raw) or {})
+        self._fh.flush()
+        os.replace(legacy, legacy + ".migrated")
+        self._save_index()
+
+    def _new_segment(self):
+        if self._fh:
+            self._fh.close()
+            self._fh = None
+        prev = self._segments[-1] if self._segments else None
+        seg = {
+            "id": prev["id"] + 1 if prev else 1,
+            "codec": None,
+            "first_seq": prev["first_seq"] + prev["count"] if prev else 0,
+            "count": 0, "bytes": 0, "first_ts": "", "last_ts": "", "sparse": [],
+            "min_ts": "", "max_ts": "", "ordered": True,
+        }
+        self._segments.append(seg)
+        if prev:
+            self._save_index()
+            self._compress_later(prev)
+        return seg
+
+    def _save_index(self):
+        index_path = os.path.join(self.dir, "index.json")
+        tmp = index_path + ".tmp"
+        closed = [s for s in self._segments if s is not self._segments[-1]]
+        with open(tmp, "w") as f:
+            json.dump({"segments": closed}, f)
+        os.replace(tmp, index_path)
+
+    def _compress_later(self, seg: Dict[str, Any]):
+        _compressor.submit(self, seg)
+
+    def _compress(self, seg: Dict[str, Any]):
+        src = self._segment_path(seg)
+        dst = src + "." + CODEC
+        if seg.get("codec"):
+            return
+        if not os.path.exists(src) and os.path.exists(dst):
+            # Another store instance compressed it first
+            with self._lock:
+                seg["codec"] = CODEC
+                self._save_index()
+            return
+        try:
+            with open(src, "rb") as fin, open(dst + ".tmp", "wb") as fout:
+                if CODEC == "zst":
+                    zstandard.ZstdCompressor(level=10).copy_stream(fin, fout)
+                else:
+                    with gzip.GzipFile(fileobj=fout, mode="wb", compresslevel=6) as gz:
+                        while True:
+                            block = fin.read(1024 * 1024)
+                            if not block:
+                                break
+                            gz.write(block)
+                fout.flush()
+                os.fsync(fout.fileno())
+            os.replace(dst + ".tmp", dst)
+            with self._lock:
+                seg["codec"] = CODEC
+                self._save_index()
+            os.remove(src)
+        except Exception as e:
+            print(f"[HISTORY] Compressing {src} failed: {e}", file=sys.stderr, flush=True)
+
+    # ── writes ──
+    def _write_line(self, line: bytes, entry: Dict[str, Any]) -> int:
+        """Write one encoded entry to the active segment; returns its seq."""
+        seg = self._segments[-1]
+        ts = _entry_ts(entry)
+        if seg["count"] and (
+            seg["bytes"] >= SEGMENT_MAX_BYTES
+            or (ROTATE_DAILY and ts[:10] and seg["last_ts"][:10] and ts[:10] != seg["last_ts"][:10])
+        ):
+            seg = self._new_segment()
+        if self._fh is None:
+            self._fh = open(self._segment_path(seg), "ab")
+            if seg["bytes"] and not self._ends_with_newline(seg):
+                # Torn last line from a crash: terminate it so it stays one (bad) line
+                self._fh.write(b"\n")
+                seg["bytes"] += 1
+        self._track(seg, entry, seg["bytes"])
+        self._fh.write(line + b"\n")
+        seg["bytes"] += len(line) + 1
+        return seg["first_seq"] + seg["count"] - 1
+
+    def _ends_with_newline(self, seg: Dict[str, Any]) -> bool:
+        with open(self._segment_path(seg), "rb") as f:
+            f.seek(seg["bytes"] - 1)
+            return f.read(1) == b"\n"
+
+    def _commit_batch(self, batch: List[Dict[str, Any]]):
+        with self._lock:
+            for slot in batch:
+                slot["seq"] = self._write_line(slot["line"], slot["entry"])
+            self._fh.flush()
+            if HISTORY_FSYNC:
+                os.fsync(self._fh.fileno())
+
+    # ── reads ──
+    def _snapshot(self) -> List[Dict[str, Any]]:
+        self._ensure_loaded()
+        with self._lock:
+            return [dict(s) for s in self._segments]
+
+    def _iter_segment(self, seg: Dict[str, Any], start: int = 0) -> Iterator[Tuple[int, Dict[str, Any]]]:
+        """Yield (seq, entry) from a segment, starting at byte `start` (a line boundary)."""
+        line_no = 0
+        if start:
+            line_no = next((i * SPARSE_INDEX_EVERY for i, (_, off) in enumerate(seg["sparse"]) if off == start), 0)
+        limit = seg["bytes"]
+        codec, f = self._open_current(seg)
+        with f:
+            if start and codec:
+                skipped = 0
+                while skipped < start:
+                    chunk = f.read(min(1024 * 1024, start - skipped))
+                    if not chunk:
+                        break
+                    skipped += len(chunk)
+            elif start:
+                f.seek(start)
+            offset = start
+            for raw in f:
+                if offset >= limit:
+                    break
+                offset += len(raw)
+                if not raw.strip():
+                    continue
+                entry = _decode(raw)
+                if entry is not None:
+                    yield seg["first_seq"] + line_no, entry
+                line_no += 1
+
+    def _open_current(self, seg: Dict[str, Any]):
+        """Open a segment's file as (codec, file), following a compression that finished meanwhile."""
+        try:
+            return seg.get("codec"), _open_segment(self._segment_path(seg), seg.get("codec"))
+        except FileNotFoundError:
+            if seg.get("codec"):
+                raise
+        # _compress records the codec under the lock before it removes the plain
+        # file; a plain file that is gone was compressed by this or another store.
+        with self._lock:
+            current = next((s for s in self._segments if s["id"] == seg["id"]), seg)
+            codec = current.get("codec") or CODEC
+        return codec, _open_segment(self._segment_path(dict(seg, codec=codec)), codec)
+
+    def tail(self, limit: int) -> List[Tuple[int, Dict[str, Any]]]:
+        """Last `limit` (seq, entry) pairs, oldest first; touches only the newest segments."""
+        out: List[Tuple[int, Dict[str, Any]]] = []
+        for seg in reversed(self._snapshot()):
+            need = limit - len(out)
+            if need <= 0:
+                break
+            if not seg["count"]:
+                continue
+            picked = None
+            if not seg.get("codec"):
+                try:
+                    picked = self._tail_plain(seg, need)
+                except FileNotFoundError:
+                    pass  # compressed meanwhile
+            if picked is None:
+                picked = list(self._iter_segment(seg))[-need:]
+            out[:0] = picked
+        return out[-limit:] if limit else out
+
+    def _tail_plain(self, seg: Dict[str, Any], need: int) -> List[Tuple[int, Dict[str, Any]]]:
+        """Last `need` decodable entries of an uncompressed segment."""
+        want = need
+        last = seg["first_seq"] + seg["count"] - 1
+        while True:
+            lines = tail_lines(self._segment_path(seg), want, end=seg["bytes"])
+            picked = [(last - i, _decode(raw)) for i, raw in enumerate(reversed(lines))]
+            picked = [(seq, e) for seq, e in picked if e is not None]
+            if len(picked) >= need or len(lines) < want:
+                picked.reverse()
+                return picked[-need:]
+            want += need - len(picked)
+
+    def _offset_for(self, seg: Dict[str, Any], seq: int) -> int:
+        """Byte offset of the closest sparse-index line at or before `seq`."""
+        idx = min((seq - seg["first_seq"]) // SPARSE_INDEX_EVERY, len(seg["sparse"]) - 1)
+        return seg["sparse"][idx][1] if idx >= 0 else 0
+
+    def page(self, before: Optional[int] = None, after: Optional[int] = None,
+             limit: int = 100) -> List[Tuple[int, Dict[str, Any]]]:
+        """Cursor pagination on seq: entries after `after`, or the newest ones before `before`."""
+        if after is not None:
+            out: List[Tuple[int, Dict[str, Any]]] = []
+            for seg in self._snapshot():
+                if not seg["count"] or seg["first_seq"] + seg["count"] - 1 <= after:
+                    continue
+                for seq, entry in self._iter_segment(seg, self._offset_for(seg, after + 1)):
+                    if seq > after:
+                        out.append((seq, entry))
+                        if len(out) >= limit:
+                            return out
+            return out
+        if before is None:
+            return self.tail(limit)
+        out = []
+        for seg in reversed(self._snapshot()):
+            need = limit - len(out)
+            if need <= 0:
+                break
+            if not seg["count"] or seg["first_seq"] >= before:
+                continue
+            end = min(before, seg["first_seq"] + seg["count"])
+            start_seq = max(seg["first_seq"], end - need)
+            while True:
+                picked = []
+                for seq, entry in self._iter_segment(seg, self._offset_for(seg, start_seq)):
+                    if seq >= end:
+                        break
+                    if seq >= start_seq:
+                        picked.append((seq, entry))
+                # Undecodable lines leave gaps; widen to the segment start if short
+                if len(picked) >= need or start_seq == seg["first_seq"]:
+                    break
+                start_seq = seg["first_seq"]
+            out[:0] = picked[-need:]
+        return out
+
+    def iter_range(self, since: str = "", until: str = "") -> Iterator[Tuple[int, Dict[str, Any]]]:
+        """Yield (seq, entry) with since <= timestamp <= until (ISO strings, either optional).
+
+        Timestamps are only known to be sorted within segments marked "ordered"
+        (imports can append older entries), so only those use the sparse index
+        and stop early; other segments are filtered entry by entry. Segments
+        indexed before min_ts/max_ts/ordered were tracked are always scanned.
+        """
+        until = _until_bound(until)
+        for seg in self._snapshot():
+            if not seg["count"]:
+                continue
+            if since and seg.get("max_ts") and seg["max_ts"] < since:
+                continue
+            if until and seg.get("min_ts") and seg["min_ts"] > until:
+                continue
+            ordered = seg.get("ordered", False)
+            start = 0
+            if since and ordered:
+                for ts, off in seg["sparse"]:
+                    if ts and ts >= since:
+                        break
+                    start = off
+            for seq, entry in self._iter_segment(seg, start):
+                ts = _entry_ts(entry)
+                if since and ts < since:
+                    continue
+                if until and ts > until:
+                    if ordered:
+                        break
+                    continue
+                yield seq, entry
+
+    def read_all(self) -> List[Dict[str, Any]]:
+        return [e for _, e in self.iter_range()]
+
+    def search(self, query: str, limit: int = 10) -> List[Dict[str, Any]]:
+        """Keyword search (all terms must appear), newest matches first. Linear scan."""
+        terms = _keyword_terms(query)
+        if not terms:
+            return []
+        hits = []
+        for seq, entry in self.iter_range():
+            text = str(entry.get("content", "")).lower()
+            if all(t in text for t in terms):
+                hits.append((seq, entry))
+        return [_search_result(entry, 1.0) for _, entry in reversed(hits[-limit:])]
+
+    def stats(self) -> Dict[str, Any]:
+        segments = self._snapshot()
+        return {
+            "backend": "segments",
+            "segments": len(segments),
+            "entries": sum(s["count"] for s in segments),
+            "bytes": sum(s["bytes"] for s in segments),
+            "compressed_segments": sum(1 for s in segments if s.get("codec")),
+            **self.commit_stats(),
+        }
+
+    def close(self):
+        with self._lock:
+            if self._fh:
+                self._fh.close()
+                self._fh = None
+
+
+def _search_result(entry: Dict[str, Any], score: float) -> Dict[str, Any]:
+    return {
+        "role": entry.get("role", ""),
+        "content": entry.get("content", ""),
+        "timestamp": entry.get("timestamp", ""),
+        "score": round(score, 3),
+    }
+
+
+class _Compressor:
+    """One background thread compressing closed segments, in rotation order."""
+
+    def __init__(self):
+        self._queue: "queue.Queue[Tuple[SegmentedHistory, Dict[str, Any]]]" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def submit(self, store: SegmentedHistory, seg: Dict[str, Any]):
+        self._queue.put((store, seg))
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="history-compress", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            store, seg = self._queue.get()
+            try:
+                store._compress(seg)
+            finally:
+                self._queue.task_done()
+
+    def wait(self):
+        """Block until every submitted segment has been compressed (or failed)."""
+        self._queue.join()
+
+
+_compressor = _Compressor()
+
+
+# ─── SQLite store ─────────────────────────────────────────────────
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    agent TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    role TEXT NOT NULL DEFAULT '',
+    timestamp TEXT NOT NULL DEFAULT '',
+    content TEXT NOT NULL DEFAULT '',
+    data TEXT NOT NULL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS entries_agent_seq ON entries(agent, seq);
+CREATE INDEX IF NOT EXISTS entries_agent_ts ON entries(agent, timestamp);
+CREATE INDEX IF NOT EXISTS entries_agent_role_ts ON entries(agent, role, timestamp);
+"""
+
+_FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS entries_fts USING fts5(content, content='entries', content_rowid='id');
+CREATE TRIGGER IF NOT EXISTS entries_ai AFTER INSERT ON entries BEGIN
+    INSERT INTO entries_fts(rowid, content) VALUES (new.id, new.content);
+END;
+CREATE TRIGGER IF NOT EXISTS entries_ad AFTER DELETE ON entries BEGIN
+    INSERT INTO entries_fts(entries_fts, rowid, content) VALUES ('delete', old.id, old.content);
+END;
+"""
+
+_databases: Dict[str, Tuple[sqlite3.Connection, threading.RLock, bool]] = {}
+# One connection (and write lock) per file even when two threads open it at once
+_databases_lock = threading.Lock()
+
+
+def _open_database(path: str) -> Tuple[sqlite3.Connection, threading.RLock, bool]:
+    """Shared connection per database file: (conn, lock, has_fts5)."""
+    with _databases_lock:
+        db = _databases.get(path)
+        if db:
+            return db
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=FULL" if HISTORY_FSYNC else "PRAGMA synchronous=NORMAL")
+        conn.executescript(_SCHEMA)
+        try:
+            conn.executescript(_FTS_SCHEMA)
+            has_fts = True
+        except sqlite3.OperationalError as e:
+            print(f"[HISTORY] FTS5 unavailable, keyword search falls back to LIKE: {e}", file=sys.stderr, flush=True)
+            has_fts = False
+        db = _databases[path] = (conn, threading.RLock(), has_fts)
+        return db
+
+
+class SqliteHistory(_GroupCommit):
+    """SQLite-backed history for one agent, same interface as SegmentedHistory."""
+
+    def __init__(self, agent_dir: str):
+        self._init_group_commit()
+        self.agent_dir = agent_dir
+        self.agent = os.path.basename(agent_dir)
+        if SQLITE_SCOPE == "install":
+            self.path = os.path.join(os.path.dirname(agent_dir), "history.db")
+        else:
+            self.path = os.path.join(agent_dir, "history.db")
+        self._conn, self._lock, self._fts = _open_database(self.path)
+        self._next_seq = None
+
+    def _ensure_loaded(self):
+        if self._next_seq is not None:
+            return
+        with self._lock:
+            if self._next_seq is not None:
+                return
+            row = self._conn.execute("SELECT MAX(seq) FROM entries WHERE agent = ?", (self.agent,)).fetchone()
+            if row[0] is None and (
+                os.path.isdir(os.path.join(self.agent_dir, HISTORY_DIRNAME))
+                or os.path.isfile(os.path.join(self.agent_dir, LEGACY_FILENAME))
+            ):
+                self._import_segments()
+                row = self._conn.execute("SELECT MAX(seq) FROM entries WHERE agent = ?", (self.agent,)).fetchone()
+            self._next_seq = 0 if row[0] is None else row[0] + 1
+
+    def _import_segments(self):
+        print(f"[HISTORY] Importing {self.agent} history into {self.path}", file=sys.stderr, flush=True)
+        source = SegmentedHistory(self.agent_dir)
+        self._conn.execute("BEGIN")
+        try:
+            for seq, entry in source.iter_range():
+                self._insert(seq, entry, json.dumps(entry))
+            self._conn.execute("COMMIT")
+        except Exception:
+            self._conn.execute("ROLLBACK")
+            raise
+        finally:
+            source.close()
+
+    def _insert(self, seq: int, entry: Dict[str, Any], data: str):
+        self._conn.execute(
+            "INSERT INTO entries (agent, seq, role, timestamp, content, data) VALUES (?, ?, ?, ?, ?, ?)",
+            (self.agent, seq, str(entry.get("role", "")), _entry_ts(entry),
+             str(entry.get("content", "") or ""), data),
+        )
+
+    def _commit_batch(self, batch: List[Dict[str, Any]]):
+        # One transaction per group commit
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                seq = self._next_seq
+                for slot in batch:
+                    self._insert(seq, slot["entry"], slot["line"].decode("utf-8"))
+                    seq += 1
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            for slot in batch:
+                slot["seq"] = self._next_seq
+                self._next_seq += 1
+
+    def _rows(self, sql: str, params: Tuple) -> List[Tuple[int, Dict[str, Any]]]:
+        self._ensure_loaded()
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+        return [(seq, json.loads(data)) for seq, data in rows]
+
+    def tail(self, limit: int) -> List[Tuple[int, Dict[str, Any]]]:
+        rows = self._rows("SELECT seq, data FROM entries WHERE agent = ? ORDER BY seq DESC LIMIT ?",
+                          (self.agent, limit))
+        rows.reverse()
+        return rows
+
+    def page(self, before: Optional[int] = None, after: Optional[int] = None,
+             limit: int = 100) -> List[Tuple[int, Dict[str, Any]]]:
+        """Cursor pagination on seq: entries after `after`, or the newest ones before `before`."""
+        if after is not None:
+            return self._rows("SELECT seq, data FROM entries WHERE agent = ? AND seq > ? ORDER BY seq LIMIT ?",
+                              (self.agent, after, limit))
+        if before is None:
+            return self.tail(limit)
+        rows = self._rows("SELECT seq, data FROM entries WHERE agent = ? AND seq < ? ORDER BY seq DESC LIMIT ?",
+                          (self.agent, before, limit))
+        rows.reverse()
+        return rows
+
+    def iter_range(self, since: str = "", until: str = "") -> Iterator[Tuple[int, Dict[str, Any]]]:
+        sql = "SELECT seq, data FROM entries WHERE agent = ?"
+        params: List[Any] = [self.agent]
+        if since:
+            sql += " AND timestamp >= ?"
+            params.append(since)
+        if until:
+            sql += " AND timestamp <= ?"
+            params.append(_until_bound(until))
+        # Walk in batches on seq so a long export doesn't hold the lock
+        last = -1
+        while True:
+            batch = self._rows(sql + " AND seq > ? ORDER BY seq LIMIT 1000", tuple(params + [last]))
+            if not batch:
+                return
+            yield from batch
+            last = batch[-1][0]
+
+    def read_all(self) -> List[Dict[str, Any]]:
+        return [e for _, e in self.iter_range()]
+
+    def search(self, query: str, limit: int = 10) -> List[Dict[str, Any]]:
+        """Keyword search (all terms must appear), best bm25 rank first."""
+        terms = _keyword_terms(query)
+        if not terms:
+            return []
+        self._ensure_loaded()
+        with self._lock:
+            if self._fts:
+                match = " ".join('"' + t.replace('"', "") + '"' for t in terms)
+                rows = self._conn.execute(
+                    "SELECT e.data, bm25(entries_fts) FROM entries_fts JOIN entries e ON e.id = entries_fts.rowid "
+                    "WHERE entries_fts MATCH ? AND e.agent = ? ORDER BY bm25(entries_fts) LIMIT ?",
+                    (match, self.agent, limit),
+                ).fetchall()
+            else:
+                sql = "SELECT data, 0 FROM entries WHERE agent = ?" + " AND content LIKE ?" * len(terms)
+                rows = self._conn.execute(sql + " ORDER BY seq DESC LIMIT ?",
+                                          (self.agent, *[f"%{t}%" for t in terms], limit)).fetchall()
+        return [_search_result(json.loads(data), -rank) for data, rank in rows]
+
+    def stats(self) -> Dict[str, Any]:
+        self._ensure_loaded()
+        return {"backend": "sqlite", "entries": self._next_seq, "path": self.path, "fts5": self._fts,
+                **self.commit_stats()}
+
+    def close(self):
+        pass
+
+
+_stores: Dict[str, Any] = {}
+_stores_lock = threading.Lock()
+
+
+def open_store(agent_dir: str):
+    """Return the (process-wide) history store for an agent directory."""
+    key = os.path.abspath(agent_dir)
+    with _stores_lock:
+        store = _stores.get(key)
+        if store is None:
+            cls = SqliteHistory if HISTORY_BACKEND == "sqlite" else SegmentedHistory
+            store = _stores[key] = cls(key)
+        return store
+
+
+def close_all():
+    with _stores_lock:
+        for store in _stores.values():
+            store.close()
+        with _databases_lock:
+            for conn, lock, _ in _databases.values():
+                with lock:
+                    conn.close()
+            _databases.clear()
+
+
+# ─── Media index ──────────────────────────────────────────────────
+def media_kind(url: str) -> str:
+    path = url.split("?", 1)[0].split("#", 1)[0].lower()
+    for kind, exts in MEDIA_KINDS.items():
+        if path.endswith(exts):
+            return kind
+    return "other"
+
+
+def extract_media(content: str) -> List[str]:
+    """Media URLs in a message, in order of first appearance."""
+    if not content or "http" not in content:
+        return []
+    urls: List[str] = []
+    for url in MEDIA_URL_RE.findall(content):
+        if url not in urls:
+            urls.append(url)
+    return urls
+
+
+class MediaIndex:
+    """Per-agent list of media URLs seen in history (first occurrence wins).
+
+    Items are {url, kind, timestamp, role, seq}, oldest first. Backed by an
+    append-only media-index.jsonl that is built from the full history once.
+    """
+
+    def __init__(self, agent_dir: str):
+        self.agent_dir = agent_dir
+        self.path = os.path.join(agent_dir, MEDIA_INDEX_FILENAME)
+        self._lock = threading.Lock()
+        self._items: Optional[List[Dict[str, Any]]] = None
+        self._urls: set = set()
+
+    def _ensure_loaded(self):
+        if self._items is not None:
+            return
+        items: List[Dict[str, Any]] = []
+        if os.path.exists(self.path):
+            with open(self.path, "rb") as f:
+                for raw in f:
+                    item = _decode(raw)
+                    if item and item.get("url") not in self._urls:
+                        self._urls.add(item["url"])
+                        items.append(item)
+            self._items = items
+            return
+        self._items = items
+        for seq, entry in open_store(self.agent_dir).iter_range():
+            self._add(seq, entry)
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            for item in self._items:
+                f.write(json.dumps(item) + "\n")
+        os.replace(tmp, self.path)
+        if self._items:
+            print(f"[HISTORY] Indexed {len(self._items)} media URLs for {os.path.basename(self.agent_dir)}",
+                  file=sys.stderr, flush=True)
+
+    def _add(self, seq: int, entry: Dict[str, Any]) -> List[Dict[str, Any]]:
+        added = []
+        for url in extract_media(str(entry.get("content", "") or "")):
+            if url in self._urls:
+                continue
+            item = {"url": url, "kind": media_kind(url), "timestamp": _entry_ts(entry),
+                    "role": entry.get("role", ""), "seq": seq}
+            self._urls.add(url)
+            self._items.append(item)
+            added.append(item)
+        return added
+
+    def add(self, seq: int, entry: Dict[str, Any]):
+        """Record media from a newly appended history entry."""
+        content = entry.get("content", "")
+        if not content or "http" not in str(content):
+            return
+        with self._lock:
+            # A first-time backfill already sees this entry; _add skips known URLs
+            self._ensure_loaded()
+            added = self._add(seq, entry)
+            if added:
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write("".join(json.dumps(item) + "\n" for item in added))
+
+    def items(self, kind: str = "", limit: int = 0) -> List[Dict[str, Any]]:
+        with self._lock:
+            self._ensure_loaded()
+            items = [i for i in self._items if not kind or i["kind"] == kind]
+        return items[-limit:] if limit else items
+
+
+_media_indexes: Dict[str, MediaIndex] = {}
+
+
+def open_media_index(agent_dir: str) -> MediaIndex:
+    key = os.path.abspath(agent_dir)
+    with _stores_lock:
+        index = _media_indexes.get(key)
+        if index is None:
+            index = _media_indexes[key] = MediaIndex(key)
+        return index
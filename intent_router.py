@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+"""
+Local fast-path router for the orchestrator.
+
+Scores a user message against embedding prototypes built from each role's
+IDENTITY.md (role + core expertise), SOUL.md (mission) and skills.json, plus a
+few Wiro generation intents, using the FastEmbed model from vector_store.
+
+A confident match returns a plan dict in the same shape the orchestrator LLM
+produces; anything else returns None and the caller falls through to the LLM
+planner.
+"""
+
+import json
+import math
+import os
+import re
+import sys
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+try:
+    import vector_store
+except ImportError:
+    vector_store = None
+
+ROLES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "roles")
+
+FAST_ROUTE_ENABLED = os.environ.get("KOALACLAW_FAST_ROUTE", "1") != "0"
+FAST_ROUTE_THRESHOLD = float(os.environ.get("KOALACLAW_FAST_ROUTE_THRESHOLD", "0.82"))
+FAST_ROUTE_MARGIN = float(os.environ.get("KOALACLAW_FAST_ROUTE_MARGIN", "0.04"))
+
+# Roles that are never fast-route targets (the router itself, free-form roles)
+SKIP_ROLES = {"orchestrator-koala", "custom-koala"}
+
+# Example phrasings per Wiro task type; a close match goes straight to model suggestions
+GENERATION_INTENTS = {
+    "text-to-image": [
+        "generate an image of a cat sitting on a sofa",
+        "create a picture of a sunset over the mountains",
+        "draw an illustration of a futuristic city",
+        "make a logo for my coffee shop",
+        "bir kedi görseli oluştur",
+    ],
+    "text-to-video": [
+        "generate a video of waves crashing on a beach",
+        "create a short video clip of a dancing robot",
+        "make an animated video of a rocket launch",
+        "bir video oluştur",
+    ],
+    "text-to-speech": [
+        "generate speech audio saying hello everyone",
+        "convert this text to speech",
+        "create a voice over narration for my video",
+    ],
+}
+
+# With media earlier in the conversation these point back at it ("animate this image",
+# "make it a video", "bunu videoya çevir"); only the LLM planner sees the media URLs
+MEDIA_REFERENCE_RE = re.compile(
+    r"\b(this|that|it|these|those|them|previous|above|last|same|animate\w*|"
+    r"bu|bunu|şu|şunu|onu|önceki|videoya|canlandır\w*|hareketlendir\w*|çevir\w*)\b",
+    re.IGNORECASE,
+)
+
+_lock = threading.Lock()
+_role_cache: Dict[str, Tuple[float, List[List[float]]]] = {}
+_intent_cache: Dict[str, List[List[float]]] = {}
+
+
+def _normalize(vec: List[float]) -> List[float]:
+    norm = math.sqrt(sum(x * x for x in vec)) or 1.0
+    return [x / norm for x in vec]
+
+
+def _dot(a: List[float], b: List[float]) -> float:
+    return sum(x * y for x, y in zip(a, b))
+
+
+def _role_files(role_id: str) -> List[str]:
+    return [os.path.join(ROLES_DIR, role_id, name) for name in ("IDENTITY.md", "SOUL.md", "skills.json")]
+
+
+def _read(path: str) -> str:
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return f.read()
+    except Exception:
+        return ""
+
+
+def _section(markdown: str, title: str) -> List[str]:
+    """Return the non-empty lines of a '## title' section."""
+    lines, inside = [], False
+    for line in markdown.splitlines():
+        if line.startswith("## "):
+            inside = line[3:].strip().lower() == title.lower()
+            continue
+        if inside and line.strip():
+            lines.append(line.strip().lstrip("-*0123456789. ").strip())
+    return lines
+
+
+def role_prototypes(role_id: str) -> List[str]:
+    """Texts describing what a role is good at (one embedding each)."""
+    identity = _read(os.path.join(ROLES_DIR, role_id, "IDENTITY.md"))
+    soul = _read(os.path.join(ROLES_DIR, role_id, "SOUL.md"))
+    title = role_id
+    for line in identity.splitlines():
+        if line.startswith("**Role:**"):
+            title = line.split("**Role:**")[1].strip()
+    texts = [f"{title}: {item}" for item in _section(identity, "Core Expertise")]
+    mission = " ".join(_section(soul, "Mission"))
+    if mission:
+        texts.append(f"{title}: {mission}")
+    skills_raw = _read(os.path.join(ROLES_DIR, role_id, "skills.json"))
+    if skills_raw:
+        try:
+            enabled = json.loads(skills_raw).get("enabled", [])
+            if enabled:
+                texts.append(f"{title} using tools: " + ", ".join(s.replace("-", " ") for s in enabled))
+        except Exception:
+            pass
+    return texts or [title]
+
+
+def _embed(texts: List[str]) -> List[List[float]]:
+    if not vector_store or not texts:
+        return []
+    return [_normalize(v) for v in vector_store.embed_texts(texts)]
+
+
+def _role_vectors(role_id: str) -> List[List[float]]:
+    mtime = max((os.path.getmtime(p) for p in _role_files(role_id) if os.path.exists(p)), default=0.0)
+    with _lock:
+        cached = _role_cache.get(role_id)
+        if cached and cached[0] == mtime:
+            return cached[1]
+    vectors = _embed(role_prototypes(role_id))
+    if vectors:
+        with _lock:
+            _role_cache[role_id] = (mtime, vectors)
+    return vectors
+
+
+def _intent_vectors(task_type: str) -> List[List[float]]:
+    with _lock:
+        cached = _intent_cache.get(task_type)
+    if cached:
+        return cached
+    vectors = _embed(GENERATION_INTENTS[task_type])
+    if vectors:
+        with _lock:
+            _intent_cache[task_type] = vectors
+    return vectors
+
+
+def classify(message: str, roster: List[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    """Score a message against generation intents and roster roles.
+
+    roster items need "id" and "role_id". Returns the best generation match and
+    ranked agent matches, or None if the embedder is unavailable.
+    """
+    query = _embed([message])
+    if not query:
+        return None
+    q = query[0]
+
+    generation = ("", 0.0)
+    for task_type in GENERATION_INTENTS:
+        vectors = _intent_vectors(task_type)
+        score = max((_dot(q, v) for v in vectors), default=0.0)
+        if score > generation[1]:
+            generation = (task_type, score)
+
+    agents = []
+    for agent in roster:
+        role_id = agent.get("role_id", "")
+        if not role_id or role_id in SKIP_ROLES:
+            continue
+        vectors = _role_vectors(role_id)
+        if vectors:
+            agents.append((agent, max(_dot(q, v) for v in vectors)))
+    agents.sort(key=lambda x: x[1], reverse=True)
+    return {"generation": generation, "agents": agents}
+
+
+def refers_to_media(message: str) -> bool:
+    return bool(MEDIA_REFERENCE_RE.search(message))
+
+
+def route(message: str, roster: List[Dict[str, Any]], has_media: bool = False) -> Optional[Dict[str, Any]]:
+    """Return an orchestrator plan for high-confidence messages, else None.
+
+    has_media: the conversation already contains media; follow-ups that refer
+    to it (image-to-video etc.) are left to the LLM planner.
+    """
+    if not FAST_ROUTE_ENABLED or not message.strip():
+        return None
+    if has_media and refers_to_media(message):
+        return None
+    try:
+        scores = classify(message, roster)
+    except Exception as e:
+        print(f"[ROUTER] Classification failed: {e}", file=sys.stderr, flush=True)
+        return None
+    if not scores:
+        return None
+
+    task_type, gen_score = scores["generation"]
+    agents = scores["agents"]
+    top_score = agents[0][1] if agents else 0.0
+    second_score = agents[1][1] if len(agents) > 1 else 0.0
+
+    if gen_score >= FAST_ROUTE_THRESHOLD and gen_score >= top_score:
+        return {
+            "plan": "suggest models",
+            "delegations": [],
+            "direct_answer": None,
+            "wiro_suggest": {"prompt": message, "task_type": task_type},
+            "fast_route": {"target": "wiro", "task_type": task_type, "score": round(gen_score, 3)},
+        }
+
+    if agents and top_score >= FAST_ROUTE_THRESHOLD and top_score - second_score >= FAST_ROUTE_MARGIN:
+        agent = agents[0][0]
+        return {
+            "plan": f"route to {agent.get('name', agent['role_id'])}",
+            "delegations": [{"agent_id": agent["id"], "task": message}],
+            "direct_answer": None,
+            "fast_route": {"target": agent["role_id"], "score": round(top_score, 3),
+                           "margin": round(top_score - second_score, 3)},
+        }
+    return None
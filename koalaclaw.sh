@@ -923,6 +923,7 @@ RestartSec=5
 User=root
 Environment=KOALACLAW_INSTALL_DIR=${INSTALL_DIR}
 Environment=KOALACLAW_API_PORT=${ADMIN_API_PORT}
+Environment=VECTOR_MODEL_CACHE_DIR=${INSTALL_DIR}/data/models
 
 [Install]
 WantedBy=multi-user.target
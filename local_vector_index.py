@@ -0,0 +1,496 @@
+#!/usr/bin/env python3
+"""
+Embedded vector index for KoalaClaw — the Qdrant client API subset vector_store uses.
+
+For single-node installs without a Qdrant container (VECTOR_BACKEND=local), or
+as a fallback when Qdrant is unreachable (VECTOR_BACKEND=auto). Each collection
+is a directory under the index root:
+  vectors.f32   append-only rows of normalized float32 vectors (memory-mapped for search)
+  points.jsonl  append-only log of upserts/deletes: id → row, payload, sparse vectors
+  config.json   vector size and sparse vector names
+
+Search is NumPy brute-force cosine over the rows that pass the filter. Large
+collections use an HNSW graph instead when hnswlib is installed (built in
+memory on first search, VECTOR_LOCAL_HNSW_MIN live points and up). Sparse
+vectors are scored with Qdrant's IDF formula and fused with RRF, so
+VECTOR_HYBRID works the same on both backends.
+
+Overwritten and deleted rows stay in the files until dead rows outnumber
+live ones; the collection is then rewritten.
+"""
+
+import json
+import math
+import os
+import shutil
+import sys
+import threading
+from types import SimpleNamespace
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+try:
+    import hnswlib
+    HNSW_AVAILABLE = True
+except ImportError:
+    HNSW_AVAILABLE = False
+
+HNSW_MIN_POINTS = int(os.environ.get("VECTOR_LOCAL_HNSW_MIN", "50000"))
+COMPACT_MIN_DEAD = 1024
+RRF_K = 60
+
+
+class CollectionNotFound(Exception):
+    status_code = 404
+
+    def __init__(self, name: str):
+        super().__init__(f"Collection {name} not found")
+
+
+def _sparse_pair(vector: Any) -> Optional[Tuple[List[int], List[float]]]:
+    if vector is None:
+        return None
+    if isinstance(vector, dict):
+        return list(vector["indices"]), [float(v) for v in vector["values"]]
+    return list(vector.indices), [float(v) for v in vector.values]
+
+
+def _split_vector(vector: Any) -> Tuple[Optional[Any], Dict[str, Tuple[List[int], List[float]]]]:
+    """A point's vector → (dense, {sparse name: (indices, values)})."""
+    if not isinstance(vector, dict):
+        return vector, {}
+    dense, sparse = None, {}
+    for name, value in vector.items():
+        if name == "":
+            dense = value
+        elif value is not None:
+            sparse[name] = _sparse_pair(value)
+    return dense, sparse
+
+
+def _point_ids(selector: Any) -> Optional[List[Any]]:
+    if isinstance(selector, (list, tuple)):
+        return list(selector)
+    if hasattr(selector, "points"):  # PointIdsList
+        return list(selector.points)
+    return None
+
+
+def _select_payload(payload: Dict[str, Any], with_payload: Any) -> Optional[Dict[str, Any]]:
+    if not with_payload:
+        return None
+    if isinstance(with_payload, (list, tuple)):
+        return {k: payload[k] for k in with_payload if k in payload}
+    return dict(payload)
+
+
+class _Collection:
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.RLock()
+        with open(os.path.join(path, "config.json"), "r", encoding="utf-8") as f:
+            self.config = json.load(f)
+        self.dim = int(self.config["size"])
+        self.row_bytes = self.dim * 4
+        self._reset()
+
+    def _reset(self):
+        self.ids: Dict[str, int] = {}
+        self.row_ids: List[Optional[Any]] = []
+        self.payloads: List[Optional[Dict[str, Any]]] = []
+        self.sparse: List[Dict[str, Tuple[List[int], List[float]]]] = []
+        self.postings: Dict[str, Dict[int, Dict[int, float]]] = {}
+        self.alive = np.zeros(0, dtype=bool)
+        self.agent = np.zeros(0, dtype=np.int64)
+        self._mm = None
+        self._hnsw = None
+        self._hnsw_rows = 0
+        self._load()
+
+    # ── Storage ──────────────────────────────────────────
+
+    def _load(self):
+        vec_path = os.path.join(self.path, "vectors.f32")
+        if not os.path.exists(vec_path):
+            open(vec_path, "wb").close()
+        rows = os.path.getsize(vec_path) // self.row_bytes
+        # Drop a torn tail row so row numbers stay aligned
+        with open(vec_path, "r+b") as f:
+            f.truncate(rows * self.row_bytes)
+        self._grow(rows)
+        log_path = os.path.join(self.path, "points.jsonl")
+        if os.path.exists(log_path):
+            with open(log_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        break  # torn last line
+                    self._apply(record)
+        self._vec_f = open(vec_path, "ab")
+        self._log_f = open(log_path, "a", encoding="utf-8")
+        if self.dead_rows() >= max(COMPACT_MIN_DEAD, self.live_rows()):
+            self.compact()
+
+    def _grow(self, rows: int):
+        while len(self.row_ids) < rows:
+            self.row_ids.append(None)
+            self.payloads.append(None)
+            self.sparse.append({})
+        if len(self.alive) < rows:
+            size = max(rows, len(self.alive) * 2, 1024)
+            self.alive = np.concatenate([self.alive, np.zeros(size - len(self.alive), dtype=bool)])
+            self.agent = np.concatenate([self.agent, np.full(size - len(self.agent), -1, dtype=np.int64)])
+
+    def _apply(self, record: Dict[str, Any]):
+        key = str(record["id"])
+        if record["op"] == "u":
+            row = record["row"]
+            if row >= len(self.row_ids):
+                return  # vector row lost in a crash
+            self._kill(key)
+            payload = record.get("payload") or {}
+            self.ids[key] = row
+            self.row_ids[row] = record["id"]
+            self.payloads[row] = payload
+            self.alive[row] = True
+            agent_id = payload.get("agent_id")
+            self.agent[row] = agent_id if isinstance(agent_id, int) else -1
+            self._set_sparse(row, {n: tuple(v) for n, v in (record.get("sparse") or {}).items()})
+        elif record["op"] == "s":
+            row = self.ids.get(key)
+            if row is not None:
+                self._set_sparse(row, {**self.sparse[row], **{n: tuple(v) for n, v in record["sparse"].items()}})
+        elif record["op"] == "d":
+            self._kill(key)
+
+    def _kill(self, key: str):
+        row = self.ids.pop(key, None)
+        if row is None:
+            return
+        self._set_sparse(row, {})
+        self.alive[row] = False
+        self.row_ids[row] = None
+        self.payloads[row] = None
+
+    def _set_sparse(self, row: int, sparse: Dict[str, Tuple[List[int], List[float]]]):
+        for name, (indices, _) in self.sparse[row].items():
+            postings = self.postings.get(name, {})
+            for i in indices:
+                postings.get(i, {}).pop(row, None)
+        self.sparse[row] = sparse
+        for name, (indices, values) in sparse.items():
+            postings = self.postings.setdefault(name, {})
+            for i, v in zip(indices, values):
+                postings.setdefault(i, {})[row] = v
+
+    def _write(self, records: List[Dict[str, Any]]):
+        for record in records:
+            self._log_f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            self._apply(record)
+        self._log_f.flush()
+
+    def _vectors(self) -> np.ndarray:
+        rows = len(self.row_ids)
+        if self._mm is None or self._mm.shape[0] < rows:
+            self._mm = np.memmap(os.path.join(self.path, "vectors.f32"), dtype=np.float32,
+                                 mode="r", shape=(rows, self.dim)) if rows else np.zeros((0, self.dim), np.float32)
+        return self._mm
+
+    def live_rows(self) -> int:
+        return len(self.ids)
+
+    def dead_rows(self) -> int:
+        return len(self.row_ids) - len(self.ids)
+
+    def compact(self):
+        with self.lock:
+            vectors = self._vectors()
+            live = [row for row in range(len(self.row_ids)) if self.row_ids[row] is not None]
+            tmp_vec = os.path.join(self.path, "vectors.f32.tmp")
+            tmp_log = os.path.join(self.path, "points.jsonl.tmp")
+            with open(tmp_vec, "wb") as vf, open(tmp_log, "w", encoding="utf-8") as lf:
+                for new_row, row in enumerate(live):
+                    vf.write(np.asarray(vectors[row], dtype=np.float32).tobytes())
+                    lf.write(json.dumps({
+                        "op": "u", "id": self.row_ids[row], "row": new_row, "payload": self.payloads[row],
+                        "sparse": {n: [list(i), list(v)] for n, (i, v) in self.sparse[row].items()},
+                    }, ensure_ascii=False) + "\n")
+            dead = self.dead_rows()
+            self.close()
+            os.replace(tmp_vec, os.path.join(self.path, "vectors.f32"))
+            os.replace(tmp_log, os.path.join(self.path, "points.jsonl"))
+            self._reset()
+            print(f"[LOCALVEC] Compacted {os.path.basename(self.path)}: dropped {dead} dead rows",
+                  file=sys.stderr, flush=True)
+
+    def close(self):
+        self._mm = None
+        self._hnsw = None
+        for f in (getattr(self, "_vec_f", None), getattr(self, "_log_f", None)):
+            if f:
+                f.close()
+
+    # ── Writes ───────────────────────────────────────────
+
+    def upsert(self, points: List[Any]):
+        with self.lock:
+            records, vectors = [], []
+            row = len(self.row_ids)
+            for p in points:
+                dense, sparse = _split_vector(p.vector)
+                if dense is None:
+                    raise ValueError(f"point {p.id} has no dense vector")
+                vec = np.asarray(dense, dtype=np.float32)
+                if vec.shape != (self.dim,):
+                    raise ValueError(f"expected dim {self.dim}, got {vec.shape}")
+                norm = float(np.linalg.norm(vec)) or 1.0
+                vectors.append((vec / norm).tobytes())
+                records.append({"op": "u", "id": p.id, "row": row, "payload": p.payload or {},
+                                "sparse": {n: [i, v] for n, (i, v) in sparse.items()}})
+                row += 1
+            # Vectors before the log, so a crash never logs a row that isn't there
+            self._vec_f.write(b"".join(vectors))
+            self._vec_f.flush()
+            self._grow(row)
+            self._write(records)
+            if self.dead_rows() >= max(COMPACT_MIN_DEAD, self.live_rows()):
+                self.compact()
+
+    def update_vectors(self, points: List[Any]):
+        with self.lock:
+            for p in points:
+                dense, sparse = _split_vector(p.vector)
+                row = self.ids.get(str(p.id))
+                if row is None:
+                    continue
+                if dense is not None:
+                    self.upsert([SimpleNamespace(id=p.id, payload=self.payloads[row], vector={
+                        "": dense, **{n: {"indices": i, "values": v}
+                                      for n, (i, v) in {**self.sparse[row], **sparse}.items()}})])
+                elif sparse:
+                    self._write([{"op": "s", "id": p.id, "sparse": {n: [i, v] for n, (i, v) in sparse.items()}}])
+
+    def delete(self, selector: Any):
+        with self.lock:
+            ids = _point_ids(selector)
+            if ids is None:
+                query_filter = getattr(selector, "filter", selector)
+                ids = [self.row_ids[row] for row in np.flatnonzero(self.mask(query_filter))]
+            self._write([{"op": "d", "id": pid} for pid in ids if str(pid) in self.ids])
+
+    # ── Reads ────────────────────────────────────────────
+
+    def mask(self, query_filter: Any) -> np.ndarray:
+        rows = len(self.row_ids)
+        mask = self.alive[:rows].copy()
+        if query_filter is None:
+            return mask
+        for condition in getattr(query_filter, "must", None) or []:
+            mask &= self._condition(condition, rows)
+        for condition in getattr(query_filter, "must_not", None) or []:
+            mask &= ~self._condition(condition, rows)
+        return mask
+
+    def _condition(self, condition: Any, rows: int) -> np.ndarray:
+        value = condition.match.value
+        if condition.key == "agent_id" and isinstance(value, int):
+            return self.agent[:rows] == value
+        return np.fromiter(((p or {}).get(condition.key) == value for p in self.payloads[:rows]),
+                           dtype=bool, count=rows)
+
+    def record(self, row: int, with_payload: Any = True, with_vectors: Any = False, score: Optional[float] = None):
+        point = SimpleNamespace(id=self.row_ids[row], payload=_select_payload(self.payloads[row], with_payload),
+                                vector=self._vectors()[row].tolist() if with_vectors else None)
+        if score is not None:
+            point.score = score
+        return point
+
+    def dense_search(self, query: List[float], mask: np.ndarray, limit: int) -> List[Tuple[int, float]]:
+        q = np.asarray(query, dtype=np.float32)
+        q /= float(np.linalg.norm(q)) or 1.0
+        candidates = int(mask.sum())
+        if not candidates or limit <= 0:
+            return []
+        if HNSW_AVAILABLE and self.live_rows() >= HNSW_MIN_POINTS:
+            found = self._hnsw_search(q, mask, min(limit, candidates))
+            if found is not None:
+                return found
+        vectors = self._vectors()
+        if candidates == len(mask):
+            rows, scores = None, vectors @ q
+        else:
+            rows = np.flatnonzero(mask)
+            scores = vectors[rows] @ q
+        k = min(limit, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(int(rows[i] if rows is not None else i), float(scores[i])) for i in top]
+
+    def _hnsw_search(self, q: np.ndarray, mask: np.ndarray, k: int) -> Optional[List[Tuple[int, float]]]:
+        rows = len(self.row_ids)
+        try:
+            if self._hnsw is None:
+                self._hnsw = hnswlib.Index(space="ip", dim=self.dim)
+                self._hnsw.init_index(max_elements=max(rows * 2, 1024), ef_construction=200, M=16)
+                self._hnsw_rows = 0
+                print(f"[LOCALVEC] Building HNSW index for {os.path.basename(self.path)} ({rows} rows)",
+                      file=sys.stderr, flush=True)
+            if self._hnsw_rows < rows:
+                if rows > self._hnsw.get_max_elements():
+                    self._hnsw.resize_index(rows * 2)
+                self._hnsw.add_items(np.asarray(self._vectors()[self._hnsw_rows:rows]),
+                                     np.arange(self._hnsw_rows, rows))
+                self._hnsw_rows = rows
+            self._hnsw.set_ef(max(64, k * 4))
+            labels, distances = self._hnsw.knn_query(q, k=k, filter=lambda label: bool(mask[label]))
+        except (RuntimeError, TypeError):
+            # Too few points pass the filter for a graph search (or hnswlib predates filters)
+            return None
+        return [(int(label), 1.0 - float(d)) for label, d in zip(labels[0], distances[0])]
+
+    def sparse_search(self, name: str, query: Any, mask: np.ndarray, limit: int) -> List[Tuple[int, float]]:
+        postings = self.postings.get(name, {})
+        total = self.live_rows()
+        scores: Dict[int, float] = {}
+        for index, weight in zip(*_sparse_pair(query)):
+            rows = postings.get(index)
+            if not rows:
+                continue
+            # Qdrant's IDF modifier
+            idf = math.log((total - len(rows) + 0.5) / (len(rows) + 0.5) + 1)
+            for row, value in rows.items():
+                if mask[row]:
+                    scores[row] = scores.get(row, 0.0) + weight * idf * value
+        return sorted(scores.items(), key=lambda item: item[1], reverse=True)[:limit]
+
+    def search(self, query: Any, using: Optional[str], mask: np.ndarray, limit: int) -> List[Tuple[int, float]]:
+        if hasattr(query, "indices") or (isinstance(query, dict) and "indices" in query):
+            return self.sparse_search(using or "", query, mask, limit)
+        return self.dense_search(query, mask, limit)
+
+
+class LocalVectorIndex:
+    """Drop-in for the QdrantClient methods vector_store calls, backed by files under `root`."""
+
+    def __init__(self, root: str):
+        self.root = root
+        self._lock = threading.Lock()
+        self._open: Dict[str, _Collection] = {}
+        os.makedirs(root, exist_ok=True)
+
+    def _collection(self, name: str) -> _Collection:
+        with self._lock:
+            collection = self._open.get(name)
+            if collection is None:
+                path = os.path.join(self.root, name)
+                if not os.path.exists(os.path.join(path, "config.json")):
+                    raise CollectionNotFound(name)
+                collection = self._open[name] = _Collection(path)
+            return collection
+
+    # ── Collections ──────────────────────────────────────
+
+    def get_collections(self):
+        names = sorted(d for d in os.listdir(self.root) if os.path.exists(os.path.join(self.root, d, "config.json")))
+        return SimpleNamespace(collections=[SimpleNamespace(name=n) for n in names])
+
+    def get_collection(self, name: str):
+        collection = self._collection(name)
+        sparse = {n: SimpleNamespace(name=n) for n in collection.config.get("sparse_vectors", [])}
+        return SimpleNamespace(
+            points_count=collection.live_rows(),
+            config=SimpleNamespace(params=SimpleNamespace(
+                vectors=SimpleNamespace(size=collection.dim), sparse_vectors=sparse or None)),
+        )
+
+    def create_collection(self, collection_name: str, vectors_config: Any, sparse_vectors_config: Any = None, **_):
+        path = os.path.join(self.root, collection_name)
+        if os.path.exists(os.path.join(path, "config.json")):
+            raise ValueError(f"Collection {collection_name} already exists")
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, "config.json"), "w", encoding="utf-8") as f:
+            json.dump({"size": vectors_config.size, "sparse_vectors": sorted(sparse_vectors_config or {})}, f)
+        return True
+
+    def update_collection(self, collection_name: str, sparse_vectors_config: Any = None, **_):
+        collection = self._collection(collection_name)
+        with collection.lock:
+            names = set(collection.config.get("sparse_vectors", [])) | set(sparse_vectors_config or {})
+            collection.config["sparse_vectors"] = sorted(names)
+            with open(os.path.join(collection.path, "config.json"), "w", encoding="utf-8") as f:
+                json.dump(collection.config, f)
+        return True
+
+    def delete_collection(self, collection_name: str, **_):
+        with self._lock:
+            collection = self._open.pop(collection_name, None)
+        if collection:
+            collection.close()
+        path = os.path.join(self.root, collection_name)
+        if not os.path.isdir(path):
+            return False
+        shutil.rmtree(path)
+        return True
+
+    def create_payload_index(self, collection_name: str, field_name: str, field_schema: Any = None, **_):
+        # agent_id is always kept as an array; other fields are matched by scanning payloads
+        self._collection(collection_name)
+        return True
+
+    # ── Points ───────────────────────────────────────────
+
+    def upsert(self, collection_name: str, points: List[Any], **_):
+        self._collection(collection_name).upsert(points)
+        return True
+
+    def update_vectors(self, collection_name: str, points: List[Any], **_):
+        self._collection(collection_name).update_vectors(points)
+        return True
+
+    def delete(self, collection_name: str, points_selector: Any, **_):
+        self._collection(collection_name).delete(points_selector)
+        return True
+
+    def retrieve(self, collection_name: str, ids: List[Any], with_payload: Any = True, with_vectors: Any = False, **_):
+        collection = self._collection(collection_name)
+        with collection.lock:
+            rows = [collection.ids.get(str(pid)) for pid in ids]
+            return [collection.record(row, with_payload, with_vectors) for row in rows if row is not None]
+
+    def scroll(self, collection_name: str, scroll_filter: Any = None, limit: int = 10, offset: Any = None,
+               with_payload: Any = True, with_vectors: Any = False, **_):
+        """Points in row order; the returned offset is the next row to read (None when done)."""
+        collection = self._collection(collection_name)
+        with collection.lock:
+            rows = np.flatnonzero(collection.mask(scroll_filter))
+            rows = rows[rows >= int(offset or 0)]
+            page = rows[:limit]
+            next_offset = int(rows[limit]) if len(rows) > limit else None
+            return [collection.record(int(row), with_payload, with_vectors) for row in page], next_offset
+
+    def query_points(self, collection_name: str, query: Any = None, query_filter: Any = None, limit: int = 10,
+                     prefetch: Any = None, using: Optional[str] = None, with_payload: Any = True,
+                     with_vectors: Any = False, **_):
+        """Dense or sparse query, or RRF over prefetches when `query` is a FusionQuery."""
+        collection = self._collection(collection_name)
+        with collection.lock:
+            if prefetch:
+                fused: Dict[int, float] = {}
+                for p in (prefetch if isinstance(prefetch, list) else [prefetch]):
+                    mask = collection.mask(getattr(p, "filter", None))
+                    hits = collection.search(p.query, getattr(p, "using", None), mask, getattr(p, "limit", None) or limit)
+                    for rank, (row, _) in enumerate(hits):
+                        fused[row] = fused.get(row, 0.0) + 1.0 / (RRF_K + rank + 1)
+                hits = sorted(fused.items(), key=lambda item: item[1], reverse=True)[:limit]
+            else:
+                hits = collection.search(query, using, collection.mask(query_filter), limit)
+            return SimpleNamespace(points=[collection.record(row, with_payload, with_vectors, score)
+                                           for row, score in hits])
+
+    def close(self):
+        with self._lock:
+            for collection in self._open.values():
+                collection.close()
+            self._open.clear()
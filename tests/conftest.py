@@ -0,0 +1,19 @@
+import importlib.util
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+@pytest.fixture(scope="session")
+def admin_api(tmp_path_factory):
+    """admin-api.py loaded as a module (its file name isn't importable), installed into a temp dir."""
+    install_dir = tmp_path_factory.mktemp("koalaclaw")
+    os.environ["KOALACLAW_INSTALL_DIR"] = str(install_dir)
+    spec = importlib.util.spec_from_file_location("admin_api", os.path.join(ROOT, "admin-api.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
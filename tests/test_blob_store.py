@@ -0,0 +1,50 @@
+import base64
+
+import pytest
+
+import blob_store
+
+PNG = b"\x89PNG\r\n\x1a\n" + bytes(range(100))
+
+
+def test_put_is_content_addressed(tmp_path):
+    store = blob_store.BlobStore(str(tmp_path))
+    digest = store.put(PNG)
+    assert store.put(PNG) == digest
+    f, size, mime = store.open(digest)
+    with f:
+        assert f.read() == PNG
+    assert (size, mime) == (len(PNG), "image/png")
+    assert store.open("0" * 64) is None
+    assert store.path("../etc/passwd") is None
+
+
+def test_data_url_round_trip(tmp_path):
+    store = blob_store.BlobStore(str(tmp_path))
+    url = "data:image/png;base64," + base64.b64encode(PNG).decode()
+    digest, mime, size = store.put_data_url(url)
+    assert (mime, size) == ("image/png", len(PNG))
+    assert store.to_data_url(digest) == url
+    with pytest.raises(ValueError):
+        blob_store.decode_data_url("data:text/plain,hello")
+
+
+@pytest.mark.parametrize("header,expected", [
+    ("bytes=0-9", (0, 9)),
+    ("bytes=10-", (10, 107)),
+    ("bytes=-8", (100, 107)),
+    ("bytes=100-500", (100, 107)),
+    ("bytes=-500", (0, 107)),
+    ("", None),
+    ("bytes=0-1,5-6", None),
+    ("items=0-1", None),
+    ("bytes=abc-def", None),
+])
+def test_parse_range(header, expected):
+    assert blob_store.parse_range(header, 108) == expected
+
+
+@pytest.mark.parametrize("header", ["bytes=108-", "bytes=5-2", "bytes=-0"])
+def test_parse_range_unsatisfiable(header):
+    with pytest.raises(ValueError):
+        blob_store.parse_range(header, 108)
@@ -0,0 +1,13 @@
+def test_broadcast_skips_malformed_agent_ids(admin_api, monkeypatch):
+    monkeypatch.setattr(admin_api, "load_state", lambda: {"AGENT_COUNT": "3"})
+    monkeypatch.setattr(admin_api, "_exec_agent_message", lambda aid, message, **kw: f"hi from {aid}")
+    handler = admin_api.AdminAPIHandler.__new__(admin_api.AdminAPIHandler)
+    handler.headers = {}
+    sent = []
+    handler._json_response = lambda payload, *args: sent.append(payload)
+
+    handler._broadcast({"message": "hello", "agent_ids": [1, "two", None, "3", 9]})
+
+    result = sent[0]
+    assert [r["agent_id"] for r in result["results"]] == [1, 3]
+    assert result["invalid_agent_ids"] == ["two", None]
@@ -0,0 +1,80 @@
+import threading
+import time
+
+import pytest
+
+
+def _job(index, agent_id, depends_on=()):
+    return {"index": index, "agent_id": agent_id, "task": f"task {index}", "depends_on": list(depends_on),
+            "info": {"name": f"A{agent_id}", "emoji": "", "role_title": "role"}}
+
+
+@pytest.fixture
+def handler(admin_api, monkeypatch):
+    monkeypatch.setattr(admin_api, "ORCH_PARALLELISM", 4)
+    monkeypatch.setattr(admin_api, "append_chat_history", lambda *args, **kwargs: None)
+    handler = admin_api.AdminAPIHandler.__new__(admin_api.AdminAPIHandler)
+    handler.events = []
+    handler._sse_send = lambda event, data: handler.events.append((event, data))
+    handler._sse_ping = lambda: None
+    return handler
+
+
+def test_dependent_jobs_start_after_their_dependencies(admin_api, monkeypatch, handler):
+    log, tasks = [], {}
+    lock = threading.Lock()
+    independent_started = threading.Event()
+
+    def fake_exec(agent_id, message, timeout=120, cancel=None):
+        with lock:
+            log.append(("start", agent_id))
+            tasks[agent_id] = message
+        if agent_id == 3:
+            independent_started.set()
+        if agent_id == 1:
+            assert independent_started.wait(5)  # agent 3 doesn't wait for agent 1
+        time.sleep(0.02)
+        with lock:
+            log.append(("end", agent_id))
+        return f"reply from {agent_id}"
+
+    monkeypatch.setattr(admin_api, "_exec_agent_message", fake_exec)
+    chain = handler._run_delegations([_job(0, 1), _job(1, 2, depends_on=[1]), _job(2, 3)], orch_id=9)
+
+    assert [step["agent_id"] for step in chain] == [1, 2, 3]
+    assert log.index(("start", 2)) > log.index(("end", 1))
+    assert log.index(("start", 3)) < log.index(("end", 1))  # independent jobs run in parallel
+    assert "Context from A1:\nreply from 1" in tasks[2]
+    assert "Context from" not in tasks[3]
+
+
+def test_dependency_cycle_runs_the_remaining_jobs(admin_api, monkeypatch, handler):
+    monkeypatch.setattr(admin_api, "_exec_agent_message", lambda agent_id, message, *args: f"reply from {agent_id}")
+    chain = handler._run_delegations([_job(0, 1, depends_on=[2]), _job(1, 2, depends_on=[1])], orch_id=9)
+    assert [step["response"] for step in chain] == ["reply from 1", "reply from 2"]
+
+
+def test_disconnect_cancels_running_jobs_and_drops_pending_ones(admin_api, monkeypatch, handler):
+    started, running, cancelled = [], threading.Event(), threading.Event()
+
+    def fake_exec(agent_id, message, timeout=120, cancel=None):
+        started.append(agent_id)
+        if agent_id == 1:
+            running.wait(5)  # finish (and hit the dead client) while agent 2 is mid-exec
+        if agent_id == 2:
+            running.set()
+            if cancel.wait(5):
+                cancelled.set()
+                raise admin_api.ExecCancelled("Cancelled")
+        return "ok"
+
+    def send(event, data):
+        if event == "agent_done":
+            raise BrokenPipeError
+    handler._sse_send = send
+    monkeypatch.setattr(admin_api, "_exec_agent_message", fake_exec)
+
+    with pytest.raises(BrokenPipeError):
+        handler._run_delegations([_job(0, 1), _job(1, 2), _job(2, 3, depends_on=[1, 2])], orch_id=9)
+    assert cancelled.wait(5)
+    assert 3 not in started
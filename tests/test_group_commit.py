@@ -0,0 +1,107 @@
+import json
+import os
+import threading
+import time
+
+import pytest
+
+import history_store
+
+
+def _entry(writer, i):
+    return {"role": "user", "content": f"{writer}-{i}" + "x" * (i * 37 % 500), "timestamp": "2026-01-01T00:00:00Z"}
+
+
+@pytest.mark.parametrize("cls", [history_store.SegmentedHistory, history_store.SqliteHistory])
+def test_concurrent_appends_get_unique_ordered_seqs(tmp_path, cls):
+    store = cls(str(tmp_path / "koala-agent-1"))
+    os.makedirs(store.agent_dir, exist_ok=True)
+    barrier = threading.Barrier(8)
+    got = {}
+
+    def writer(w):
+        barrier.wait()
+        seqs = []
+        for i in range(0, 60, 3):
+            seqs += store.append_many([(_entry(w, j), None) for j in range(i, i + 3)])
+        got[w] = seqs
+
+    threads = [threading.Thread(target=writer, args=(w,)) for w in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert sorted(seq for seqs in got.values() for seq in seqs) == list(range(480))
+    for seqs in got.values():
+        assert seqs == sorted(seqs)
+        # One append_many call is committed as one contiguous run
+        assert all(seqs[k + 2] - seqs[k] == 2 for k in range(0, len(seqs), 3))
+    by_seq = dict(store.page(after=-1, limit=1000))
+    for w, seqs in got.items():
+        assert [by_seq[seq]["content"].split("x")[0] for seq in seqs] == [f"{w}-{i}" for i in range(60)]
+    store.close()
+
+
+def test_segment_lines_never_interleave(tmp_path):
+    store = history_store.SegmentedHistory(str(tmp_path))
+    threads = [threading.Thread(target=lambda w=w: [store.append(_entry(w, i)) for i in range(50)]) for w in range(6)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    store.close()
+    with open(os.path.join(tmp_path, "history", "seg-000001.jsonl"), "rb") as f:
+        lines = f.read().splitlines()
+    assert len(lines) == 300
+    assert all(json.loads(line)["role"] == "user" for line in lines)
+
+
+def test_followers_queued_behind_the_leader_commit_together(tmp_path):
+    store = history_store.SegmentedHistory(str(tmp_path))
+    store.append(_entry(0, 0))  # load the store before timing anything
+    entered, release = threading.Event(), threading.Event()
+    commit = store._commit_batch
+
+    def slow_commit(batch):
+        entered.set()
+        release.wait(5)
+        commit(batch)
+
+    store._commit_batch = slow_commit
+    leader = threading.Thread(target=store.append, args=(_entry(1, 0),))
+    leader.start()
+    assert entered.wait(5)
+    entered.clear()
+    followers = [threading.Thread(target=store.append, args=(_entry(2, i),)) for i in range(5)]
+    for t in followers:
+        t.start()
+    while len(store._pending) < 5:
+        time.sleep(0.005)
+    release.set()
+    for t in [leader] + followers:
+        t.join()
+
+    stats = store.commit_stats()
+    assert (stats["appends"], stats["group_commits"], stats["max_batch"]) == (7, 3, 5)
+
+
+def test_commit_errors_reach_the_caller_and_the_store_recovers(tmp_path):
+    store = history_store.SegmentedHistory(str(tmp_path))
+    commit = store._commit_batch
+    calls = []
+
+    def failing_once(batch):
+        if not calls:
+            calls.append(batch)
+            raise OSError("disk full")
+        commit(batch)
+
+    store._commit_batch = failing_once
+    committed = []
+    with pytest.raises(OSError, match="disk full"):
+        store.append_many([(_entry(0, 0), None)], on_commit=lambda *args: committed.append(args))
+    assert committed == []
+    assert store.append_many([(_entry(0, 1), None)], on_commit=lambda seq, entry, line: committed.append(seq)) == [0]
+    assert committed == [0]
+    assert not store._committing
@@ -0,0 +1,87 @@
+import threading
+
+
+def _loader(entries):
+    def load(n):
+        return entries[-n:] if n else list(entries)
+    return load
+
+
+def _history(n):
+    return [(seq, {"role": "user", "content": str(seq)}) for seq in range(n)]
+
+
+def test_get_serves_small_reads_from_the_ring(admin_api):
+    cache = admin_api._HistoryCache(ring_size=50, max_bytes=10 ** 7)
+    entries = _history(30)
+    assert cache.get(1, 10, _loader(entries)) == entries[-10:]
+    assert cache.get(1, 100, lambda n: []) == entries  # complete ring: no disk read
+    assert cache.stats()["hits"] == 1
+
+
+def test_limit_larger_than_ring_does_not_mark_ring_complete(admin_api):
+    cache = admin_api._HistoryCache(ring_size=200, max_bytes=10 ** 7)
+    entries = _history(300)
+    load = _loader(entries)
+    assert len(cache.get(1, 500, load)) == 300
+    assert cache.get(1, 300, load) == entries
+    assert cache.get(1, 150, load) == entries[-150:]
+
+
+def test_after_falls_back_when_cursor_precedes_ring(admin_api):
+    cache = admin_api._HistoryCache(ring_size=200, max_bytes=10 ** 7)
+    entries = _history(300)
+    cache.get(1, 500, _loader(entries))
+    assert cache.after(1, -1, 10) is None
+    assert cache.after(1, 50, 10) is None
+    assert cache.after(1, 99, 3) == entries[100:103]
+    assert cache.after(1, 299, 10) == []
+
+
+def test_after_on_complete_ring(admin_api):
+    cache = admin_api._HistoryCache(ring_size=50, max_bytes=10 ** 7)
+    entries = _history(20)
+    cache.get(1, 10, _loader(entries))
+    assert cache.after(1, -1, 5) == entries[:5]
+
+
+def test_append_keeps_ring_current(admin_api):
+    cache = admin_api._HistoryCache(ring_size=3, max_bytes=10 ** 7)
+    entries = _history(2)
+    cache.get(1, 2, _loader(entries))
+    for seq in (2, 3):
+        cache.append(1, seq, {"content": str(seq)}, 10)
+    assert [seq for seq, _ in cache.get(1, 3, lambda n: [])] == [1, 2, 3]
+    # Oldest entry evicted: the ring no longer covers the start
+    assert cache.after(1, -1, 10) is None
+    assert [seq for seq, _ in cache.after(1, 1, 10)] == [2, 3]
+
+
+def test_read_chat_page_after_returns_oldest_entries(admin_api, monkeypatch):
+    monkeypatch.setattr(admin_api, "_history_cache", admin_api._HistoryCache(ring_size=200, max_bytes=10 ** 7))
+    entries = [{"role": "user", "content": str(i), "timestamp": "2026-01-01T00:00:00Z"} for i in range(300)]
+    admin_api.append_history_entries(7, entries)
+    assert len(admin_api.read_chat_history(7, limit=500)) == 300
+    assert len(admin_api.read_chat_history(7, limit=300)) == 300
+    page = admin_api.read_chat_page(7, after=-1, limit=5)
+    assert [e["content"] for _, e in page] == ["0", "1", "2", "3", "4"]
+
+
+def test_concurrent_appends_reach_the_ring_in_seq_order(admin_api, monkeypatch):
+    cache = admin_api._HistoryCache(ring_size=500, max_bytes=10 ** 7)
+    monkeypatch.setattr(admin_api, "_history_cache", cache)
+    assert admin_api.read_chat_history(8, limit=10) == []  # warms an empty, complete ring
+    barrier = threading.Barrier(8)
+
+    def writer(w):
+        barrier.wait()
+        for i in range(25):
+            admin_api.append_history_entries(8, [{"role": "user", "content": f"{w}-{i}",
+                                                  "timestamp": "2026-01-01T00:00:00Z"}])
+
+    threads = [threading.Thread(target=writer, args=(w,)) for w in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert [seq for seq, _ in cache.after(8, -1, 1000)] == list(range(200))
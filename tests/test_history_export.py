@@ -0,0 +1,24 @@
+import io
+import json
+
+
+class _FailingStore:
+    def iter_range(self, since="", until=""):
+        yield 0, {"role": "user", "content": "hi", "timestamp": "2026-01-01T00:00:00Z"}
+        raise FileNotFoundError("seg-000001.jsonl")
+
+
+def test_export_ends_with_an_error_line_when_the_store_fails(admin_api, monkeypatch):
+    monkeypatch.setattr(admin_api, "get_history_store", lambda agent_id: _FailingStore())
+    handler = admin_api.AdminAPIHandler.__new__(admin_api.AdminAPIHandler)
+    handler.wfile = io.BytesIO()
+    handler.send_response = lambda *args: None
+    handler.send_header = lambda *args: None
+    handler.end_headers = lambda: None
+
+    handler._history_export({"agent": ["1"]})
+
+    lines = [json.loads(line) for line in handler.wfile.getvalue().decode().splitlines()]
+    assert lines[0]["content"] == "hi"
+    assert lines[-1]["exported"] == 1
+    assert "seg-000001.jsonl" in lines[-1]["error"]
@@ -0,0 +1,89 @@
+import threading
+
+import history_store
+
+
+def _entry(ts, content=""):
+    return {"role": "user", "content": content or ts, "timestamp": ts}
+
+
+def _store(tmp_path, timestamps):
+    store = history_store.SegmentedHistory(str(tmp_path))
+    store.append_many([(_entry(ts), None) for ts in timestamps])
+    return store
+
+
+def test_iter_range_filters_by_timestamp(tmp_path):
+    store = _store(tmp_path, [f"2026-01-0{d}T12:00:00Z" for d in range(1, 6)])
+    got = [e["timestamp"] for _, e in store.iter_range("2026-01-02", "2026-01-04T00:00:00Z")]
+    assert got == ["2026-01-02T12:00:00Z", "2026-01-03T12:00:00Z"]
+
+
+def test_iter_range_date_only_until_includes_the_day(tmp_path):
+    store = _store(tmp_path, ["2026-01-01T08:00:00Z", "2026-01-01T23:30:00Z", "2026-01-02T00:00:01Z"])
+    got = [e["timestamp"] for _, e in store.iter_range(until="2026-01-01")]
+    assert got == ["2026-01-01T08:00:00Z", "2026-01-01T23:30:00Z"]
+
+
+def test_iter_range_finds_out_of_order_imported_entries(tmp_path):
+    store = _store(tmp_path, ["2026-03-01T10:00:00Z", "2026-03-01T11:00:00Z"])
+    # An import appends older entries after newer ones
+    store.append_many([(_entry("2026-01-15T09:00:00Z", "imported"), None),
+                       (_entry("2026-03-01T10:30:00Z", "imported late"), None)])
+    got = [e["content"] for _, e in store.iter_range("2026-01-01", "2026-01-31")]
+    assert got == ["imported"]
+    got = [e["timestamp"] for _, e in store.iter_range("2026-03-01T10:15:00Z", "2026-03-01T10:45:00Z")]
+    assert got == ["2026-03-01T10:30:00Z"]
+
+
+def test_iter_range_survives_reopen(tmp_path):
+    _store(tmp_path, ["2026-03-01T10:00:00Z", "2026-01-15T09:00:00Z"]).close()
+    store = history_store.SegmentedHistory(str(tmp_path))
+    assert [e["timestamp"] for _, e in store.iter_range(until="2026-01-31")] == ["2026-01-15T09:00:00Z"]
+
+
+def test_iter_segment_follows_a_compression_that_finished_meanwhile(tmp_path):
+    store = _store(tmp_path, ["2026-01-15T09:00:00Z", "2026-03-01T10:00:00Z"])
+    history_store._compressor.wait()
+    # A snapshot taken before the plain file was replaced by the compressed one
+    stale = dict(store._snapshot()[0], codec=None)
+    assert [e["timestamp"] for _, e in store._iter_segment(stale)] == ["2026-01-15T09:00:00Z"]
+    assert store._snapshot()[0]["codec"] == history_store.CODEC
+
+
+def test_page_after_and_before(tmp_path):
+    store = _store(tmp_path, [f"2026-01-01T00:{m:02d}:00Z" for m in range(50)])
+    after = store.page(after=9, limit=5)
+    assert [seq for seq, _ in after] == [10, 11, 12, 13, 14]
+    assert after[0][1]["timestamp"] == "2026-01-01T00:10:00Z"
+    assert [seq for seq, _ in store.page(after=-1, limit=3)] == [0, 1, 2]
+    assert [seq for seq, _ in store.page(before=10, limit=4)] == [6, 7, 8, 9]
+    assert [seq for seq, _ in store.page(before=2, limit=10)] == [0, 1]
+    assert store.page(after=49, limit=10) == []
+
+
+def test_page_crosses_segments(tmp_path):
+    # Daily rotation puts each day in its own segment
+    store = _store(tmp_path, [f"2026-01-0{d}T00:00:0{i}Z" for d in range(1, 4) for i in range(3)])
+    assert len(store._snapshot()) >= 3
+    assert [seq for seq, _ in store.page(after=1, limit=5)] == [2, 3, 4, 5, 6]
+    assert [seq for seq, _ in store.page(before=7, limit=5)] == [2, 3, 4, 5, 6]
+    assert [seq for seq, _ in store.tail(4)] == [5, 6, 7, 8]
+
+
+def test_sqlite_database_opened_once_under_concurrency(tmp_path):
+    path = str(tmp_path / "history.db")
+    results = []
+    barrier = threading.Barrier(8)
+
+    def worker():
+        barrier.wait()
+        results.append(history_store._open_database(path))
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len({id(db[0]) for db in results}) == 1
+    assert len({id(db[1]) for db in results}) == 1
@@ -0,0 +1,23 @@
+import pytest
+
+import intent_router
+
+
+@pytest.mark.parametrize("message", [
+    "animate this image",
+    "make it a video",
+    "Animate the cat",
+    "bunu videoya çevir",
+    "fotoğrafı hareketlendir",
+])
+def test_follow_ups_about_earlier_media_skip_the_fast_route(message):
+    assert intent_router.refers_to_media(message)
+    assert intent_router.route(message, [], has_media=True) is None
+
+
+@pytest.mark.parametrize("message", [
+    "generate a video of waves crashing on a beach",
+    "bir kedi görseli oluştur",
+])
+def test_new_generation_requests_are_not_media_references(message):
+    assert not intent_router.refers_to_media(message)
@@ -0,0 +1,59 @@
+from types import SimpleNamespace as NS
+
+import pytest
+
+np = pytest.importorskip("numpy")
+import local_vector_index  # noqa: E402  (needs numpy)
+
+
+def _agent(agent_id):
+    return NS(must=[NS(key="agent_id", match=NS(value=agent_id))])
+
+
+@pytest.fixture
+def index(tmp_path):
+    idx = local_vector_index.LocalVectorIndex(str(tmp_path))
+    idx.create_collection("docs", NS(size=3), sparse_vectors_config={"text": None})
+    idx.upsert("docs", [
+        NS(id="a", vector={"": [1, 0, 0], "text": NS(indices=[1], values=[1.0])}, payload={"agent_id": 1, "n": "a"}),
+        NS(id="b", vector={"": [0.9, 0.1, 0], "text": NS(indices=[2], values=[1.0])}, payload={"agent_id": 1, "n": "b"}),
+        NS(id="c", vector={"": [0, 1, 0], "text": NS(indices=[2], values=[1.0])}, payload={"agent_id": 1, "n": "c"}),
+        NS(id="d", vector={"": [1, 0, 0], "text": NS(indices=[2], values=[1.0])}, payload={"agent_id": 2, "n": "d"}),
+    ])
+    yield idx
+    idx.close()
+
+
+def test_dense_query_is_cosine_and_filtered(index):
+    points = index.query_points("docs", query=[2, 0, 0], query_filter=_agent(1), limit=2).points
+    assert [p.id for p in points] == ["a", "b"]
+    assert points[0].score == pytest.approx(1.0)
+
+
+def test_sparse_query(index):
+    points = index.query_points("docs", query=NS(indices=[2], values=[1.0]), using="text",
+                                query_filter=_agent(1), limit=5).points
+    assert {p.id for p in points} == {"b", "c"}
+
+
+def test_rrf_fusion_prefers_points_ranked_by_both(index):
+    prefetch = [
+        NS(query=[1, 0, 0], using=None, filter=_agent(1), limit=3),
+        NS(query=NS(indices=[2], values=[1.0]), using="text", filter=_agent(1), limit=3),
+    ]
+    points = index.query_points("docs", prefetch=prefetch, query=NS(fusion="rrf"), limit=3).points
+    # b is 2nd by dense and matches the keyword; a is 1st by dense only; c matches the keyword only
+    assert [p.id for p in points][0] == "b"
+    rank = lambda r: 1.0 / (local_vector_index.RRF_K + r)
+    assert points[0].score == pytest.approx(rank(2) + rank(1))
+
+
+def test_delete_scroll_and_reopen(index, tmp_path):
+    index.delete("docs", NS(must=[NS(key="n", match=NS(value="c"))]))
+    records, offset = index.scroll("docs", limit=10)
+    assert offset is None and [r.id for r in records] == ["a", "b", "d"]
+    index.close()
+    reopened = local_vector_index.LocalVectorIndex(str(tmp_path))
+    assert reopened.get_collection("docs").points_count == 3
+    assert reopened.retrieve("docs", ["b"], with_vectors=True)[0].vector == pytest.approx(
+        list(np.array([0.9, 0.1, 0]) / np.linalg.norm([0.9, 0.1, 0])))
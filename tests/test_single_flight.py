@@ -0,0 +1,107 @@
+import threading
+import time
+
+
+def _wait_for(predicate, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.005)
+
+
+def _run(flight, key, fn, results, **kwargs):
+    def call():
+        try:
+            results.append(flight.do(key, fn, **kwargs))
+        except BaseException as e:
+            results.append(e)
+    thread = threading.Thread(target=call)
+    thread.start()
+    return thread
+
+
+def test_concurrent_identical_calls_run_once(admin_api):
+    flight = admin_api._SingleFlight()
+    release = threading.Event()
+    runs = []
+
+    def fn():
+        runs.append(1)
+        release.wait(5)
+        return "answer"
+
+    results = []
+    threads = [_run(flight, "k", fn, results)]
+    _wait_for(lambda: flight.stats()["in_flight"] == 1)
+    threads += [_run(flight, "k", fn, results) for _ in range(4)]
+    _wait_for(lambda: flight.stats()["coalesced"] == 4)
+    release.set()
+    for t in threads:
+        t.join()
+
+    assert results == ["answer"] * 5
+    assert len(runs) == 1
+    stats = flight.stats()
+    assert (stats["calls"], stats["executed"], stats["coalesced"], stats["in_flight"]) == (5, 1, 4, 0)
+
+
+def test_followers_share_the_leaders_error(admin_api):
+    flight = admin_api._SingleFlight()
+    release = threading.Event()
+
+    def fn():
+        release.wait(5)
+        raise RuntimeError("agent down")
+
+    results = []
+    threads = [_run(flight, "k", fn, results)]
+    _wait_for(lambda: flight.stats()["in_flight"] == 1)
+    threads.append(_run(flight, "k", fn, results))
+    _wait_for(lambda: flight.stats()["coalesced"] == 1)
+    release.set()
+    for t in threads:
+        t.join()
+
+    assert [str(r) for r in results] == ["agent down", "agent down"]
+    assert flight.stats()["executed"] == 1
+
+
+def test_follower_reruns_after_the_leader_is_cancelled(admin_api):
+    flight = admin_api._SingleFlight()
+    release = threading.Event()
+    runs = []
+
+    def fn():
+        runs.append(1)
+        if len(runs) == 1:
+            release.wait(5)
+            raise admin_api.ExecCancelled("Cancelled")  # the leader's client went away
+        return "answer"
+
+    leader_results, follower_results = [], []
+    leader = _run(flight, "k", fn, leader_results, cancel=threading.Event())
+    _wait_for(lambda: flight.stats()["in_flight"] == 1)
+    follower = _run(flight, "k", fn, follower_results, cancel=threading.Event())
+    _wait_for(lambda: flight.stats()["coalesced"] == 1)
+    release.set()
+    leader.join()
+    follower.join()
+
+    assert isinstance(leader_results[0], admin_api.ExecCancelled)
+    assert follower_results == ["answer"]
+    assert len(runs) == 2
+    assert flight.stats()["executed"] == 2
+
+
+def test_recent_results_are_reused(admin_api):
+    flight = admin_api._SingleFlight(reuse_seconds=60)
+    runs = []
+
+    def fn():
+        runs.append(1)
+        return len(runs)
+
+    assert flight.do("k", fn) == 1
+    assert flight.do("k", fn) == 1
+    assert flight.do("other", fn) == 2
+    assert flight.stats()["reused"] == 1
@@ -47,7 +47,8 @@ class ChatManager {
             if (data && data.history && data.history.length > 0) {
                 data.history.forEach(msg => {
                     if (msg.role === 'user') {
-                        this._appendUserBubble(msg.content, msg.timestamp, true, msg.image_base64);
+                        const image = msg.image_blob ? `${API_BASE}/blobs/${msg.image_blob}` : msg.image_base64;
+                        this._appendUserBubble(msg.content, msg.timestamp, true, image);
                     } else if (msg.role === 'assistant') {
                         this._appendRestoredAssistantBubble(msg.content, msg.timestamp);
                     }
@@ -455,7 +456,9 @@ class ChatManager {
             ? new Date(timestamp).toLocaleTimeString([], { hour: '2-digit', minute: '2-digit' })
             : this._timeStr();
 
-        const safeDataUrl = (imageBase64 && String(imageBase64).startsWith('data:image/')) ? imageBase64 : '';
+        const imageSrc = imageBase64 ? String(imageBase64) : '';
+        const isBlobUrl = imageSrc.startsWith(API_BASE) && /^\/blobs\/[0-9a-f]{64}$/.test(imageSrc.slice(API_BASE.length));
+        const safeDataUrl = (imageSrc.startsWith('data:image/') || isBlobUrl) ? imageSrc : '';
         const imgHtml = safeDataUrl
             ? `<div class="chat-image-wrap"><img class="chat-image" src="${safeDataUrl.replace(/"/g, '&quot;')}" alt="Attached"></div>`
             : '';
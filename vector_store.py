@@ -6,94 +6,848 @@ Each agent gets two collections:
   - agent_{id}_chat  — chat history (semantic search over conversations)
   - agent_{id}_docs  — uploaded documents (RAG)
 
+With VECTOR_LAYOUT=shared, all agents share one chat and one docs
+collection instead (koalaclaw_chat / koalaclaw_docs), with payload indexes
+on agent_id and filename; every query is filtered by agent_id. Existing
+per-agent collections are copied over with:
+  python3 vector_store.py migrate-shared [--delete-old]
+
 Qdrant runs on the Docker network at 172.30.0.200:6333.
-Falls back to localhost:6333 for development.
+Falls back to localhost:6333 for development. VECTOR_BACKEND=local uses the
+embedded index in local_vector_index.py instead (no Qdrant server), and
+VECTOR_BACKEND=auto uses it only when Qdrant is unreachable; points written
+there can be copied into Qdrant later with:
+  python3 vector_store.py import-local
 """
 
 import hashlib
+import io
 import json
+import mmap
 import os
+import re
 import sys
+import threading
+from array import array
 import time
 import uuid
-from typing import Any, Dict, List, Optional
+import zlib
+from collections import OrderedDict, deque
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 
 QDRANT_HOST = os.environ.get("QDRANT_HOST", "172.30.0.200")
 QDRANT_PORT = int(os.environ.get("QDRANT_PORT", "6333"))
+QDRANT_TIMEOUT = float(os.environ.get("QDRANT_TIMEOUT", "5"))
+# gRPC transport (lower per-call overhead than REST); needs the grpc extra of qdrant-client
+QDRANT_GRPC = os.environ.get("QDRANT_GRPC", "0") == "1"
+QDRANT_GRPC_PORT = int(os.environ.get("QDRANT_GRPC_PORT", "6334"))
+# Circuit breaker: open after N consecutive connection failures, probe again after a
+# backoff that doubles on every failed probe (up to the max), close on the first success
+BREAKER_FAILURES = int(os.environ.get("VECTOR_BREAKER_FAILURES", "3"))
+BREAKER_BACKOFF = float(os.environ.get("VECTOR_BREAKER_BACKOFF", "2"))
+BREAKER_BACKOFF_MAX = float(os.environ.get("VECTOR_BREAKER_BACKOFF_MAX", "60"))
+# qdrant | local (embedded index, no server) | auto (local only if Qdrant is unreachable;
+# the choice then sticks for the life of the process)
+VECTOR_BACKEND = os.environ.get("VECTOR_BACKEND", "qdrant")
+LOCAL_INDEX_DIR = os.environ.get(
+    "VECTOR_LOCAL_DIR", os.path.join(os.environ.get("KOALACLAW_INSTALL_DIR", "/opt/koalaclaw"), "data", "vectors"))
 EMBEDDING_MODEL = "BAAI/bge-small-en-v1.5"
 VECTOR_SIZE = 384
 
+VECTOR_LAYOUT = os.environ.get("VECTOR_LAYOUT", "per_agent")  # per_agent | shared
+
+# Hybrid retrieval: a hashed BM25-style sparse vector ("text") next to the dense one, fused with RRF
+HYBRID_ENABLED = os.environ.get("VECTOR_HYBRID", "0") == "1"
+SPARSE_VECTOR_NAME = "text"
+HYBRID_PREFETCH = 4  # each side fetches limit * this before fusion
+SHARED_CHAT_COLLECTION = "koalaclaw_chat"
+SHARED_DOCS_COLLECTION = "koalaclaw_docs"
+
+# Background chat indexing: messages are embedded and upserted in batches
+INDEX_BATCH_SIZE = int(os.environ.get("VECTOR_INDEX_BATCH", "64"))
+INDEX_MAX_WAIT = float(os.environ.get("VECTOR_INDEX_MAX_WAIT_MS", "250")) / 1000
+INDEX_QUEUE_MAX = int(os.environ.get("VECTOR_INDEX_QUEUE_MAX", "10000"))
+
+# Document chunking / ingestion (token counts are estimated as chars / 4)
+CHUNK_TOKENS = int(os.environ.get("VECTOR_CHUNK_TOKENS", "256"))
+CHUNK_OVERLAP_TOKENS = int(os.environ.get("VECTOR_CHUNK_OVERLAP_TOKENS", "40"))
+DOC_BATCH_SIZE = int(os.environ.get("VECTOR_DOC_BATCH", "64"))
+
+# Embedding cache: in-memory LRU (entries) + optional on-disk tier (directory)
+EMBED_CACHE_SIZE = int(os.environ.get("VECTOR_EMBED_CACHE_SIZE", "4096"))
+EMBED_CACHE_DIR = os.environ.get("VECTOR_EMBED_CACHE_DIR", "")
+
+# Search results cached until the agent's collection is written to (or the TTL passes,
+# for writes made by another process, e.g. the migration CLI); 0 disables
+QUERY_CACHE_SIZE = int(os.environ.get("VECTOR_QUERY_CACHE_SIZE", "1024"))
+QUERY_CACHE_TTL = float(os.environ.get("VECTOR_QUERY_CACHE_TTL", "300"))
+
+# Opt-in: load + warm the embedder and connect to Qdrant in the background at startup
+WARMUP_ENABLED = os.environ.get("VECTOR_WARMUP", "0") == "1"
+# Where FastEmbed keeps downloaded models (its default is a temp dir that may not survive reboots)
+MODEL_CACHE_DIR = os.environ.get("VECTOR_MODEL_CACHE_DIR", "")
+
 try:
     from qdrant_client import QdrantClient
-    from qdrant_client.models import Distance, VectorParams, PointStruct, Filter, FieldCondition, MatchValue
+    from qdrant_client.models import (
+        Distance, VectorParams, PointStruct, Filter, FieldCondition, MatchValue, PayloadSchemaType,
+        SparseVectorParams, SparseVector, Modifier, Prefetch, FusionQuery, Fusion, PointVectors,
+    )
     QDRANT_AVAILABLE = True
 except ImportError:
     QDRANT_AVAILABLE = False
 
+# The local backend still uses qdrant_client's model classes, just not its server
+try:
+    import local_vector_index
+except ImportError:
+    local_vector_index = None
+
 _client: Optional[Any] = None
+# VECTOR_BACKEND=auto: served instead of _client while the circuit is open
+_local_client: Optional[Any] = None
 _embedder: Optional[Any] = None
+_embedder_lock = threading.Lock()
+# Collections known to exist; filled when connecting, updated on create/delete
+_collections: set = set()
+# Of those, the ones known to have / lack the sparse vector config (checked once per connection)
+_sparse_collections: set = set()
+_dense_collections: set = set()
+_collections_lock = threading.Lock()
+_readiness: Dict[str, Any] = {"embedder": "cold", "qdrant": "unknown", "warmup": "off", "backend": None}
+
+
+_CONNECTION_ERRORS = {
+    "ResponseHandlingException", "ConnectError", "ConnectTimeout", "ReadTimeout", "WriteTimeout",
+    "PoolTimeout", "TimeoutException", "RemoteProtocolError", "NetworkError",
+}
+
+
+def _is_connection_error(error: Exception) -> bool:
+    """True for transport failures (Qdrant down/unreachable), False for request errors like 404/400."""
+    code = getattr(error, "status_code", None)
+    if code is not None:
+        return code in (502, 503, 504)
+    if hasattr(error, "code") and callable(error.code):
+        return getattr(error.code(), "name", None) in ("UNAVAILABLE", "DEADLINE_EXCEEDED")  # grpc.RpcError
+    while error is not None:
+        if isinstance(error, (ConnectionError, TimeoutError)) or type(error).__name__ in _CONNECTION_ERRORS:
+            return True
+        error = error.__cause__ or error.__context__
+    return False
+
+
+class _CircuitBreaker:
+    """closed → (BREAKER_FAILURES connection errors) → open → (backoff) → half_open → closed/open.
+
+    While open, _get_client() returns None (the local index with
+    VECTOR_BACKEND=auto) immediately; recovery is tested by a background probe
+    thread, so no request ever waits on a dead Qdrant.
+    """
+
+    def __init__(self, failures: int, backoff: float, backoff_max: float):
+        self.threshold = failures
+        self.base_backoff = backoff
+        self.backoff_max = backoff_max
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self._closed.set()
+        self.state = "closed"
+        self._failures = 0
+        self._backoff = backoff
+        self._retry_at = 0.0
+        self._probe: Optional[threading.Thread] = None
+        self._stats = {"opened": 0, "probes": 0, "rejected": 0, "connection_errors": 0}
+
+    def allow(self) -> bool:
+        if self.state == "closed":
+            return True
+        with self._lock:
+            self._stats["rejected"] += 1
+        return False
+
+    def success(self):
+        if self.state == "closed" and not self._failures:
+            return
+        with self._lock:
+            self._failures = 0
+            if self.state != "closed":
+                print("[VECTOR] Qdrant reachable again, circuit closed", file=sys.stderr, flush=True)
+            self.state = "closed"
+            self._backoff = self.base_backoff
+            self._closed.set()
+
+    def failure(self, trip: bool = False):
+        """Record a connection failure; trip=True opens the circuit regardless of the count."""
+        with self._lock:
+            self._stats["connection_errors"] += 1
+            self._failures += 1
+            if self.state == "open" or not (trip or self.state == "half_open" or self._failures >= self.threshold):
+                return
+            if self.state == "closed":
+                self._stats["opened"] += 1
+                print(f"[VECTOR] Qdrant unreachable, circuit open (retry in {self._backoff:g}s)",
+                      file=sys.stderr, flush=True)
+            else:
+                self._backoff = min(self._backoff * 2, self.backoff_max)
+            self.state = "open"
+            _readiness["qdrant"] = "unavailable"
+            self._retry_at = time.time() + self._backoff
+            self._closed.clear()
+            if self._probe is None or not self._probe.is_alive():
+                self._probe = threading.Thread(target=self._run_probe, name="qdrant-probe", daemon=True)
+                self._probe.start()
+
+    def _run_probe(self):
+        while True:
+            with self._lock:
+                if self.state == "closed":
+                    return
+                wait = self._retry_at - time.time()
+                if wait <= 0:
+                    self.state = "half_open"
+                    self._stats["probes"] += 1
+            if wait > 0:
+                time.sleep(min(wait, 1.0))
+                continue
+            if _probe_qdrant():
+                self.success()
+            else:
+                self.failure()
+
+    def wait_closed(self, timeout: Optional[float] = None) -> bool:
+        return self._closed.wait(timeout)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {**self._stats, "state": self.state, "consecutive_failures": self._failures,
+                    "backoff_s": self._backoff,
+                    "retry_in_s": max(0.0, round(self._retry_at - time.time(), 1)) if self.state != "closed" else 0.0,
+                    "transport": "grpc" if QDRANT_GRPC else "rest"}
+
+
+_breaker = _CircuitBreaker(BREAKER_FAILURES, BREAKER_BACKOFF, BREAKER_BACKOFF_MAX)
+_connect_lock = threading.Lock()
+
+
+class _GuardedClient:
+    """QdrantClient wrapper that reports call outcomes to the circuit breaker."""
+
+    def __init__(self, client: Any):
+        self.raw = client
+
+    def __getattr__(self, name: str) -> Any:
+        attr = getattr(self.raw, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            try:
+                result = attr(*args, **kwargs)
+            except Exception as e:
+                if _is_connection_error(e):
+                    _breaker.failure()
+                raise
+            _breaker.success()
+            return result
+        return call
+
+
+def _qdrant_client(host: str) -> Any:
+    if QDRANT_GRPC:
+        return QdrantClient(host=host, port=QDRANT_PORT, grpc_port=QDRANT_GRPC_PORT, prefer_grpc=True,
+                            timeout=int(QDRANT_TIMEOUT))
+    return QdrantClient(host=host, port=QDRANT_PORT, timeout=int(QDRANT_TIMEOUT))
+
+
+def _connect_qdrant() -> Optional[Any]:
+    try:
+        client = _qdrant_client(QDRANT_HOST)
+        _remember_collections(client.get_collections())
+        return client
+    except Exception as e:
+        print(f"[VECTOR] Qdrant connection failed ({QDRANT_HOST}:{QDRANT_PORT}): {e}", file=sys.stderr, flush=True)
+    try:
+        client = _qdrant_client("localhost")
+        _remember_collections(client.get_collections())
+        print("[VECTOR] Connected to Qdrant on localhost", file=sys.stderr, flush=True)
+        return client
+    except Exception:
+        return None
+
+
+def _probe_qdrant() -> bool:
+    """Health check used by the breaker's probe thread; connects first if never connected."""
+    global _client
+    client = _client.raw if isinstance(_client, _GuardedClient) else _connect_qdrant()
+    if client is None:
+        return False
+    try:
+        collections = client.get_collections()
+    except Exception as e:
+        print(f"[VECTOR] Qdrant probe failed: {e}", file=sys.stderr, flush=True)
+        return False
+    with _connect_lock:
+        if not isinstance(_client, _GuardedClient):
+            _client = _GuardedClient(client)
+        # Switch back from the local index (auto mode) atomically with closing the circuit
+        _remember_collections(collections)
+        _readiness["qdrant"] = "connected"
+        _readiness["backend"] = "qdrant"
+        _breaker.success()
+    return True
+
+
+def _open_local_index() -> Optional[Any]:
+    if not local_vector_index:
+        print("[VECTOR] Local vector index unavailable (numpy not installed)", file=sys.stderr, flush=True)
+        return None
+    try:
+        client = local_vector_index.LocalVectorIndex(LOCAL_INDEX_DIR)
+    except OSError as e:
+        print(f"[VECTOR] Local vector index failed ({LOCAL_INDEX_DIR}): {e}", file=sys.stderr, flush=True)
+        return None
+    print(f"[VECTOR] Using local vector index in {LOCAL_INDEX_DIR}", file=sys.stderr, flush=True)
+    return client
 
 
 def _get_client() -> Optional[Any]:
+    """The active client, or None — immediately, without a network call — while the circuit is open.
+
+    With VECTOR_BACKEND=auto the local index is returned while the circuit is
+    open, and Qdrant again once the probe has closed it.
+    """
     global _client
     if not QDRANT_AVAILABLE:
         return None
-    if _client is None:
-        try:
-            _client = QdrantClient(host=QDRANT_HOST, port=QDRANT_PORT, timeout=5)
-            _client.get_collections()
-        except Exception as e:
-            print(f"[VECTOR] Qdrant connection failed ({QDRANT_HOST}:{QDRANT_PORT}): {e}", file=sys.stderr, flush=True)
-            try:
-                _client = QdrantClient(host="localhost", port=QDRANT_PORT, timeout=5)
-                _client.get_collections()
-                print("[VECTOR] Connected to Qdrant on localhost", file=sys.stderr, flush=True)
-            except Exception:
-                _client = None
-    return _client
+    if _client is None and _breaker.allow():
+        with _connect_lock:
+            if _client is None and _breaker.allow():
+                if VECTOR_BACKEND == "local":
+                    _client = _open_local_index()
+                    if _client:
+                        _remember_collections(_client.get_collections())
+                    _readiness["backend"] = "local" if _client else None
+                else:
+                    client = _connect_qdrant()
+                    _readiness["qdrant"] = "connected" if client else "unavailable"
+                    if client:
+                        _client = _GuardedClient(client)
+                        _readiness["backend"] = "qdrant"
+                    else:
+                        # Both hosts already failed: go straight to open and let the probe reconnect
+                        _breaker.failure(trip=True)
+    if _breaker.allow():
+        return _client
+    return _local_fallback() if VECTOR_BACKEND == "auto" else None
+
+
+def _local_fallback() -> Optional[Any]:
+    """auto mode: the local index (opened on first use); the registry follows the switch."""
+    global _local_client
+    with _connect_lock:
+        if _breaker.state == "closed":
+            return _client  # the probe switched back meanwhile
+        if _local_client is None:
+            _local_client = _open_local_index()
+        if _local_client is not None and _readiness["backend"] != "local":
+            _remember_collections(_local_client.get_collections())
+            _readiness["backend"] = "local"
+    return _local_client
+
+
+def connection_stats() -> Dict[str, Any]:
+    return {"backend": _readiness.get("backend"), **_breaker.stats()}
 
 
 def _get_embedder():
     global _embedder
     if _embedder is None:
+        # One loader at a time: a request arriving mid-warm-up waits instead of loading a second copy
+        with _embedder_lock:
+            if _embedder is None:
+                _readiness["embedder"] = "loading"
+                try:
+                    from fastembed import TextEmbedding
+                    kwargs = {"cache_dir": MODEL_CACHE_DIR} if MODEL_CACHE_DIR else {}
+                    _embedder = TextEmbedding(model_name=EMBEDDING_MODEL, **kwargs)
+                    _readiness["embedder"] = "ready"
+                    print(f"[VECTOR] FastEmbed model loaded: {EMBEDDING_MODEL}", file=sys.stderr, flush=True)
+                except Exception as e:
+                    print(f"[VECTOR] FastEmbed init failed: {e}", file=sys.stderr, flush=True)
+                    _readiness["embedder"] = "failed"
+                    _embedder = None
+    return _embedder
+
+
+def warm_up():
+    """Load the embedder, run one inference (ONNX session init) and connect to Qdrant."""
+    started = time.time()
+    _readiness["warmup"] = "running"
+    embedder = _get_embedder()
+    if embedder:
         try:
-            from fastembed import TextEmbedding
-            _embedder = TextEmbedding(model_name=EMBEDDING_MODEL)
-            print(f"[VECTOR] FastEmbed model loaded: {EMBEDDING_MODEL}", file=sys.stderr, flush=True)
+            list(embedder.embed(["warm up"]))  # straight to ONNX, not the embedding cache
         except Exception as e:
-            print(f"[VECTOR] FastEmbed init failed: {e}", file=sys.stderr, flush=True)
-            _embedder = None
-    return _embedder
+            print(f"[VECTOR] Warm-up inference failed: {e}", file=sys.stderr, flush=True)
+    _get_client()
+    _readiness["warmup"] = "done"
+    _readiness["warmup_ms"] = int((time.time() - started) * 1000)
+    print(f"[VECTOR] Warm-up finished in {_readiness['warmup_ms']} ms "
+          f"(embedder {_readiness['embedder']}, qdrant {_readiness['qdrant']})", file=sys.stderr, flush=True)
+
+
+def start_warmup() -> Optional[threading.Thread]:
+    """Run warm_up() in a background thread if VECTOR_WARMUP=1."""
+    if not WARMUP_ENABLED:
+        return None
+    _readiness["warmup"] = "pending"
+    thread = threading.Thread(target=warm_up, name="vector-warmup", daemon=True)
+    thread.start()
+    return thread
+
+
+def readiness() -> Dict[str, Any]:
+    """Embedder/Qdrant state; ready is False only while a warm-up is still in progress."""
+    state = dict(_readiness)
+    state["ready"] = state["warmup"] not in ("pending", "running")
+    state["model"] = EMBEDDING_MODEL
+    return state
+
+
+class _EmbeddingCache:
+    """Vectors keyed by sha256(model, text): LRU in memory, optionally persisted.
+
+    The disk tier is two append-only files per model in `directory`:
+      embeddings-<model>.f32  rows of VECTOR_SIZE float32 values (memory-mapped for reads)
+      embeddings-<model>.idx  one 32-byte key per row, loaded into a dict at startup
+    The vector row is written before its key, so a crash never indexes a partial row.
+    """
+
+    def __init__(self, model: str, capacity: int, directory: str = ""):
+        self.model = model
+        self.capacity = capacity
+        self._lock = threading.Lock()
+        self._memory: "OrderedDict[bytes, array]" = OrderedDict()
+        self._rows: Dict[bytes, int] = {}
+        self._row_bytes = VECTOR_SIZE * 4
+        self._vec_f = self._idx_f = None
+        self._mm = None
+        self._mapped_rows = 0
+        self._stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0}
+        if directory:
+            try:
+                self._open_disk(directory)
+            except OSError as e:
+                print(f"[VECTOR] Embedding disk cache disabled: {e}", file=sys.stderr, flush=True)
+                self._vec_f = self._idx_f = None
+
+    def _open_disk(self, directory: str):
+        os.makedirs(directory, exist_ok=True)
+        base = os.path.join(directory, "embeddings-" + self.model.replace("/", "_"))
+        self._vec_f = open(base + ".f32", "a+b")
+        self._idx_f = open(base + ".idx", "a+b")
+        self._idx_f.seek(0)
+        keys = self._idx_f.read()
+        rows = min(len(keys) // 32, os.path.getsize(base + ".f32") // self._row_bytes)
+        for row in range(rows):
+            self._rows[keys[row * 32:(row + 1) * 32]] = row
+        # Drop a torn tail (crash between the two writes) so row numbers stay aligned
+        self._vec_f.truncate(rows * self._row_bytes)
+        self._idx_f.truncate(rows * 32)
+        if rows:
+            print(f"[VECTOR] Embedding disk cache: {rows} vectors in {base}.f32", file=sys.stderr, flush=True)
+
+    def key(self, text: str) -> bytes:
+        return hashlib.sha256(f"{self.model}\0{text}".encode("utf-8")).digest()
+
+    def _read_row(self, row: int) -> array:
+        if row >= self._mapped_rows:
+            if self._mm:
+                self._mm.close()
+            self._vec_f.flush()
+            self._mm = mmap.mmap(self._vec_f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._mapped_rows = len(self._mm) // self._row_bytes
+        vec = array("f")
+        vec.frombytes(self._mm[row * self._row_bytes:(row + 1) * self._row_bytes])
+        return vec
+
+    def _remember(self, key: bytes, vec: array):
+        self._memory[key] = vec
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.capacity:
+            self._memory.popitem(last=False)
+
+    def get(self, key: bytes) -> Optional[List[float]]:
+        with self._lock:
+            vec = self._memory.get(key)
+            if vec is not None:
+                self._memory.move_to_end(key)
+                self._stats["memory_hits"] += 1
+                return vec.tolist()
+            row = self._rows.get(key)
+            if row is not None:
+                vec = self._read_row(row)
+                self._remember(key, vec)
+                self._stats["disk_hits"] += 1
+                return vec.tolist()
+            self._stats["misses"] += 1
+            return None
+
+    def put(self, key: bytes, values: List[float]):
+        vec = array("f", values)
+        with self._lock:
+            self._remember(key, vec)
+            if self._vec_f is None or key in self._rows or len(vec) != VECTOR_SIZE:
+                return
+            try:
+                self._vec_f.seek(0, os.SEEK_END)
+                row = self._vec_f.tell() // self._row_bytes
+                self._vec_f.write(vec.tobytes())
+                self._vec_f.flush()
+                self._idx_f.write(key)
+                self._idx_f.flush()
+                self._rows[key] = row
+            except OSError as e:
+                print(f"[VECTOR] Embedding disk cache write failed: {e}", file=sys.stderr, flush=True)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = sum(self._stats.values())
+            hits = self._stats["memory_hits"] + self._stats["disk_hits"]
+            return {**self._stats, "hit_rate": round(hits / lookups, 3) if lookups else 0.0,
+                    "memory_entries": len(self._memory), "capacity": self.capacity,
+                    "disk_entries": len(self._rows), "disk": self._vec_f is not None}
+
+
+_embed_cache = _EmbeddingCache(EMBEDDING_MODEL, EMBED_CACHE_SIZE, EMBED_CACHE_DIR)
 
 
 def _embed(texts: List[str]) -> List[List[float]]:
-    embedder = _get_embedder()
-    if not embedder:
-        return []
-    try:
-        return [list(v) for v in embedder.embed(texts)]
-    except Exception as e:
-        print(f"[VECTOR] Embedding failed: {e}", file=sys.stderr, flush=True)
-        return []
+    """Embed texts, running the model only for ones not already cached."""
+    keys = [_embed_cache.key(t) for t in texts]
+    vectors: List[Optional[List[float]]] = [_embed_cache.get(k) for k in keys]
+    missing: Dict[bytes, List[int]] = {}
+    for i, vec in enumerate(vectors):
+        if vec is None:
+            missing.setdefault(keys[i], []).append(i)
+    if missing:
+        embedder = _get_embedder()
+        if not embedder:
+            return []
+        todo = [texts[positions[0]] for positions in missing.values()]
+        try:
+            computed = [list(v) for v in embedder.embed(todo)]
+        except Exception as e:
+            print(f"[VECTOR] Embedding failed: {e}", file=sys.stderr, flush=True)
+            return []
+        for (key, positions), vec in zip(missing.items(), computed):
+            _embed_cache.put(key, vec)
+            for i in positions:
+                vectors[i] = vec
+    return vectors
+
+
+def embedding_cache_stats() -> Dict[str, Any]:
+    return _embed_cache.stats()
+
+
+def embed_texts(texts: List[str]) -> List[List[float]]:
+    """Embed texts with the shared FastEmbed model (works without Qdrant)."""
+    return _embed(texts)
+
+
+def _shared() -> bool:
+    return VECTOR_LAYOUT == "shared"
 
 
 def _chat_collection(agent_id: int) -> str:
-    return f"agent_{agent_id}_chat"
+    return SHARED_CHAT_COLLECTION if _shared() else f"agent_{agent_id}_chat"
 
 
 def _docs_collection(agent_id: int) -> str:
-    return f"agent_{agent_id}_docs"
+    return SHARED_DOCS_COLLECTION if _shared() else f"agent_{agent_id}_docs"
+
+
+def _agent_filter(agent_id: int, *conditions) -> Optional[Any]:
+    """Query filter for one agent's points (only needed in the shared layout)."""
+    must = list(conditions)
+    if _shared():
+        must.insert(0, FieldCondition(key="agent_id", match=MatchValue(value=int(agent_id))))
+    return Filter(must=must) if must else None
+
 
+def _create_payload_indexes(client, name: str):
+    if name not in (SHARED_CHAT_COLLECTION, SHARED_DOCS_COLLECTION):
+        return
+    # agent_id is stored as an int, so it gets an integer (not keyword) index
+    client.create_payload_index(collection_name=name, field_name="agent_id",
+                                field_schema=PayloadSchemaType.INTEGER)
+    if name == SHARED_DOCS_COLLECTION:
+        client.create_payload_index(collection_name=name, field_name="filename",
+                                    field_schema=PayloadSchemaType.KEYWORD)
+
+
+def _remember_collections(response):
+    with _collections_lock:
+        _collections.clear()
+        _collections.update(c.name for c in response.collections)
+        _sparse_collections.clear()
+        _dense_collections.clear()
+
+
+def _forget_collection(name: str):
+    with _collections_lock:
+        _collections.discard(name)
+        _sparse_collections.discard(name)
+        _dense_collections.discard(name)
+
+
+def _sparse_config() -> Dict[str, Any]:
+    # Qdrant applies IDF at query time, so stored values only carry term frequency
+    return {SPARSE_VECTOR_NAME: SparseVectorParams(modifier=Modifier.IDF)}
+
+
+def _create_collection(client, name: str, sparse: bool):
+    client.create_collection(
+        collection_name=name,
+        vectors_config=VectorParams(size=VECTOR_SIZE, distance=Distance.COSINE),
+        sparse_vectors_config=_sparse_config() if sparse else None,
+    )
+    _create_payload_indexes(client, name)
+    print(f"[VECTOR] Created collection: {name}", file=sys.stderr, flush=True)
 
-def _ensure_collection(client, name: str):
+
+def _ensure_collection(client, name: str) -> bool:
+    """Create a collection unless the registry already knows it (no round trip then).
+
+    Returns whether it has the sparse vector config. Qdrant can't add a vector
+    to an existing collection, so in hybrid mode collections created before
+    VECTOR_HYBRID=1 stay dense-only until `vector_store.py hybrid-backfill`
+    rebuilds them.
+    """
+    with _collections_lock:
+        if name in _sparse_collections:
+            return True
+        if name in _collections and (not HYBRID_ENABLED or name in _dense_collections):
+            return False
+    return _check_collection(client, name, create=True)
+
+
+def _has_sparse(client, name: str) -> bool:
+    """Whether a collection has the sparse vector config (False if it doesn't exist)."""
+    with _collections_lock:
+        if name in _sparse_collections:
+            return True
+        if name in _dense_collections:
+            return False
+    return _check_collection(client, name, create=False)
+
+
+def _check_collection(client, name: str, create: bool) -> bool:
+    """Look up a collection's sparse config once per connection, creating the collection if asked."""
     try:
-        client.get_collection(name)
-    except Exception:
-        client.create_collection(
-            collection_name=name,
-            vectors_config=VectorParams(size=VECTOR_SIZE, distance=Distance.COSINE),
-        )
-        print(f"[VECTOR] Created collection: {name}", file=sys.stderr, flush=True)
+        info = client.get_collection(name)
+    except Exception as e:
+        if not _is_not_found(e):
+            raise
+        if not create:
+            return False
+        _create_collection(client, name, sparse=HYBRID_ENABLED)
+        sparse = HYBRID_ENABLED
+    else:
+        sparse = SPARSE_VECTOR_NAME in (info.config.params.sparse_vectors or {})
+        if HYBRID_ENABLED and not sparse:
+            print(f"[VECTOR] Collection {name} has no sparse vectors; using it dense-only until hybrid-backfill",
+                  file=sys.stderr, flush=True)
+    with _collections_lock:
+        _collections.add(name)
+        (_sparse_collections if sparse else _dense_collections).add(name)
+    return sparse
+
+
+# ── Sparse (keyword) vectors ─────────────────────────────
+
+_STOPWORDS = frozenset(
+    "a an and are as at be by for from has have in is it its of on or that the this to was were will with "
+    "i you he she we they me my your our their what which who how do does did not no so if but".split()
+)
+BM25_K1 = 1.2
+
+
+def _terms(text: str) -> List[str]:
+    return [t for t in re.findall(r"\w+", text.lower()) if t not in _STOPWORDS and len(t) > 1]
+
+
+def _term_index(term: str) -> int:
+    # Stable across processes (unlike hash()); collisions in 2^31 buckets are negligible
+    return zlib.crc32(term.encode("utf-8")) & 0x7FFFFFFF
+
+
+def sparse_document_vector(text: str) -> Optional[Any]:
+    """BM25 term-frequency weights (k1 saturation, no length norm) for a stored text."""
+    counts: Dict[int, int] = {}
+    for term in _terms(text):
+        idx = _term_index(term)
+        counts[idx] = counts.get(idx, 0) + 1
+    if not counts:
+        return None
+    indices = sorted(counts)
+    values = [counts[i] * (BM25_K1 + 1) / (counts[i] + BM25_K1) for i in indices]
+    return SparseVector(indices=indices, values=values)
+
+
+def sparse_query_vector(text: str) -> Optional[Any]:
+    indices = sorted({_term_index(t) for t in _terms(text)})
+    return SparseVector(indices=indices, values=[1.0] * len(indices)) if indices else None
+
+
+def _point_vector(dense: Any, text: str, sparse: Optional[bool] = None) -> Any:
+    """Dense vector, plus the sparse one in hybrid mode. Stored dicts are passed through."""
+    if not (HYBRID_ENABLED if sparse is None else sparse):
+        return dense
+    if isinstance(dense, dict):
+        if SPARSE_VECTOR_NAME in dense:
+            return dense
+        dense = dense.get("", next(iter(dense.values()), None))
+    sparse = sparse_document_vector(text)
+    return {"": dense, SPARSE_VECTOR_NAME: sparse} if sparse else {"": dense}
+
+
+def _query(client, name: str, dense: List[float], text: str, query_filter: Any, limit: int, hybrid: Optional[bool] = None):
+    """Dense query, or dense + sparse prefetches fused with RRF in hybrid mode.
+
+    Returns (points, fused). Fused scores are RRF ranks, not cosine similarities.
+    """
+    hybrid = HYBRID_ENABLED if hybrid is None else hybrid
+    sparse = sparse_query_vector(text) if hybrid else None
+    if sparse and not _has_sparse(client, name):
+        sparse = None  # collection from before VECTOR_HYBRID=1
+    if not sparse:
+        return client.query_points(collection_name=name, query=dense, query_filter=query_filter, limit=limit).points, False
+    fetch = limit * HYBRID_PREFETCH
+    result = client.query_points(
+        collection_name=name,
+        prefetch=[
+            Prefetch(query=dense, filter=query_filter, limit=fetch),
+            Prefetch(query=sparse, using=SPARSE_VECTOR_NAME, filter=query_filter, limit=fetch),
+        ],
+        query=FusionQuery(fusion=Fusion.RRF),
+        limit=limit,
+    )
+    return result.points, True
+
+
+def _is_not_found(error: Exception) -> bool:
+    code = getattr(error, "status_code", None)
+    if code is None and hasattr(error, "code") and callable(error.code):
+        code = getattr(error.code(), "name", None)  # grpc.RpcError
+    return code in (404, "NOT_FOUND") or "not found" in str(error).lower()
+
+
+def _dense_only(point: Any) -> Any:
+    if not isinstance(point.vector, dict):
+        return point
+    dense = point.vector.get("", next(iter(point.vector.values()), None))
+    return PointStruct(id=point.id, vector=dense, payload=point.payload)
+
+
+def _upsert(client, name: str, points: List[Any]):
+    """Upsert, re-validating the registry once if the collection vanished behind our back.
+
+    Sparse vectors are dropped for collections without the sparse config.
+    """
+    if not _ensure_collection(client, name):
+        points = [_dense_only(p) for p in points]
+    try:
+        client.upsert(collection_name=name, points=points)
+    except Exception as e:
+        if not _is_not_found(e):
+            raise
+        print(f"[VECTOR] Collection {name} missing, recreating", file=sys.stderr, flush=True)
+        _forget_collection(name)
+        _ensure_collection(client, name)
+        client.upsert(collection_name=name, points=points)
+
+
+class _QueryCache:
+    """LRU of search results, invalidated by a generation counter per (collection, agent).
+
+    Writers bump the generation after their write lands; a reader records the
+    generation before querying, so a result computed while a write was in
+    flight is stored under the old generation and never served.
+    """
+
+    def __init__(self, capacity: int, ttl: float):
+        self.capacity = capacity
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[tuple, tuple]" = OrderedDict()
+        self._generations: Dict[tuple, int] = {}
+        self._stats = {"hits": 0, "misses": 0, "invalidations": 0}
+
+    def generation(self, collection: str, agent_id: int) -> int:
+        with self._lock:
+            return self._generations.get((collection, int(agent_id)), 0)
+
+    def get(self, key: tuple, generation: int) -> Optional[List[Dict[str, Any]]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] == generation and time.monotonic() - entry[1] < self.ttl:
+                self._entries.move_to_end(key)
+                self._stats["hits"] += 1
+                return [dict(r) for r in entry[2]]
+            if entry:
+                del self._entries[key]
+            self._stats["misses"] += 1
+            return None
+
+    def put(self, key: tuple, generation: int, results: List[Dict[str, Any]]):
+        with self._lock:
+            self._entries[key] = (generation, time.monotonic(), [dict(r) for r in results])
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, collection: str, agent_id: int):
+        # Stale entries are dropped lazily when next looked up (or evicted)
+        with self._lock:
+            key = (collection, int(agent_id))
+            self._generations[key] = self._generations.get(key, 0) + 1
+            self._stats["invalidations"] += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self._stats["hits"] + self._stats["misses"]
+            return {**self._stats, "hit_rate": round(self._stats["hits"] / lookups, 3) if lookups else 0.0,
+                    "entries": len(self._entries), "capacity": self.capacity, "ttl": self.ttl}
+
+
+_query_cache = _QueryCache(QUERY_CACHE_SIZE, QUERY_CACHE_TTL)
+
+
+def _cached_search(collection: str, agent_id: int, query: str, limit: int, hybrid: Optional[bool], run) -> List[Dict[str, Any]]:
+    """Serve a search from the query cache, or run it and cache the results.
+
+    `run` returns the results, or None on error (errors are not cached).
+    """
+    if QUERY_CACHE_SIZE <= 0:
+        return run() or []
+    key = (_readiness.get("backend"), collection, int(agent_id), " ".join(query.split()), limit,
+           HYBRID_ENABLED if hybrid is None else hybrid)
+    generation = _query_cache.generation(collection, agent_id)
+    results = _query_cache.get(key, generation)
+    if results is not None:
+        return results
+    results = run()
+    if results is None:
+        return []
+    _query_cache.put(key, generation, results)
+    return results
+
+
+def query_cache_stats() -> Dict[str, Any]:
+    return _query_cache.stats()
 
 
 def is_available() -> bool:
@@ -113,12 +867,23 @@ def delete_agent(agent_id: int):
     client = _get_client()
     if not client:
         return
+    if _shared():
+        for name in [_chat_collection(agent_id), _docs_collection(agent_id)]:
+            try:
+                client.delete(collection_name=name, points_selector=_agent_filter(agent_id))
+                print(f"[VECTOR] Deleted agent {agent_id} points from {name}", file=sys.stderr, flush=True)
+            except Exception:
+                pass
+            _query_cache.invalidate(name, agent_id)
+        return
     for name in [_chat_collection(agent_id), _docs_collection(agent_id)]:
+        _forget_collection(name)
         try:
             client.delete_collection(name)
             print(f"[VECTOR] Deleted collection: {name}", file=sys.stderr, flush=True)
         except Exception:
             pass
+        _query_cache.invalidate(name, agent_id)
 
 
 # ── Chat History ──────────────────────────────────────────
@@ -127,136 +892,460 @@ def add_chat_message(agent_id: int, role: str, content: str, timestamp: str = ""
     client = _get_client()
     if not client or not content.strip():
         return
-    _ensure_collection(client, _chat_collection(agent_id))
     vectors = _embed([content])
     if not vectors:
         return
     point_id = str(uuid.uuid4())
     ts = timestamp or time.strftime("%Y-%m-%dT%H:%M:%S")
+    name = _chat_collection(agent_id)
     try:
-        client.upsert(
-            collection_name=_chat_collection(agent_id),
-            points=[PointStruct(
+        _upsert(
+            client,
+            name,
+            [PointStruct(
                 id=point_id,
-                vector=vectors[0],
-                payload={"role": role, "content": content, "timestamp": ts, "agent_id": agent_id},
+                vector=_point_vector(vectors[0], content),
+                payload={"role": role, "content": content, "timestamp": ts, "agent_id": int(agent_id)},
             )],
         )
     except Exception as e:
         print(f"[VECTOR] add_chat_message error: {e}", file=sys.stderr, flush=True)
+    finally:
+        _query_cache.invalidate(name, agent_id)
+
+
+class _ChatIndexer:
+    """Bounded queue of chat messages, embedded and upserted by one worker thread.
+
+    Messages from all agents share a batch (one embed call), then go out as one
+    upsert per collection. When the queue is full the oldest message is dropped.
+    """
+
+    def __init__(self, batch_size: int, max_wait: float, max_queued: int):
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self._queue: deque = deque()
+        self._max_queued = max_queued
+        self._cond = threading.Condition()
+        self._in_flight = 0
+        self._flushing = 0
+        self._thread: Optional[threading.Thread] = None
+        self._stats = {"enqueued": 0, "indexed": 0, "dropped": 0, "failed": 0, "requeued": 0, "batches": 0,
+                       "last_batch_size": 0, "last_batch_ms": 0, "last_lag_ms": 0}
+
+    def enqueue(self, agent_id: int, role: str, content: str, timestamp: str, block: bool = False):
+        with self._cond:
+            while block and self._thread is not None and len(self._queue) >= self._max_queued:
+                self._cond.wait(1.0)
+            if len(self._queue) >= self._max_queued:
+                self._queue.popleft()
+                self._stats["dropped"] += 1
+            self._queue.append((time.time(), agent_id, role, content, timestamp))
+            self._stats["enqueued"] += 1
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="vector-indexer", daemon=True)
+                self._thread.start()
+            self._cond.notify_all()
+
+    def _take_batch(self) -> List[tuple]:
+        with self._cond:
+            while not self._queue:
+                self._cond.wait()
+            # Give a burst a moment to fill the batch before embedding
+            deadline = time.time() + self.max_wait
+            while len(self._queue) < self.batch_size and time.time() < deadline and not self._flushing:
+                self._cond.wait(deadline - time.time())
+            n = min(self.batch_size, len(self._queue))
+            batch = [self._queue.popleft() for _ in range(n)]
+            self._in_flight = n
+            return batch
+
+    def _run(self):
+        while True:
+            # While Qdrant is unreachable messages wait in the (bounded) queue instead of failing;
+            # in auto mode they go to the local index meanwhile
+            if VECTOR_BACKEND != "auto":
+                _breaker.wait_closed()
+            batch = self._take_batch()
+            started = time.time()
+            try:
+                indexed, retry = _index_chat_batch(batch)
+            except Exception as e:
+                print(f"[VECTOR] Chat indexing batch failed: {e}", file=sys.stderr, flush=True)
+                indexed, retry = 0, []
+            with self._cond:
+                now = time.time()
+                # Back to the front of the queue, in order, until Qdrant is reachable again
+                self._queue.extendleft(reversed(retry))
+                self._stats["requeued"] += len(retry)
+                self._stats["indexed"] += indexed
+                self._stats["failed"] += len(batch) - indexed - len(retry)
+                self._stats["batches"] += 1
+                self._stats["last_batch_size"] = len(batch)
+                self._stats["last_batch_ms"] = int((now - started) * 1000)
+                self._stats["last_lag_ms"] = int((now - batch[0][0]) * 1000)
+                self._in_flight = 0
+                self._cond.notify_all()
+
+    def flush(self, timeout: float = 10.0) -> bool:
+        """Wait until everything queued so far is indexed (or timeout). True if drained."""
+        deadline = time.time() + timeout
+        with self._cond:
+            self._flushing += 1
+            self._cond.notify_all()
+            try:
+                while self._queue or self._in_flight:
+                    remaining = deadline - time.time()
+                    if remaining <= 0 or self._thread is None or (
+                            _breaker.state != "closed" and VECTOR_BACKEND != "auto"):
+                        return False
+                    self._cond.wait(remaining)
+                return True
+            finally:
+                self._flushing -= 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            oldest = self._queue[0][0] if self._queue else None
+            return {**self._stats, "queued": len(self._queue) + self._in_flight,
+                    "lag_ms": int((time.time() - oldest) * 1000) if oldest else 0,
+                    "batch_size": self.batch_size, "max_queued": self._max_queued}
+
+
+def _index_chat_batch(batch: List[tuple]) -> Tuple[int, List[tuple]]:
+    """Embed a batch of (enqueued_at, agent_id, role, content, timestamp) and upsert it.
+
+    Returns (points written, items to retry): items are handed back instead of
+    dropped when Qdrant is unreachable (circuit open or a connection error).
+    """
+    client = _get_client()
+    if not client:
+        return 0, (list(batch) if _breaker.state != "closed" else [])
+    vectors = _embed([item[3] for item in batch])
+    if len(vectors) != len(batch):
+        return 0, []
+    by_collection: Dict[str, List[Any]] = {}
+    items: Dict[str, List[tuple]] = {}
+    agents: Dict[str, set] = {}
+    for item, vec in zip(batch, vectors):
+        _, agent_id, role, content, ts = item
+        name = _chat_collection(agent_id)
+        agents.setdefault(name, set()).add(int(agent_id))
+        items.setdefault(name, []).append(item)
+        by_collection.setdefault(name, []).append(PointStruct(
+            id=str(uuid.uuid4()),
+            vector=_point_vector(vec, content),
+            payload={"role": role, "content": content, "timestamp": ts, "agent_id": int(agent_id)},
+        ))
+    written, retry = 0, []
+    for name, points in by_collection.items():
+        try:
+            _upsert(client, name, points)
+            written += len(points)
+        except Exception as e:
+            print(f"[VECTOR] Chat batch upsert to {name} failed: {e}", file=sys.stderr, flush=True)
+            if _is_connection_error(e):
+                retry.extend(items[name])
+        for agent_id in agents[name]:
+            _query_cache.invalidate(name, agent_id)
+    return written, retry
+
+
+_indexer = _ChatIndexer(INDEX_BATCH_SIZE, INDEX_MAX_WAIT, INDEX_QUEUE_MAX)
+
+
+def enqueue_chat_message(agent_id: int, role: str, content: str, timestamp: str = "", block: bool = False):
+    """Queue a chat message for background indexing.
+
+    Returns immediately (dropping the oldest queued message if full) unless
+    block=True, which waits for room instead (bulk imports).
+    """
+    if not QDRANT_AVAILABLE or not content.strip():
+        return
+    _indexer.enqueue(agent_id, role, content, timestamp or time.strftime("%Y-%m-%dT%H:%M:%S"), block)
+
+
+def flush_indexing(timeout: float = 10.0) -> bool:
+    return _indexer.flush(timeout)
+
+
+def indexing_stats() -> Dict[str, Any]:
+    return _indexer.stats()
 
 
 def search_chat(agent_id: int, query: str, limit: int = 10) -> List[Dict[str, Any]]:
     client = _get_client()
     if not client:
         return []
+    name = _chat_collection(agent_id)
+    return _cached_search(name, agent_id, query, limit, None,
+                          lambda: _search_chat(client, name, agent_id, query, limit))
+
+
+def _search_chat(client, name: str, agent_id: int, query: str, limit: int) -> Optional[List[Dict[str, Any]]]:
     vectors = _embed([query])
     if not vectors:
-        return []
+        return None
     try:
-        results = client.query_points(
-            collection_name=_chat_collection(agent_id),
-            query=vectors[0],
-            limit=limit,
-        )
+        points, fused = _query(client, name, vectors[0], query, _agent_filter(agent_id), limit)
         return [
             {
                 "role": r.payload.get("role", ""),
                 "content": r.payload.get("content", ""),
                 "timestamp": r.payload.get("timestamp", ""),
-                "score": round(r.score, 3),
+                "score": round(r.score, 4 if fused else 3),
+                "fused": fused,
             }
-            for r in results.points
+            for r in points
         ]
     except Exception as e:
         print(f"[VECTOR] search_chat error: {e}", file=sys.stderr, flush=True)
-        return []
+        return None
 
 
 # ── Documents (RAG) ──────────────────────────────────────
 
-def chunk_text(text: str, chunk_size: int = 200, overlap: int = 30) -> List[str]:
-    words = text.split()
-    chunks = []
-    start = 0
-    while start < len(words):
-        end = start + chunk_size
-        chunk = " ".join(words[start:end])
-        if chunk.strip():
-            chunks.append(chunk)
-        start = end - overlap
-    return chunks
+_SENTENCE_END = re.compile(r"(?<=[.!?。！？])\s+")
 
 
-def add_document(agent_id: int, filename: str, content: str) -> int:
+def _estimate_tokens(text: str) -> int:
+    return max(1, len(text) // 4)
+
+
+def _iter_paragraphs(source) -> Iterator[str]:
+    """Blank-line separated paragraphs from a string or any iterable of lines."""
+    lines = io.StringIO(source) if isinstance(source, str) else source
+    para: List[str] = []
+    for line in lines:
+        line = line.strip()
+        if line:
+            para.append(line)
+        elif para:
+            yield " ".join(para)
+            para = []
+    if para:
+        yield " ".join(para)
+
+
+def _iter_pieces(paragraph: str, max_tokens: int) -> Iterator[str]:
+    """Sentences of a paragraph; sentences longer than max_tokens are split on words."""
+    for sentence in _SENTENCE_END.split(paragraph):
+        if _estimate_tokens(sentence) <= max_tokens:
+            yield sentence
+            continue
+        words: List[str] = []
+        size = 0
+        for word in sentence.split():
+            t = _estimate_tokens(word + " ")
+            if words and size + t > max_tokens:
+                yield " ".join(words)
+                words, size = [], 0
+            words.append(word)
+            size += t
+        if words:
+            yield " ".join(words)
+
+
+def iter_chunks(source, max_tokens: int = CHUNK_TOKENS, overlap_tokens: int = CHUNK_OVERLAP_TOKENS) -> Iterator[str]:
+    """Yield chunks of up to ~max_tokens built from whole sentences.
+
+    A chunk also ends at a paragraph break once it is half full, so an edit only
+    re-chunks its own paragraph instead of shifting every later chunk. The last
+    ~overlap_tokens of sentences are repeated at the start of the next chunk.
+    """
+    current: List[str] = []
+    sizes: List[int] = []
+    fresh = 0
+
+    def _carry():
+        kept, total = [], 0
+        for piece, size in zip(reversed(current), reversed(sizes)):
+            if total + size > overlap_tokens:
+                break
+            kept.append((piece, size))
+            total += size
+        kept.reverse()
+        return [p for p, _ in kept], [n for _, n in kept]
+
+    for paragraph in _iter_paragraphs(source):
+        for piece in _iter_pieces(paragraph, max_tokens):
+            size = _estimate_tokens(piece)
+            if fresh and sum(sizes) + size > max_tokens:
+                yield " ".join(current)
+                current, sizes = _carry()
+                fresh = 0
+            current.append(piece)
+            sizes.append(size)
+            fresh += 1
+        if fresh and sum(sizes) >= max_tokens // 2:
+            yield " ".join(current)
+            current, sizes = _carry()
+            fresh = 0
+    if fresh:
+        yield " ".join(current)
+
+
+def chunk_text(text: str, chunk_size: int = CHUNK_TOKENS, overlap: int = CHUNK_OVERLAP_TOKENS) -> List[str]:
+    """All chunks of a text (see iter_chunks; sizes are in estimated tokens)."""
+    return list(iter_chunks(text, chunk_size, overlap))
+
+
+_CHUNK_NAMESPACE = uuid.uuid5(uuid.NAMESPACE_URL, "koalaclaw:document-chunks")
+
+
+def _chunk_id(agent_id: int, filename: str, chunk: str, seen: Dict[str, int]) -> str:
+    """Point id from (agent, filename, content hash, occurrence of that content so far)."""
+    digest = hashlib.sha256(chunk.encode("utf-8")).hexdigest()
+    occurrence = seen.get(digest, 0)
+    seen[digest] = occurrence + 1
+    return str(uuid.uuid5(_CHUNK_NAMESPACE, f"{int(agent_id)}/{filename}/{digest}/{occurrence}"))
+
+
+def _existing_chunks(client, agent_id: int, filename: str) -> Dict[str, int]:
+    """id -> chunk_index of the points currently stored for a document."""
+    existing: Dict[str, int] = {}
+    offset = None
+    while True:
+        records, offset = client.scroll(
+            collection_name=_docs_collection(agent_id),
+            scroll_filter=_agent_filter(agent_id, FieldCondition(key="filename", match=MatchValue(value=filename))),
+            limit=1000, offset=offset, with_payload=["chunk_index"], with_vectors=False,
+        )
+        for r in records:
+            existing[str(r.id)] = (r.payload or {}).get("chunk_index", -1)
+        if offset is None:
+            return existing
+
+
+def index_document(agent_id: int, filename: str, content) -> Dict[str, int]:
+    """(Re-)index a document, embedding only chunks that are new since the last upload.
+
+    `content` is a string or an iterable of lines. Chunks are streamed from
+    iter_chunks and embedded/upserted DOC_BATCH_SIZE at a time, so memory stays
+    flat for large files. Unchanged chunks keep their points (moved ones only
+    get a payload update), chunks no longer in the document are deleted.
+    """
+    stats = {"chunks": 0, "embedded": 0, "unchanged": 0, "moved": 0, "deleted": 0}
     client = _get_client()
-    if not client or not content.strip():
-        return 0
-    _ensure_collection(client, _docs_collection(agent_id))
-    chunks = chunk_text(content)
-    if not chunks:
-        return 0
-    vectors = _embed(chunks)
-    if not vectors or len(vectors) != len(chunks):
-        return 0
-    points = []
-    for i, (chunk, vec) in enumerate(zip(chunks, vectors)):
-        points.append(PointStruct(
-            id=str(uuid.uuid4()),
-            vector=vec,
-            payload={
-                "filename": filename,
-                "chunk_index": i,
-                "content": chunk,
-                "agent_id": agent_id,
-                "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
-            },
-        ))
+    if not client or (isinstance(content, str) and not content.strip()):
+        return stats
+    name = _docs_collection(agent_id)
     try:
-        client.upsert(collection_name=_docs_collection(agent_id), points=points)
-        print(f"[VECTOR] Added {len(points)} chunks from '{filename}' for agent {agent_id}", file=sys.stderr, flush=True)
-        return len(points)
+        _ensure_collection(client, name)
+        existing = _existing_chunks(client, agent_id, filename)
+    except Exception as e:
+        print(f"[VECTOR] Reading existing chunks of '{filename}' failed, re-indexing all: {e}", file=sys.stderr, flush=True)
+        existing = {}
+
+    now = time.strftime("%Y-%m-%dT%H:%M:%S")
+
+    def _point(pid, i, chunk, vec):
+        return PointStruct(id=pid, vector=_point_vector(vec, chunk), payload={
+            "filename": filename, "chunk_index": i, "content": chunk,
+            "agent_id": int(agent_id), "timestamp": now,
+        })
+
+    def _flush_new(batch):
+        vectors = _embed([chunk for _, _, chunk in batch])
+        if len(vectors) != len(batch):
+            raise RuntimeError("embedding failed")
+        _upsert(client, name, [_point(pid, i, chunk, vec) for (pid, i, chunk), vec in zip(batch, vectors)])
+        stats["embedded"] += len(batch)
+
+    def _flush_moved(batch):
+        # Same content at a new position: reuse the stored vector
+        stored = {str(r.id): r.vector for r in client.retrieve(
+            collection_name=name, ids=[pid for pid, _, _ in batch], with_vectors=True)}
+        points = [_point(pid, i, chunk, stored[pid]) for pid, i, chunk in batch if pid in stored]
+        if points:
+            _upsert(client, name, points)
+        stats["moved"] += len(points)
+        return [item for item in batch if item[0] not in stored]
+
+    seen: Dict[str, int] = {}
+    current = set()
+    new_batch, moved_batch = [], []
+    try:
+        for i, chunk in enumerate(iter_chunks(content)):
+            pid = _chunk_id(agent_id, filename, chunk, seen)
+            current.add(pid)
+            stats["chunks"] += 1
+            if pid not in existing:
+                new_batch.append((pid, i, chunk))
+            elif existing[pid] != i:
+                moved_batch.append((pid, i, chunk))
+            else:
+                stats["unchanged"] += 1
+            if len(moved_batch) >= DOC_BATCH_SIZE:
+                new_batch += _flush_moved(moved_batch)
+                moved_batch = []
+            if len(new_batch) >= DOC_BATCH_SIZE:
+                _flush_new(new_batch)
+                new_batch = []
+        if moved_batch:
+            new_batch += _flush_moved(moved_batch)
+        if new_batch:
+            _flush_new(new_batch)
+        stale = [pid for pid in existing if pid not in current]
+        if stale:
+            client.delete(collection_name=name, points_selector=stale)
+        stats["deleted"] = len(stale)
     except Exception as e:
         print(f"[VECTOR] add_document error: {e}", file=sys.stderr, flush=True)
-        return 0
+        return {**stats, "chunks": 0}
+    finally:
+        _query_cache.invalidate(name, agent_id)
+    print(f"[VECTOR] Indexed '{filename}' for agent {agent_id}: {stats}", file=sys.stderr, flush=True)
+    return stats
+
+
+def add_document(agent_id: int, filename: str, content: str) -> int:
+    """Index a document; returns the number of chunks it now has in the store."""
+    return index_document(agent_id, filename, content)["chunks"]
 
 
-def search_docs(agent_id: int, query: str, limit: int = 5) -> List[Dict[str, Any]]:
+def search_docs(agent_id: int, query: str, limit: int = 5, hybrid: Optional[bool] = None) -> List[Dict[str, Any]]:
+    """Top document chunks for a query. hybrid=None follows VECTOR_HYBRID; results say whether scores are fused."""
     client = _get_client()
     if not client:
         return []
+    name = _docs_collection(agent_id)
+    return _cached_search(name, agent_id, query, limit, hybrid,
+                          lambda: _search_docs(client, name, agent_id, query, limit, hybrid))
+
+
+def _search_docs(client, name: str, agent_id: int, query: str, limit: int,
+                 hybrid: Optional[bool]) -> Optional[List[Dict[str, Any]]]:
     vectors = _embed([query])
     if not vectors:
-        return []
+        return None
     try:
-        results = client.query_points(
-            collection_name=_docs_collection(agent_id),
-            query=vectors[0],
-            limit=limit,
-        )
+        points, fused = _query(client, name, vectors[0], query, _agent_filter(agent_id), limit, hybrid)
         return [
             {
                 "filename": r.payload.get("filename", ""),
                 "content": r.payload.get("content", ""),
                 "chunk_index": r.payload.get("chunk_index", 0),
-                "score": round(r.score, 3),
+                "score": round(r.score, 4 if fused else 3),
+                "fused": fused,
             }
-            for r in results.points
+            for r in points
         ]
     except Exception as e:
         print(f"[VECTOR] search_docs error: {e}", file=sys.stderr, flush=True)
-        return []
+        return None
 
 
 def delete_document(agent_id: int, filename: str) -> bool:
     client = _get_client()
     if not client:
         return False
+    name = _docs_collection(agent_id)
     try:
         client.delete(
-            collection_name=_docs_collection(agent_id),
-            points_selector=Filter(
-                must=[FieldCondition(key="filename", match=MatchValue(value=filename))]
+            collection_name=name,
+            points_selector=_agent_filter(
+                agent_id, FieldCondition(key="filename", match=MatchValue(value=filename))
             ),
         )
         print(f"[VECTOR] Deleted document '{filename}' for agent {agent_id}", file=sys.stderr, flush=True)
@@ -264,3 +1353,215 @@ def delete_document(agent_id: int, filename: str) -> bool:
     except Exception as e:
         print(f"[VECTOR] delete_document error: {e}", file=sys.stderr, flush=True)
         return False
+    finally:
+        _query_cache.invalidate(name, agent_id)
+
+
+# ── Layout migration ─────────────────────────────────────
+
+def migrate_to_shared(delete_old: bool = False, batch_size: int = 256) -> Dict[str, int]:
+    """Copy every agent_{id}_chat / agent_{id}_docs collection into the shared ones.
+
+    Point ids and payloads are kept (agent_id is set from the collection name),
+    so re-running is idempotent. Returns points copied per source collection.
+    """
+    client = _get_client()
+    if not client:
+        raise RuntimeError("Qdrant not available")
+    copied: Dict[str, int] = {}
+    for collection in client.get_collections().collections:
+        match = re.match(r"^agent_(\d+)_(chat|docs)$", collection.name)
+        if not match:
+            continue
+        agent_id, kind = int(match.group(1)), match.group(2)
+        target = SHARED_CHAT_COLLECTION if kind == "chat" else SHARED_DOCS_COLLECTION
+        _ensure_collection(client, target)
+        offset, total = None, 0
+        while True:
+            records, offset = client.scroll(collection_name=collection.name, limit=batch_size,
+                                            offset=offset, with_payload=True, with_vectors=True)
+            if records:
+                _upsert(client, target, [
+                    PointStruct(id=r.id, vector=_point_vector(r.vector, (r.payload or {}).get("content", "")),
+                                payload={**(r.payload or {}), "agent_id": agent_id})
+                    for r in records
+                ])
+                total += len(records)
+            if offset is None:
+                break
+        copied[collection.name] = total
+        print(f"[VECTOR] Migrated {total} points: {collection.name} -> {target}", file=sys.stderr, flush=True)
+        if delete_old:
+            _forget_collection(collection.name)
+            client.delete_collection(collection.name)
+    return copied
+
+
+def import_local(batch_size: int = 256) -> Dict[str, int]:
+    """Copy every collection of the local index into Qdrant (ids kept, so re-runs are idempotent)."""
+    if not (QDRANT_AVAILABLE and local_vector_index):
+        raise RuntimeError("qdrant-client and numpy are required")
+    target = _connect_qdrant()
+    if not target:
+        raise RuntimeError("Qdrant not reachable")
+    source = local_vector_index.LocalVectorIndex(LOCAL_INDEX_DIR)
+    copied: Dict[str, int] = {}
+    for collection in source.get_collections().collections:
+        _ensure_collection(target, collection.name)
+        offset, total = None, 0
+        while True:
+            records, offset = source.scroll(collection_name=collection.name, limit=batch_size,
+                                            offset=offset, with_payload=True, with_vectors=True)
+            if records:
+                _upsert(target, collection.name, [
+                    PointStruct(id=r.id, vector=_point_vector(r.vector, (r.payload or {}).get("content", "")),
+                                payload=r.payload)
+                    for r in records
+                ])
+                total += len(records)
+            if offset is None:
+                break
+        copied[collection.name] = total
+        print(f"[VECTOR] Imported {total} points into {collection.name}", file=sys.stderr, flush=True)
+    source.close()
+    return copied
+
+
+REBUILD_SUFFIX = "__rebuild"
+
+
+def _copy_points(client, source: str, target: str, batch_size: int, sparse: bool) -> int:
+    """Copy every point (ids, payloads, dense vectors) of `source` into `target`."""
+    offset, total = None, 0
+    while True:
+        records, offset = client.scroll(collection_name=source, limit=batch_size, offset=offset,
+                                        with_payload=True, with_vectors=True)
+        if records:
+            points = [PointStruct(id=r.id, payload=r.payload,
+                                  vector=_point_vector(r.vector, (r.payload or {}).get("content", ""), sparse=sparse))
+                      for r in records]
+            client.upsert(collection_name=target, points=points if sparse else [_dense_only(p) for p in points])
+            total += len(records)
+        if offset is None:
+            return total
+
+
+def backfill_sparse(batch_size: int = 256) -> Dict[str, int]:
+    """Give every chat/docs collection the sparse vector config and its points sparse vectors.
+
+    Qdrant can't add a vector to an existing collection, so collections created
+    before VECTOR_HYBRID=1 are rebuilt: points are copied to `<name>__rebuild`,
+    the collection is recreated with the sparse config, and the points are
+    copied back with sparse vectors (ids kept). A run that was interrupted is
+    finished from the `__rebuild` copy. Stop the admin API while this runs.
+    """
+    client = _get_client()
+    if not client:
+        raise RuntimeError("Qdrant not available")
+    existing = {c.name for c in client.get_collections().collections}
+    names = {n[:-len(REBUILD_SUFFIX)] if n.endswith(REBUILD_SUFFIX) else n for n in existing}
+    done: Dict[str, int] = {}
+    for name in sorted(names):
+        if not (re.match(r"^agent_\d+_(chat|docs)$", name) or name in (SHARED_CHAT_COLLECTION, SHARED_DOCS_COLLECTION)):
+            continue
+        tmp = name + REBUILD_SUFFIX
+        has_sparse = False
+        if name in existing:
+            info = client.get_collection(name)
+            has_sparse = SPARSE_VECTOR_NAME in (info.config.params.sparse_vectors or {})
+        _forget_collection(name)
+        if not has_sparse:
+            if name in existing:
+                if tmp in existing:
+                    client.delete_collection(tmp)  # partial copy; the original is still complete
+                _create_collection(client, tmp, sparse=False)
+                _copy_points(client, name, tmp, batch_size, sparse=False)
+                client.delete_collection(name)
+            _create_collection(client, name, sparse=True)
+        if tmp in existing or not has_sparse:
+            total = _copy_points(client, tmp, name, batch_size, sparse=True)
+            client.delete_collection(tmp)
+            done[name] = total
+            print(f"[VECTOR] Rebuilt {name} with sparse vectors ({total} points)", file=sys.stderr, flush=True)
+            continue
+        offset, total = None, 0
+        while True:
+            records, offset = client.scroll(collection_name=name, limit=batch_size, offset=offset,
+                                            with_payload=["content"], with_vectors=False)
+            updates = []
+            for r in records:
+                sparse = sparse_document_vector((r.payload or {}).get("content", ""))
+                if sparse:
+                    updates.append(PointVectors(id=r.id, vector={SPARSE_VECTOR_NAME: sparse}))
+            if updates:
+                client.update_vectors(collection_name=name, points=updates)
+                total += len(updates)
+            if offset is None:
+                break
+        done[name] = total
+        print(f"[VECTOR] Sparse vectors added to {total} points in {name}", file=sys.stderr, flush=True)
+    return done
+
+
+def bench_recall(agent_id: int, queries: List[Dict[str, Any]], ks: List[int]) -> Dict[str, Dict[int, float]]:
+    """Recall@k of dense vs hybrid search_docs.
+
+    Each query is {"query", "filename"} or {"query", "contains"}; a hit is
+    relevant if its filename matches / its content contains the string.
+    """
+    def _relevant(hit, q):
+        if q.get("filename"):
+            return hit["filename"] == q["filename"]
+        return q.get("contains", "").lower() in hit["content"].lower()
+
+    top = max(ks)
+    recall: Dict[str, Dict[int, float]] = {}
+    for mode, hybrid in (("dense", False), ("hybrid", True)):
+        found = {k: 0 for k in ks}
+        for q in queries:
+            hits = search_docs(agent_id, q["query"], limit=top, hybrid=hybrid)
+            rank = next((i for i, h in enumerate(hits) if _relevant(h, q)), None)
+            for k in ks:
+                if rank is not None and rank < k:
+                    found[k] += 1
+        recall[mode] = {k: round(found[k] / len(queries), 3) if queries else 0.0 for k in ks}
+    return recall
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="KoalaClaw vector store maintenance")
+    sub = parser.add_subparsers(dest="command", required=True)
+    migrate = sub.add_parser("migrate-shared", help="copy per-agent collections into the shared layout")
+    migrate.add_argument("--delete-old", action="store_true", help="drop per-agent collections after copying")
+    sub.add_parser("import-local", help="copy points from the local index (VECTOR_LOCAL_DIR) into Qdrant")
+    sub.add_parser("hybrid-backfill", help="rebuild collections from before VECTOR_HYBRID=1 with sparse vectors")
+    bench = sub.add_parser("bench", help="recall@k of dense vs hybrid document search")
+    bench.add_argument("--agent", type=int, required=True)
+    bench.add_argument("--queries", required=True, help='JSONL of {"query", "filename"|"contains"}')
+    bench.add_argument("--k", default="1,3,5,10", help="comma-separated k values")
+    args = parser.parse_args()
+
+    if args.command == "migrate-shared":
+        result = migrate_to_shared(delete_old=args.delete_old)
+        print(json.dumps({"migrated": result, "points": sum(result.values())}, indent=2))
+        print("Set VECTOR_LAYOUT=shared for the admin API to use the shared collections.")
+    elif args.command == "import-local":
+        result = import_local()
+        print(json.dumps({"imported": result, "points": sum(result.values())}, indent=2))
+    elif args.command == "hybrid-backfill":
+        result = backfill_sparse()
+        print(json.dumps({"updated": result, "points": sum(result.values())}, indent=2))
+    elif args.command == "bench":
+        with open(args.queries, encoding="utf-8") as f:
+            queries = [json.loads(line) for line in f if line.strip()]
+        ks = sorted(int(k) for k in args.k.split(","))
+        recall = bench_recall(args.agent, queries, ks)
+        print(f"{len(queries)} queries, agent {args.agent}")
+        print("k      " + "  ".join(f"{k:>6}" for k in ks))
+        for mode, values in recall.items():
+            print(f"{mode:<7}" + "  ".join(f"{values[k]:>6.3f}" for k in ks))
+        best_dense = recall["dense"][ks[-1]]
+        k_hybrid = next((k for k in ks if recall["hybrid"][k] >= best_dense), None)
+        print(f"hybrid matches dense@{ks[-1]} recall ({best_dense:.3f}) at k={k_hybrid}")